@@ -0,0 +1,192 @@
+"""Trains the DQN agent with a pool of actor processes and a single learner.
+
+Each actor steps its own vector environment, choosing actions with a NumPy
+copy of the network (so actors never import TensorFlow), and sends chunks of
+transitions to the learner. The learner stores them in its replay buffer,
+trains continuously, and periodically broadcasts its latest weights to the
+actors through shared memory.
+
+This module is imported by the actor processes, so TensorFlow must only be
+imported inside the learner's functions."""
+
+from environment.envs.vector_application_placement_env import VectorApplicationPlacementEnv
+from numpy_dqn import NumpyDuelingDQN, NumpyPolicy, layer_weights
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import queue
+
+# The number of transitions an actor collects before sending them to the
+# learner. Larger chunks amortize the cost of inter-process communication.
+CHUNK_SIZE = 256
+# The number of learner train steps between weight broadcasts
+BROADCAST_INTERVAL = 50
+
+class SharedWeights:
+    """The weights of a DuelingDQN held in a shared memory block as one flat
+    float32 array. A version counter tells readers when new weights have been
+    written."""
+    def __init__(self, shapes, name=None, lock=None, version=None):
+        # The shape of each weight array, keyed by name
+        self.shapes = shapes
+        sizes = [int(np.prod(shape)) for shape in shapes.values()]
+        self.offsets = np.cumsum([0] + sizes)
+        nbytes = int(self.offsets[-1]) * np.dtype(np.float32).itemsize
+        # The creator of the block passes no name, and readers attach to it by
+        # name
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=nbytes)
+        self.array = np.ndarray((int(self.offsets[-1]),), dtype=np.float32, buffer=self.memory.buf)
+        self.lock = lock if lock is not None else mp.Lock()
+        self.version = version if version is not None else mp.Value("i", 0, lock=False)
+
+    def attach_args(self):
+        """Returns the arguments for attaching to this block from another
+        process."""
+        return self.shapes, self.memory.name, self.lock, self.version
+
+    def write(self, weights):
+        """Copies the given weights into shared memory and bumps the version."""
+        with self.lock:
+            for i, name in enumerate(self.shapes):
+                self.array[self.offsets[i]:self.offsets[i + 1]] = np.ravel(weights[name])
+            self.version.value += 1
+
+    def read(self):
+        """Returns a copy of the weights currently in shared memory."""
+        with self.lock:
+            return {
+                name: self.array[self.offsets[i]:self.offsets[i + 1]].reshape(shape).copy()
+                for i, (name, shape) in enumerate(self.shapes.items())
+            }
+
+    def close(self, unlink=False):
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+def run_actor(actor_id, num_envs, weight_args, epsilon, transition_queue, stop_event, seed):
+    """Runs in an actor process. Steps a vector environment with the latest
+    broadcast weights and sends chunks of transitions to the learner."""
+    weights = SharedWeights(*weight_args)
+    version = weights.version.value
+    policy = NumpyPolicy(NumpyDuelingDQN(weights.read()))
+    envs = VectorApplicationPlacementEnv(num_envs)
+    np.random.seed(seed)
+
+    states, infos = envs.reset(seed=seed)
+    episode_rewards = np.zeros(num_envs)
+    chunk = []
+    finished_rewards = []
+    while not stop_event.is_set():
+        # Picks up new weights whenever the learner has broadcast them
+        if weights.version.value != version:
+            version = weights.version.value
+            policy.q_net = NumpyDuelingDQN(weights.read())
+        policy.epsilon = epsilon.value
+
+        actions = policy.policy_batch(states, infos["action_mask"])
+        next_states, rewards, dones, _, infos = envs.step(actions)
+        # Sub-environments that terminated have already been reset, so their
+        # real next states are the final states
+        chunk.append((states, actions, rewards, infos["final_states"], dones, infos["action_mask"]))
+        episode_rewards += rewards
+        finished_rewards.extend(episode_rewards[dones].tolist())
+        episode_rewards[dones] = 0.0
+        states = next_states
+
+        if len(chunk) * num_envs >= CHUNK_SIZE:
+            transition_queue.put((actor_id, *[np.concatenate(column) for column in zip(*chunk)], finished_rewards))
+            chunk = []
+            finished_rewards = []
+    weights.close()
+
+def train_distributed(num_workers: int, num_episodes: int, model_save_path: str, num_envs: int = 1,
+                      replay_buffer=None, checkpointer=None, resume_path=None):
+    """Trains the agent with num_workers actor processes, each stepping
+    num_envs sub-environments, until num_episodes episodes have finished.
+    Checkpoints (see checkpoint.py) hold the learner's state, so actors start
+    new episodes when resuming from one."""
+    from dqn_agent import DQNAgent
+    from checkpoint import load_checkpoint
+    agent = DQNAgent(replay_buffer=replay_buffer)
+    total_reward = 0.0
+    episodes_finished = 0
+    if resume_path is not None:
+        progress = load_checkpoint(resume_path, agent)
+        episodes_finished = progress["episodes_finished"]
+        total_reward = progress["total_reward"]
+        print(f"Resumed training from {resume_path} after {episodes_finished} episodes")
+
+    # Actors are started with "spawn" so that they don't inherit the
+    # learner's TensorFlow state
+    context = mp.get_context("spawn")
+    initial_weights = layer_weights(agent.q_net)
+    weights = SharedWeights(
+        {name: w.shape for name, w in initial_weights.items()},
+        lock=context.Lock(), version=context.Value("i", 0, lock=False)
+    )
+    weights.write(initial_weights)
+    epsilon = context.Value("d", agent.epsilon, lock=False)
+    transition_queue = context.Queue(maxsize=4 * num_workers)
+    stop_event = context.Event()
+    actors = [
+        context.Process(
+            target=run_actor,
+            args=(i, num_envs, weights.attach_args(), epsilon, transition_queue, stop_event, i),
+            daemon=True
+        )
+        for i in range(num_workers)
+    ]
+    for actor in actors:
+        actor.start()
+
+    last_broadcast = agent.trainstep
+    try:
+        while episodes_finished < num_episodes:
+            # Drains every chunk that has arrived, waiting for one if the
+            # buffer is still too small to train on
+            block = agent.replay_buffer.pointer < agent.batch_size
+            while True:
+                try:
+                    actor_id, states, actions, rewards, next_states, dones, next_masks, finished_rewards = transition_queue.get(block=block, timeout=1)
+                except queue.Empty:
+                    break
+                block = False
+                # Chunks hold each step of every sub-environment in turn, and
+                # each sub-environment's episodes are a separate stream
+                streams = [(actor_id, i % num_envs) for i in range(len(states))]
+                agent.store_batch(states, actions, rewards, next_states, dones, next_masks, streams)
+                for reward in finished_rewards:
+                    episodes_finished += 1
+                    total_reward += reward
+                    print(f"Reward for episode {episodes_finished} is {reward} and epsilon is {agent.epsilon}")
+
+            agent.train()
+            epsilon.value = agent.epsilon
+            if agent.trainstep - last_broadcast >= BROADCAST_INTERVAL:
+                weights.write(layer_weights(agent.q_net))
+                last_broadcast = agent.trainstep
+            if checkpointer is not None:
+                checkpointer.maybe_save(agent, {"episodes_finished": episodes_finished, "total_reward": total_reward})
+    except KeyboardInterrupt:
+        print("Training interrupted")
+    else:
+        print(f"Total reward for {episodes_finished} episodes is {total_reward}.")
+        print(f"Average reward is {total_reward / episodes_finished}")
+        if checkpointer is not None:
+            checkpointer.save(agent, {"episodes_finished": episodes_finished, "total_reward": total_reward}, wait=True)
+    finally:
+        stop_event.set()
+        # Unblocks any actor waiting to put a chunk on the full queue
+        while any(actor.is_alive() for actor in actors):
+            try:
+                transition_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for actor in actors:
+            actor.join()
+        weights.close(unlink=True)
+
+    agent.q_net.save(model_save_path)
+    print(f"Saved model to {model_save_path}")
+    return agent
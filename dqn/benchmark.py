@@ -0,0 +1,209 @@
+"""Benchmarks the hot paths of the environment, the replay buffer and the
+agent, for every combination of the given module and node counts. Results
+are written as JSON so that they can be compared between commits and used
+to plot how each path scales.
+
+Usage: python benchmark.py [--modules 15 100] [--nodes 5 20] [--output results.json]"""
+
+from environment.envs.application_placement_env import ApplicationPlacementEnv
+from replay_buffer import ReplayBuffer
+import environment
+import numpy as np
+import itertools
+import argparse
+import platform
+import subprocess
+import json
+import sys
+import time
+
+# The benchmarks that can be run, in the order they are run
+BENCHMARKS = ("env", "replay_buffer", "train", "policy")
+# The percentiles reported for latency measurements
+PERCENTILES = (50, 90, 99)
+
+def time_calls(function, number: int) -> np.ndarray:
+    """Calls function number times and returns the time each call took in
+    seconds."""
+    times = np.empty(number)
+    for i in range(number):
+        start = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - start
+    return times
+
+def latency(times: np.ndarray) -> dict:
+    """Summarizes per-call times as a mean, percentiles and a rate, in
+    microseconds and calls per second."""
+    return {
+        "mean_us": float(times.mean() * 1e6),
+        **{f"p{p}_us": float(v * 1e6) for p, v in zip(PERCENTILES, np.percentile(times, PERCENTILES))},
+        "per_second": float(len(times) / times.sum())
+    }
+
+def collect_transitions(num_modules: int, num_nodes: int, number: int, seed: int = 0):
+    """Steps the environment with random actions and returns number
+    transitions as (states, actions, rewards, next_states, dones) arrays, for
+    filling replay buffers with realistic data."""
+    env = ApplicationPlacementEnv(backend="arrays", num_modules=num_modules, num_nodes=num_nodes)
+    rng = np.random.default_rng(seed)
+    states = np.empty((number, env.observation_space.shape[0]))
+    next_states = np.empty_like(states)
+    actions = rng.integers(num_nodes, size=number)
+    rewards = np.empty(number)
+    dones = np.empty(number, dtype=bool)
+    state, _ = env.reset(seed=seed)
+    for i in range(number):
+        next_state, rewards[i], dones[i], _, _ = env.step(actions[i])
+        states[i] = state
+        next_states[i] = next_state
+        state = env.reset()[0] if dones[i] else next_state
+    return states, actions, rewards, next_states, dones
+
+def benchmark_env(num_modules: int, num_nodes: int, backend: str, number: int) -> list:
+    """Measures reset, step, _get_obs and get_state/set_state snapshots for
+    one backend. Steps use random actions, and the episode is reset (untimed)
+    whenever it terminates."""
+    env = ApplicationPlacementEnv(backend=backend, num_modules=num_modules, num_nodes=num_nodes)
+    env.reset(seed=0)
+    params = {"backend": backend}
+    results = [("env_reset", params, latency(time_calls(env.reset, max(1, number // num_modules))))]
+
+    actions = np.random.default_rng(0).integers(num_nodes, size=number)
+    times = np.empty(number)
+    for i in range(number):
+        start = time.perf_counter()
+        _, _, terminated, _, _ = env.step(actions[i])
+        times[i] = time.perf_counter() - start
+        if terminated:
+            env.reset()
+    results.append(("env_step", params, latency(times)))
+
+    env.reset()
+    results.append(("env_get_obs", params, latency(time_calls(env._get_obs, number))))
+    state = env.get_state()
+    results.append(("env_get_state", params, latency(time_calls(env.get_state, number))))
+    results.append(("env_set_state", params, latency(time_calls(lambda: env.set_state(state), number))))
+    return results
+
+def benchmark_replay_buffer(transitions, fills: list, storage: str, number: int, batch_size: int = 64) -> list:
+    """Measures store_experience, store_batch (of batch_size experiences) and
+    sample_batch once the buffer holds each of the given numbers of
+    experiences. Transitions are reused cyclically to reach larger fills."""
+    states, actions, rewards, next_states, dones = transitions
+    buffer = ReplayBuffer(states.shape[1], buffer_size=max(fills) + number, storage=storage)
+
+    def store(i):
+        i %= len(states)
+        buffer.store_experience(states[i], actions[i], rewards[i], next_states[i], dones[i])
+
+    results = []
+    stored = 0
+    for fill in sorted(fills):
+        while buffer.pointer < fill:
+            store(stored)
+            stored += 1
+        params = {"storage": storage, "fill": fill}
+        results.append(("replay_buffer_sample_batch", params, latency(time_calls(buffer.sample_batch, number))))
+        times = np.empty(number)
+        for i in range(number):
+            start = time.perf_counter()
+            store(stored)
+            times[i] = time.perf_counter() - start
+            stored += 1
+        results.append(("replay_buffer_store_experience", params, latency(times)))
+        rows = np.arange(batch_size) % len(states)
+        batch = (states[rows], actions[rows], rewards[rows], next_states[rows], dones[rows])
+        results.append(("replay_buffer_store_batch", {**params, "batch_size": batch_size},
+                        latency(time_calls(lambda: buffer.store_batch(*batch), number))))
+        stored += number * batch_size
+    return results
+
+def benchmark_train(transitions, num_nodes: int, number: int, warmup: int = 10) -> list:
+    """Measures DQNAgent.train on a buffer of the given transitions. The first
+    few steps trace the compiled train step and aren't timed."""
+    from dqn_agent import DQNAgent
+    states, actions, rewards, next_states, dones = transitions
+    agent = DQNAgent(observation_space=states.shape[1], action_space=num_nodes)
+    agent.store_batch(states, actions, rewards, next_states, dones)
+    for _ in range(warmup):
+        agent.train()
+    return [("dqn_train", {}, latency(time_calls(agent.train, number)))]
+
+def benchmark_policy(transitions, num_nodes: int, number: int) -> list:
+    """Measures the greedy decision latency of DQNAgent.policy, and of
+    NumpyPolicy with the same weights."""
+    from dqn_agent import DQNAgent
+    from numpy_dqn import NumpyDuelingDQN, NumpyPolicy, layer_weights
+    states = transitions[0]
+    agent = DQNAgent(observation_space=states.shape[1], action_space=num_nodes)
+    agent.epsilon = 0.0
+    numpy_policy = NumpyPolicy(NumpyDuelingDQN(layer_weights(agent.q_net)))
+    results = []
+    for name, policy in (("dqn_policy", agent.policy), ("numpy_policy", numpy_policy.policy)):
+        policy(states[0])
+        index = itertools.count()
+        times = time_calls(lambda: policy(states[next(index) % len(states)]), number)
+        results.append((name, {}, latency(times)))
+    return results
+
+def run_benchmarks(module_counts: list, node_counts: list, benchmarks=BENCHMARKS, fills=(1_000, 10_000, 100_000),
+                   storage="separate", number: int = 1_000) -> dict:
+    """Runs the chosen benchmarks for every combination of module and node
+    counts and returns the results along with details of the machine and
+    commit they were measured on."""
+    results = []
+    for num_modules, num_nodes in itertools.product(module_counts, node_counts):
+        # Progress goes to stderr so that stdout is only the JSON results
+        print(f"Benchmarking {num_modules} modules and {num_nodes} nodes", file=sys.stderr)
+        size = {"num_modules": num_modules, "num_nodes": num_nodes}
+        measurements = []
+        if "env" in benchmarks:
+            for backend in ("objects", "arrays"):
+                measurements += benchmark_env(num_modules, num_nodes, backend, number)
+        if any(name in benchmarks for name in ("replay_buffer", "train", "policy")):
+            transitions = collect_transitions(num_modules, num_nodes, min(max(fills), 10_000))
+            if "replay_buffer" in benchmarks:
+                measurements += benchmark_replay_buffer(transitions, fills, storage, number)
+            if "train" in benchmarks:
+                measurements += benchmark_train(transitions, num_nodes, number)
+            if "policy" in benchmarks:
+                measurements += benchmark_policy(transitions, num_nodes, number)
+        for name, params, values in measurements:
+            results.append({"benchmark": name, **size, **params, **values})
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.platform(),
+        "processor": platform.processor(),
+        "number": number,
+        "results": results
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the environment, replay buffer and agent.")
+    parser.add_argument("--modules", type=int, nargs="+", default=[15, 100], help="Module counts to benchmark")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[5, 20], help="Node counts to benchmark")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="Which benchmarks to run")
+    parser.add_argument("--fills", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Numbers of experiences in the replay buffer to benchmark it at")
+    parser.add_argument("--buffer-storage", choices=["separate", "compact"], default="separate",
+                        help="Storage of the benchmarked replay buffer")
+    parser.add_argument("--number", type=int, default=1_000, help="Number of timed calls per measurement")
+    parser.add_argument("--output", default=None, help="File to write the JSON results to")
+    args = parser.parse_args()
+    assert args.number > 0, "Need at least 1 timed call"
+
+    report = run_benchmarks(args.modules, args.nodes, args.benchmarks, args.fills, args.buffer_storage, args.number)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,219 @@
+"""Periodic checkpoints of the full training state, written in the background.
+
+A checkpoint holds everything needed to resume training exactly where it
+left off: both networks, the optimizer's state, epsilon, the train step, the
+replay buffer, the progress of the training loop and the random number
+generators of NumPy and the environment.
+
+Taking a checkpoint only copies that state in memory on the training
+thread. Writing it to disk happens on a background thread, so the training
+loop never waits on disk I/O. A memory-mapped replay buffer (see
+ReplayBuffer's storage path) isn't copied into memory: its files are
+flushed on the training thread and copied by the background thread. If a
+checkpoint is due while the previous one is still being written, it is
+skipped rather than waited for.
+
+Checkpoints are written to a temporary directory which then replaces the
+previous checkpoint, so an interrupted write never leaves a partial
+checkpoint behind. The layout of a checkpoint directory is:
+
+    agent.npz       Network weights and optimizer variables
+    state.json      Epsilon, the train step, progress and RNG states
+    replay_buffer/  The replay buffer (see ReplayBuffer.save)
+
+This module is imported by train.py, which actor processes re-import, so it
+must not import TensorFlow."""
+
+from replay_buffer import ReplayBuffer
+from environment.profiling import PROFILER
+import numpy as np
+import threading
+import shutil
+import json
+import os
+
+# The agent state saved as lists of arrays in agent.npz
+WEIGHT_LISTS = ("q_net", "target_net", "optimizer")
+
+SNAPSHOT_TIMER = PROFILER.timer("checkpoint.snapshot")
+WRITE_TIMER = PROFILER.timer("checkpoint.write")
+
+def snapshot_training(agent, progress: dict, env_rng=None) -> dict:
+    """Copies the training state of an agent (including its replay buffer),
+    the loop's progress, NumPy's global RNG and optionally an environment's
+    RNG, so it can be written while training continues."""
+    algorithm, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "agent": agent.get_training_state(),
+        "replay_buffer": agent.replay_buffer.snapshot(),
+        "progress": dict(progress),
+        "np_random": {
+            "algorithm": algorithm,
+            "keys": keys.copy(),
+            "position": position,
+            "has_gauss": has_gauss,
+            "cached_gaussian": cached_gaussian
+        },
+        "env_rng": env_rng.bit_generator.state if env_rng is not None else None
+    }
+
+def write_checkpoint(path: str, snapshot: dict):
+    """Writes a snapshot taken with snapshot_training to a checkpoint
+    directory, replacing any checkpoint already there."""
+    path = os.path.normpath(path)
+    temporary_path = path + ".tmp"
+    previous_path = path + ".old"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    agent_state = snapshot["agent"]
+    arrays = {
+        f"{name}_{i}": array for name in WEIGHT_LISTS for i, array in enumerate(agent_state[name])
+    }
+    arrays["np_random_keys"] = snapshot["np_random"]["keys"]
+    np.savez(os.path.join(temporary_path, "agent.npz"), **arrays)
+    state = {
+        "epsilon": agent_state["epsilon"],
+        "trainstep": agent_state["trainstep"],
+        "num_weights": {name: len(agent_state[name]) for name in WEIGHT_LISTS},
+        "progress": snapshot["progress"],
+        "np_random": {key: value for key, value in snapshot["np_random"].items() if key != "keys"},
+        "env_rng": snapshot["env_rng"]
+    }
+    with open(os.path.join(temporary_path, "state.json"), "w") as f:
+        json.dump(state, f)
+    ReplayBuffer.write_snapshot(os.path.join(temporary_path, "replay_buffer"), *snapshot["replay_buffer"])
+
+    # The previous checkpoint is only removed once the new one is complete
+    shutil.rmtree(previous_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, previous_path)
+    os.replace(temporary_path, path)
+    shutil.rmtree(previous_path, ignore_errors=True)
+
+def load_checkpoint(path: str, agent, env_rng=None) -> dict:
+    """Restores a checkpoint into an agent built with the same networks (and
+    its replay buffer), NumPy's global RNG and optionally an environment's
+    RNG. Returns the progress of the training loop when it was taken."""
+    path = os.path.normpath(path)
+    if not os.path.exists(path) and os.path.exists(path + ".old"):
+        # Writing was interrupted after the previous checkpoint was moved
+        path = path + ".old"
+    with open(os.path.join(path, "state.json")) as f:
+        state = json.load(f)
+    with np.load(os.path.join(path, "agent.npz")) as arrays:
+        agent_state = {
+            name: [arrays[f"{name}_{i}"] for i in range(state["num_weights"][name])] for name in WEIGHT_LISTS
+        }
+        np_random = state["np_random"]
+        np.random.set_state((np_random["algorithm"], arrays["np_random_keys"], np_random["position"],
+                             np_random["has_gauss"], np_random["cached_gaussian"]))
+    agent_state["epsilon"] = state["epsilon"]
+    agent_state["trainstep"] = state["trainstep"]
+    agent.set_training_state(agent_state)
+
+    buffer = agent.replay_buffer
+    if buffer.storage_path is not None:
+        # A memory-mapped buffer stays where it was configured, with the
+        # checkpoint's contents copied into it straight from its files
+        loaded = ReplayBuffer.load(os.path.join(path, "replay_buffer"), mmap_mode="r")
+        assert loaded.n_step == buffer.n_step, "Checkpoint's replay buffer uses different n-step returns"
+        loaded_arrays = loaded._arrays()
+        for name, array in buffer._arrays().items():
+            assert array.shape == loaded_arrays[name].shape, "Checkpoint's replay buffer doesn't match the configured one"
+            array[...] = loaded_arrays[name]
+        buffer.beta = loaded.beta
+        buffer.pointer = loaded.pointer
+        buffer.last_done = loaded.last_done
+        buffer.max_priority = loaded.max_priority
+        for array in buffer._arrays().values():
+            array.flush()
+    else:
+        agent.replay_buffer = ReplayBuffer.load(os.path.join(path, "replay_buffer"), mmap_mode=None)
+
+    if env_rng is not None and state["env_rng"] is not None:
+        env_rng.bit_generator.state = state["env_rng"]
+    return state["progress"]
+
+class Checkpointer:
+    """Takes a checkpoint of the training state every interval train steps
+    and writes it to path on a background thread."""
+    def __init__(self, path: str, interval: int):
+        assert interval > 0, "Checkpoint interval must be at least 1 train step"
+        self.path = path
+        self.interval = interval
+        # The train step of the last checkpoint, set by the first call to
+        # maybe_save so that a resumed run counts from where it resumed
+        self.last_trainstep = None
+        self.checkpoints_written = 0
+        self.checkpoints_skipped = 0
+        # The snapshot waiting to be written, handed over under the condition
+        self.pending = None
+        self.writing = False
+        self.stopping = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="Checkpointer", daemon=True)
+        self.thread.start()
+
+    def due(self, agent) -> bool:
+        if self.last_trainstep is None:
+            self.last_trainstep = agent.trainstep
+        return agent.trainstep - self.last_trainstep >= self.interval
+
+    def maybe_save(self, agent, progress: dict, env_rng=None):
+        """Takes a checkpoint if one is due and the previous one has been
+        written."""
+        if self.due(agent):
+            self.save(agent, progress, env_rng)
+
+    def save(self, agent, progress: dict, env_rng=None, wait: bool = False):
+        """Snapshots the training state and hands it to the writer thread. The
+        checkpoint is skipped if the previous one is still being written,
+        unless wait is set (e.g. for a final checkpoint)."""
+        if self.error is not None:
+            raise self.error
+        with self.condition:
+            if wait:
+                while self.writing or self.pending is not None:
+                    self.condition.wait()
+            elif self.writing or self.pending is not None:
+                self.checkpoints_skipped += 1
+                PROFILER.count("checkpoint.skipped")
+                return
+        with SNAPSHOT_TIMER:
+            snapshot = snapshot_training(agent, progress, env_rng)
+        self.last_trainstep = agent.trainstep
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                snapshot = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                with WRITE_TIMER:
+                    write_checkpoint(self.path, snapshot)
+                self.checkpoints_written += 1
+            except Exception as error:
+                # Raised on the training thread by the next save
+                self.error = error
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def close(self):
+        """Finishes writing any pending checkpoint and stops the thread."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
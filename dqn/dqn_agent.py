@@ -1,13 +1,23 @@
-from dueling_dqn import DuelingDQN
+from dueling_dqn import DuelingDQN, NodeEncoderDQN, MASKED_Q_VALUE
 from replay_buffer import ReplayBuffer
+from environment.envs.application_placement_env import PADDED_ROW_SIZE, OBSERVATION_SPACE, ACTION_SPACE, padded_node_mask
+from environment.profiling import PROFILER
 import numpy as np
+import tensorflow as tf
 import keras
 
-OBSERVATION_SPACE = 12
-ACTION_SPACE = 5
+# Timers for the phases of choosing actions and training (see
+# environment.profiling)
+POLICY_TIMER = PROFILER.timer("agent.policy_forward")
+SAMPLE_TIMER = PROFILER.timer("agent.sample")
+TRAIN_STEP_TIMER = PROFILER.timer("agent.train_step")
+PRIORITIES_TIMER = PROFILER.timer("agent.update_priorities")
+TARGET_TIMER = PROFILER.timer("agent.update_target")
 
 class DQNAgent:
-    def __init__(self, dqn=None, gamma=0.99, update_frequency=100, lr=0.001):
+    def __init__(self, dqn=None, gamma=0.99, update_frequency=100, lr=0.001, priority="reward",
+                 replay_buffer=None, observation_space=OBSERVATION_SPACE, action_space=ACTION_SPACE,
+                 max_nodes=None, n_step=1):
         # High gamma ensures the agent prefers long-term rewards over short
         # term rewards
         self.gamma = gamma
@@ -18,38 +28,106 @@ class DQNAgent:
 
         # How often the target network should be updated
         self.update_frequency = update_frequency
+        # With max_nodes set, the agent acts on padded observations of up to
+        # max_nodes nodes (see ApplicationPlacementEnv) with a NodeEncoderDQN,
+        # and only explores real nodes. A loaded NodeEncoderDQN does the same.
+        self.padded = max_nodes is not None or getattr(dqn, "per_node", False)
+        if max_nodes is not None:
+            observation_space = PADDED_ROW_SIZE * (max_nodes + 1)
+            action_space = max_nodes
+        # The size of the observations and the number of actions (nodes)
+        self.observation_space = observation_space
+        self.action_space = action_space
         # Keeps count of the number of times the agent has been trained
         self.trainstep = 0
 
-        self.replay_buffer = ReplayBuffer(OBSERVATION_SPACE)
+        # Experiences are prioritized by the magnitude of either their reward
+        # or their TD error (see ReplayBuffer). A buffer configured with other
+        # storage options (e.g. compact or memory-mapped) can be passed in.
+        # With n_step above 1, the buffer stores n-step returns.
+        if replay_buffer is not None:
+            self.replay_buffer = replay_buffer
+        elif priority == "td":
+            self.replay_buffer = ReplayBuffer(observation_space, priority="td", alpha=0.6, action_mask_size=action_space,
+                                              n_step=n_step, gamma=gamma)
+        else:
+            self.replay_buffer = ReplayBuffer(observation_space, action_mask_size=action_space, n_step=n_step, gamma=gamma)
+        assert self.replay_buffer.n_step == 1 or self.replay_buffer.gamma == gamma, \
+            "The replay buffer's n-step returns must be discounted by the agent's gamma"
         self.batch_size = 64
 
         if dqn is None:
-            self.q_net = DuelingDQN()
-            self.target_net = DuelingDQN()
+            if self.padded:
+                self.q_net = NodeEncoderDQN()
+                self.target_net = NodeEncoderDQN()
+            else:
+                self.q_net = DuelingDQN(action_space)
+                self.target_net = DuelingDQN(action_space)
             opt = keras.optimizers.Adam(learning_rate=lr)
             self.q_net.compile(loss='mse', optimizer=opt) # type: ignore
             self.target_net.compile(loss='mse', optimizer=opt) # type: ignore
+            # The networks and optimizer are built up front so that the compiled
+            # train step doesn't create any variables while it is traced
+            self.q_net(np.zeros((1, observation_space), dtype=np.float32))
+            self.target_net(np.zeros((1, observation_space), dtype=np.float32))
+            opt.build(self.q_net.trainable_variables)
         else:
             self.q_net = dqn
 
-    def policy(self, state) -> int:
+    def policy(self, state, mask=None) -> int:
         """Epsilon-Greedy policy. Has a chance based on epsilon to return a
         random action, otherwise returns the best possible action (based on
-        the DQN)"""
+        the DQN). If an action mask is given (see the environment's info),
+        only allowed actions are chosen."""
+        if mask is None and self.padded:
+            mask = padded_node_mask(state)
         # Exploration - Generates a random action if the random number is less
         # than epsilon
         if np.random.rand() <= self.epsilon:
-            return np.random.choice([i for i in range(ACTION_SPACE)])
+            if mask is not None:
+                return int(np.random.choice(np.flatnonzero(mask)))
+            return np.random.choice([i for i in range(self.action_space)])
         # Exploitation - Uses the DQN to determine the best action
         else:
-            actions = self.q_net.advantage(np.array([state]))
+            with POLICY_TIMER:
+                actions = np.asarray(self.q_net.advantage(np.array([state])))[0]
+            if mask is not None:
+                actions = np.where(mask, actions, MASKED_Q_VALUE)
             action = np.argmax(actions)
             return int(action)
-        
-    def store_experience(self, state, action, reward, next_state, done):
-        """Takes an experience and stores it in the replay buffer."""
-        self.replay_buffer.store_experience(state, action, reward, next_state, done)
+
+    def policy_batch(self, states, masks=None) -> np.ndarray:
+        """Epsilon-Greedy policy for a batch of states (e.g. from a vector
+        environment). Makes a single call to the DQN for the whole batch."""
+        states = np.asarray(states)
+        if masks is None and self.padded:
+            masks = padded_node_mask(states)
+        # Each state independently has a chance based on epsilon of being given
+        # a random action
+        explore = np.random.rand(len(states)) <= self.epsilon
+        if masks is not None:
+            # A random allowed action, as disallowed actions get no random key
+            actions = np.argmax(np.random.rand(*masks.shape) * masks, axis=1)
+        else:
+            actions = np.random.randint(self.action_space, size=len(states))
+        if not explore.all():
+            with POLICY_TIMER:
+                advantages = np.asarray(self.q_net.advantage(states))
+            if masks is not None:
+                advantages = np.where(masks, advantages, MASKED_Q_VALUE)
+            actions = np.where(explore, actions, np.argmax(advantages, axis=1))
+        return actions
+
+    def store_experience(self, state, action, reward, next_state, done, next_mask=None, stream=0):
+        """Takes an experience, and the action mask of its next state, and
+        stores it in the replay buffer. Experiences from interleaved episodes
+        (e.g. of a vector environment) are given different streams."""
+        self.replay_buffer.store_experience(state, action, reward, next_state, done, next_mask, stream)
+
+    def store_batch(self, states, actions, rewards, next_states, dones, next_masks=None, streams=None):
+        """Stores a batch of experiences in the replay buffer at once (see
+        ReplayBuffer.store_batch)."""
+        self.replay_buffer.store_batch(states, actions, rewards, next_states, dones, next_masks, streams)
 
     def update_target_network(self):
         """Updates the target network with the weights from the main network"""
@@ -64,29 +142,124 @@ class DQNAgent:
             self.epsilon = self.min_epsilon
         return self.epsilon
 
+    def get_training_state(self) -> dict:
+        """Returns copies of everything training changes besides the replay
+        buffer: both networks' weights, the optimizer's variables (its step
+        count and moment estimates), epsilon and the train step."""
+        return {
+            "q_net": self.q_net.get_weights(),
+            "target_net": self.target_net.get_weights(),
+            "optimizer": [np.array(variable) for variable in self.q_net.optimizer.variables],
+            "epsilon": self.epsilon,
+            "trainstep": self.trainstep
+        }
+
+    def set_training_state(self, state: dict):
+        """Restores a state returned by get_training_state into an agent built
+        with the same networks."""
+        self.q_net.set_weights(state["q_net"])
+        self.target_net.set_weights(state["target_net"])
+        variables = self.q_net.optimizer.variables
+        assert len(variables) == len(state["optimizer"]), "Optimizer state doesn't match the agent's networks"
+        for variable, value in zip(variables, state["optimizer"]):
+            variable.assign(value)
+        self.epsilon = state["epsilon"]
+        self.trainstep = state["trainstep"]
+
     def train(self):
         """Uses sampled experiences from the replay buffer to train the main
         network"""
         # If there aren't enough experiences in the buffer yet, skip the
         # training
         if self.replay_buffer.pointer < self.batch_size:
+            PROFILER.count("agent.train_skipped")
             return
 
         # Updates the target netowrk every self.update_frequency steps
         if self.trainstep % self.update_frequency == 0:
-            self.update_target_network()
+            with TARGET_TIMER:
+                self.update_target_network()
 
         # Samples a batch of experiences from the replay buffer and splits them
-        states, actions, rewards, next_states, dones = self.replay_buffer.sample_batch(self.batch_size)
+        with SAMPLE_TIMER:
+            states, actions, rewards, next_states, dones, indices, weights = self.replay_buffer.sample_prioritized(self.batch_size)
+            next_masks = None
+            if self.replay_buffer.action_mask_size is not None:
+                next_masks = self.replay_buffer.next_mask_memory[indices]
 
-        target = self.q_net.predict(states)
-        next_state_val = self.target_net.predict(next_states)
-        max_action = np.argmax(self.q_net.predict(next_states), axis=1)
+        # n-step experiences bootstrap from the state n steps later
+        discount = self.gamma ** self.replay_buffer.n_step
+        if self.replay_buffer.priority == "td":
+            # Importance-sampling weights correct for the bias of sampling by
+            # TD error, and the new TD errors become the experiences' priorities
+            with TRAIN_STEP_TIMER:
+                td_errors = self.train_on_experiences(states, actions, rewards, next_states, dones, weights, next_masks,
+                                                      discount)
+            with PRIORITIES_TIMER:
+                self.replay_buffer.update_priorities(indices, td_errors)
+        else:
+            with TRAIN_STEP_TIMER:
+                self.train_on_experiences(states, actions, rewards, next_states, dones, next_masks=next_masks,
+                                          discount=discount)
+        self.decay_epsilon()
+        self.trainstep += 1
+
+    def train_on_batch(self, states, actions, rewards, next_states, dones, next_masks=None) -> np.ndarray:
+        """Trains the main network on a batch of experiences from outside the
+        replay buffer (e.g. a recorded trace), updating the target network on
+        the same schedule as train. Returns the experiences' TD errors."""
+        if self.trainstep % self.update_frequency == 0:
+            with TARGET_TIMER:
+                self.update_target_network()
+        with TRAIN_STEP_TIMER:
+            td_errors = self.train_on_experiences(states, actions, rewards, next_states, dones, next_masks=next_masks)
+        self.trainstep += 1
+        return td_errors
 
-        batch_index = np.arange(self.batch_size, dtype=np.int32)
-        q_target = np.copy(target)
-        q_target[batch_index, actions] = rewards + self.gamma * next_state_val[batch_index, max_action]*dones
+    def train_on_experiences(self, states, actions, rewards, next_states, dones, weights=None,
+                             next_masks=None, discount=None) -> np.ndarray:
+        """Performs one gradient update of the main network on a batch of
+        experiences and returns their TD errors. Dones are 0 for experiences
+        that ended an episode and 1 otherwise (as stored in the buffer). The
+        best next action is only chosen from those allowed by next_masks.
+        The next state's value is discounted by gamma unless another discount
+        is given (e.g. for n-step returns)."""
+        if discount is None:
+            discount = self.gamma
+        if weights is None:
+            weights = np.ones(len(states), dtype=np.float32)
+        if next_masks is None:
+            next_masks = np.ones((len(states), self.action_space), dtype=bool)
+        td_errors = self._train_step(
+            tf.convert_to_tensor(states, dtype=tf.float32),
+            tf.convert_to_tensor(actions, dtype=tf.int32),
+            tf.convert_to_tensor(rewards, dtype=tf.float32),
+            tf.convert_to_tensor(next_states, dtype=tf.float32),
+            tf.convert_to_tensor(dones, dtype=tf.float32),
+            tf.convert_to_tensor(weights, dtype=tf.float32),
+            tf.convert_to_tensor(next_masks, dtype=tf.bool),
+            tf.constant(discount, dtype=tf.float32)
+        )
+        return td_errors.numpy()
 
-        self.q_net.train_on_batch(states, q_target)
-        self.decay_epsilon()
-        self.trainstep += 1
\ No newline at end of file
+    @tf.function
+    def _train_step(self, states, actions, rewards, next_states, dones, weights, next_masks, discount):
+        """Computes the Double DQN target, the loss and the gradient update in
+        a single compiled graph, rather than with separate predict calls."""
+        # Double DQN: the main network chooses the best next action and the
+        # target network evaluates it. Only allowed actions can be chosen.
+        next_q_values = tf.where(next_masks, self.q_net(next_states), MASKED_Q_VALUE)
+        max_action = tf.argmax(next_q_values, axis=1, output_type=tf.int32)
+        next_state_val = tf.gather(self.target_net(next_states), max_action, batch_dims=1)
+        q_target = rewards + discount * next_state_val * dones
+
+        with tf.GradientTape() as tape:
+            q_values = self.q_net(states, training=True)
+            td_errors = q_target - tf.gather(q_values, actions, batch_dims=1)
+            # Matches the mean squared error over every action that was used
+            # before, where only the taken action's target differed from the
+            # prediction, so the learning rate keeps the same meaning
+            loss = tf.reduce_mean(weights * tf.square(td_errors)) / tf.cast(tf.shape(q_values)[1], tf.float32)
+        gradients = tape.gradient(loss, self.q_net.trainable_variables)
+        self.q_net.optimizer.apply_gradients(zip(gradients, self.q_net.trainable_variables))
+        return td_errors
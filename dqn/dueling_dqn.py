@@ -1,20 +1,26 @@
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
+from environment.envs.application_placement_env import PADDED_ROW_SIZE
 import tensorflow as tf
 import keras
 
 NUM_INPUT = 12
 NUM_OUTPUT = 5
 
+# Registering the class allows saved models to be loaded with
+# keras.models.load_model
+@keras.saving.register_keras_serializable()
 class DuelingDQN(keras.Model):
-    """Inherits from a Tensorflow model. Implements a Dueling DQN structure."""
-    def __init__(self, *args, **kwargs):
+    """Inherits from a Tensorflow model. Implements a Dueling DQN structure.
+    The input size is set by the first batch of states it is called on."""
+    def __init__(self, num_actions=NUM_OUTPUT, *args, **kwargs):
         super(DuelingDQN, self).__init__(*args, **kwargs)
+        self.num_actions = num_actions
         self.d1 = keras.layers.Dense(128, activation='relu')
         self.d2 = keras.layers.Dense(128, activation='relu')
         self.v = keras.layers.Dense(1, activation=None)
-        self.a = keras.layers.Dense(NUM_OUTPUT, activation=None)
+        self.a = keras.layers.Dense(num_actions, activation=None)
     
     def call(self, input_data):
         x = self.d1(input_data)
@@ -22,9 +28,59 @@ class DuelingDQN(keras.Model):
         v = self.v(x)
         a = self.a(x)
         return v + (a - tf.math.reduce_mean(a, axis=1, keepdims=True))
+
+    def get_config(self):
+        # Saved so that models with other numbers of actions can be loaded
+        config = super(DuelingDQN, self).get_config()
+        config["num_actions"] = self.num_actions
+        return config
     
     def advantage(self, state):
         x = self.d1(state)
         x = self.d2(x)
         a = self.a(x)
-        return a
\ No newline at end of file
+        return a
+
+
+# The Q-value given to padding nodes so that they are never chosen
+MASKED_Q_VALUE = -1e9
+
+@keras.saving.register_keras_serializable()
+class NodeEncoderDQN(keras.Model):
+    """A Dueling DQN for padded observations with any number of nodes. Each
+    node's features are encoded together with the module's by the same shared
+    layers, so the cost grows linearly with the number of nodes and one model
+    serves every topology size. Each node's advantage comes from its own
+    encoding and the value from the mean encoding of the real nodes. Padding
+    nodes are given a Q-value of MASKED_Q_VALUE."""
+    # Read by numpy_dqn, which can't check the class without TensorFlow
+    per_node = True
+
+    def __init__(self, *args, **kwargs):
+        super(NodeEncoderDQN, self).__init__(*args, **kwargs)
+        self.d1 = keras.layers.Dense(128, activation='relu')
+        self.d2 = keras.layers.Dense(128, activation='relu')
+        self.v = keras.layers.Dense(1, activation=None)
+        self.a = keras.layers.Dense(1, activation=None)
+
+    def encode(self, input_data):
+        """Returns the encoding of every node, with shape (batch size, nodes,
+        128), and whether each node is real."""
+        rows = tf.reshape(input_data, (tf.shape(input_data)[0], -1, PADDED_ROW_SIZE))
+        nodes = rows[:, 1:, :2]
+        module = tf.broadcast_to(rows[:, :1, :2], tf.shape(nodes))
+        x = self.d1(tf.concat([nodes, module], axis=2))
+        return self.d2(x), rows[:, 1:, 2]
+
+    def call(self, input_data):
+        x, mask = self.encode(input_data)
+        count = tf.maximum(tf.reduce_sum(mask, axis=1, keepdims=True), 1.0)
+        v = self.v(tf.reduce_sum(x * mask[:, :, None], axis=1) / count)
+        a = tf.squeeze(self.a(x), axis=2)
+        q = v + (a - tf.reduce_sum(a * mask, axis=1, keepdims=True) / count)
+        return tf.where(mask > 0, q, MASKED_Q_VALUE)
+
+    def advantage(self, state):
+        x, mask = self.encode(state)
+        a = tf.squeeze(self.a(x), axis=2)
+        return tf.where(mask > 0, a, MASKED_Q_VALUE)
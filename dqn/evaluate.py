@@ -1,40 +1,226 @@
-import asyncio
-from environment.envs.application_placement_env import ApplicationPlacementEnv
+from environment.envs.application_placement_env import (ApplicationPlacementEnv, OBSERVATION_SPACE, ACTION_SPACE,
+                                                        PADDED_ROW_SIZE)
+from environment.envs.vector_application_placement_env import VectorApplicationPlacementEnv
 import environment
-from dqn_agent import DQNAgent
-import sys
-import keras
+from numpy_dqn import NumpyDuelingDQN, NumpyPolicy
+from traces import TraceWriter
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+import multiprocessing as mp
+import numpy as np
+import argparse
+import json
+import time
 
-async def evaluate_training_result(agent: DQNAgent, rendering:bool, num_episodes: int) -> float:
+# TensorFlow is only imported when evaluating a Keras model, so evaluating
+# exported .npz weights starts quickly
+if TYPE_CHECKING:
+    from dqn_agent import DQNAgent
+
+def evaluate_training_result(agent: "DQNAgent | NumpyPolicy", rendering:bool, num_episodes: int, real_time: bool = False,
+                             max_nodes: int | None = None, record_path: str | None = None, frame_skip: int = 0,
+                             network_model: bool = False, trace_writer: TraceWriter | None = None) -> float:
     reward_total = 0.0
     if rendering:
-        env = ApplicationPlacementEnv(render_mode="human")
+        env = ApplicationPlacementEnv(render_mode="human", real_time=real_time, max_nodes=max_nodes,
+                                      record_path=record_path, frame_skip=frame_skip, network_model=network_model)
     else:
-        env = ApplicationPlacementEnv()
+        env = ApplicationPlacementEnv(real_time=real_time, max_nodes=max_nodes,
+                                      record_path=record_path, frame_skip=frame_skip, network_model=network_model)
 
     for i in range(num_episodes):
-        state, _ = env.reset()
+        state, info = env.reset()
         done = False
         episode_reward = 0.0
         while not done:
-            action = agent.policy(state)
-            next_state, reward, done, _, _ = await env.step(action)
+            action = agent.policy(state, info["action_mask"])
+            next_state, reward, done, _, info = env.step(action)
             episode_reward += reward
-            state = next_state
+            if next_state is not None:
+                if trace_writer is not None:
+                    trace_writer.append(state, action, reward, next_state, done, info["action_mask"])
+                state = next_state
         reward_total += episode_reward
+    # Waits for the render thread to finish drawing any recorded frames
+    env.close()
     avg_reward = reward_total / num_episodes
     return avg_reward
 
+def evaluate_vector(agent: "DQNAgent | NumpyPolicy", num_envs: int, num_episodes: int,
+                    trace_writer: TraceWriter | None = None) -> float:
+    """Evaluates the agent on a vector environment, choosing the actions for
+    every sub-environment with a single call to the DQN."""
+    envs = VectorApplicationPlacementEnv(num_envs)
+    reward_total = 0.0
+    episodes_finished = 0
+    episode_rewards = [0.0] * num_envs
+    states, infos = envs.reset()
+    while episodes_finished < num_episodes:
+        actions = agent.policy_batch(states, infos["action_mask"])
+        next_states, rewards, dones, _, infos = envs.step(actions)
+        for i in range(num_envs):
+            if trace_writer is not None:
+                trace_writer.append(states[i], actions[i], rewards[i], infos["final_states"][i], dones[i],
+                                    infos["action_mask"][i])
+            episode_rewards[i] += rewards[i]
+            if dones[i]:
+                # Episodes that finish after the requested number has been
+                # reached are not counted
+                if episodes_finished < num_episodes:
+                    reward_total += episode_rewards[i]
+                    episodes_finished += 1
+                episode_rewards[i] = 0.0
+        states = next_states
+    return reward_total / num_episodes
+
+# The statistics recorded for every episode by the evaluation harness
+EPISODE_STATISTICS = ("reward", "makespan", "memory_violations", "decisions_per_second")
+# The percentiles reported for each statistic
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+
+def load_policy(model_path: str):
+    """Loads a greedy policy from exported .npz weights or a Keras model."""
+    if model_path.endswith(".npz"):
+        return NumpyPolicy(NumpyDuelingDQN.load(model_path))
+    import keras
+    from dqn_agent import DQNAgent
+    agent = DQNAgent(keras.models.load_model(model_path))
+    # Evaluation is greedy, rather than exploring with the initial epsilon
+    agent.epsilon = 0.0
+    return agent
+
+def run_episode(agent, env: ApplicationPlacementEnv, seed: int) -> dict:
+    """Runs one episode on the scenario generated from the given seed and
+    returns its statistics."""
+    state, info = env.reset(seed=seed)
+    done = False
+    episode_reward = 0.0
+    decisions = 0
+    start_time = time.perf_counter()
+    while not done:
+        action = agent.policy(state, info["action_mask"])
+        state, reward, done, _, info = env.step(action)
+        episode_reward += reward
+        decisions += 1
+    elapsed = time.perf_counter() - start_time
+    return {
+        "reward": episode_reward,
+        # The simulated time at which the last module finished
+        "makespan": info["time"],
+        "memory_violations": info["memory_violations"],
+        "decisions_per_second": decisions / elapsed
+    }
+
+# The policy and environment of each evaluation worker process
+_worker_agent = None
+_worker_env = None
+
+def _init_worker(model_path: str, max_nodes: int | None, network_model: bool):
+    global _worker_agent, _worker_env
+    _worker_agent = load_policy(model_path)
+    _worker_env = ApplicationPlacementEnv(max_nodes=max_nodes, network_model=network_model)
+
+def _run_episodes(seeds) -> list:
+    return [run_episode(_worker_agent, _worker_env, seed) for seed in seeds]
+
+def summarize(episodes: list, statistics=EPISODE_STATISTICS) -> dict:
+    """Aggregates per-episode statistics into their mean, standard deviation,
+    minimum, maximum and percentiles."""
+    summary = {"num_episodes": len(episodes)}
+    for statistic in statistics:
+        values = np.array([episode[statistic] for episode in episodes], dtype=np.float64)
+        summary[statistic] = {
+            "mean": float(values.mean()),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            **{f"p{p}": float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+        }
+    return summary
+
+def evaluate_parallel(model_path: str, num_episodes: int, num_workers: int, seed: int = 0,
+                      chunk_size: int = 100, max_nodes: int | None = None, network_model: bool = False) -> dict:
+    """Evaluates a policy on num_episodes scenarios across a pool of worker
+    processes. Episode i uses the scenario generated from seed + i, so results
+    are reproducible regardless of the number of workers."""
+    seeds = list(range(seed, seed + num_episodes))
+    chunks = [seeds[i:i + chunk_size] for i in range(0, num_episodes, chunk_size)]
+    start_time = time.perf_counter()
+    # Workers are spawned so that they don't inherit any TensorFlow state
+    with ProcessPoolExecutor(num_workers, mp.get_context("spawn"), _init_worker, (model_path, max_nodes, network_model)) as pool:
+        episodes = [episode for chunk in pool.map(_run_episodes, chunks) for episode in chunk]
+    summary = summarize(episodes)
+    summary["seed"] = seed
+    summary["wall_time"] = time.perf_counter() - start_time
+    return summary
+
 if __name__ == "__main__":
-    if len(sys.argv) == 4:
-        render = sys.argv[2]
-        assert render == "h" or render == "n", "Render mode must be 'h' (human) or 'n' (none)"
-        render = True if render == "h" else False
-        num_episodes = int(sys.argv[3])
-        assert num_episodes > 0, "Need at least 1 episode"
-
-        dqn = keras.models.load_model(sys.argv[1])
-        agent = DQNAgent(dqn)
-        asyncio.run(evaluate_training_result(agent, render, num_episodes))
+    parser = argparse.ArgumentParser(description="Evaluates a trained DQN model.")
+    parser.add_argument("model_path", help="Path of the trained model, or of weights exported to .npz")
+    parser.add_argument("render", choices=["h", "n"], help="Render mode: 'h' (human) or 'n' (none)")
+    parser.add_argument("num_episodes", type=int, help="Number of episodes to evaluate")
+    parser.add_argument("--real-time", action="store_true",
+                        help="Process modules in real time instead of on a virtual clock")
+    parser.add_argument("--num-envs", type=int, default=1,
+                        help="Number of environments stepped together in a vector environment")
+    parser.add_argument("--num-workers", type=int, default=0,
+                        help="Evaluate across this many processes and report statistics as JSON")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first scenario evaluated by the workers")
+    parser.add_argument("--output", default=None, help="File to write the JSON statistics to")
+    parser.add_argument("--record", default=None,
+                        help="Stream rendered frames to this frame file (see environment.renderer)")
+    parser.add_argument("--frame-skip", type=int, default=0,
+                        help="Number of steps skipped between rendered or recorded frames")
+    parser.add_argument("--max-nodes", type=int, default=None,
+                        help="Evaluate on topologies of varying size, with observations padded to this many nodes")
+    parser.add_argument("--network-model", action="store_true",
+                        help="Include the transfer time of module input data over a SAGIN link model")
+    parser.add_argument("--trace", default=None,
+                        help="Directory to record every transition to as a trace for offline training (see traces.py)")
+    args = parser.parse_args()
+    assert args.num_episodes > 0, "Need at least 1 episode"
+    assert args.num_envs > 0, "Need at least 1 environment"
+    assert args.num_envs == 1 or not (args.render == "h" or args.real_time), \
+        "Vector environments only support the virtual clock without rendering"
+
+    assert args.num_workers == 0 or not (args.render == "h" or args.real_time), \
+        "Evaluation workers only support the virtual clock without rendering"
+
+    assert args.max_nodes is None or (args.num_envs == 1 and not args.real_time), \
+        "Varying topology sizes are only supported by a single environment on the virtual clock"
+
+    assert args.record is None or (args.num_envs == 1 and args.num_workers == 0), \
+        "Frames can only be recorded from a single environment"
+
+    assert not args.network_model or (args.num_envs == 1 and not args.real_time), \
+        "The network model is only supported by single environments on the virtual clock"
+
+    assert args.trace is None or args.num_workers == 0, "Traces can't be recorded from evaluation workers"
+
+    if args.num_workers > 0:
+        summary = evaluate_parallel(args.model_path, args.num_episodes, args.num_workers, args.seed,
+                                    max_nodes=args.max_nodes, network_model=args.network_model)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=2)
+        print(json.dumps(summary, indent=2))
+        raise SystemExit
+
+    trace_writer = None
+    if args.trace is not None:
+        if args.max_nodes is None:
+            trace_writer = TraceWriter(args.trace, OBSERVATION_SPACE, ACTION_SPACE)
+        else:
+            trace_writer = TraceWriter(args.trace, PADDED_ROW_SIZE * (args.max_nodes + 1), args.max_nodes,
+                                       max_nodes=args.max_nodes)
+    agent = load_policy(args.model_path)
+    if args.num_envs > 1:
+        avg_reward = evaluate_vector(agent, args.num_envs, args.num_episodes, trace_writer)
     else:
-        print("Please provide arguments: <Model path> <Render mode> <# Episodes>")
\ No newline at end of file
+        avg_reward = evaluate_training_result(agent, args.render == "h", args.num_episodes, args.real_time,
+                                              args.max_nodes, args.record, args.frame_skip, args.network_model,
+                                              trace_writer)
+    print(f"Average reward over {args.num_episodes} episodes is {avg_reward}")
+    if trace_writer is not None:
+        trace_writer.close()
+        print(f"Recorded {trace_writer.transitions_written} transitions to {args.trace}")
@@ -0,0 +1,132 @@
+"""Heuristic placement policies, used as baselines and to pre-fill the replay
+buffer with demonstrations.
+
+Each heuristic chooses a node for the next module of every sub-environment of
+a VectorApplicationPlacementEnv at once, from the environment's batched node
+and module arrays:
+
+- fastest: the node with the highest processing speed
+- best_fit: the node whose available memory fits the module most tightly
+- earliest_finish: the node the module would finish on soonest, given the
+  modules already queued there
+
+Heuristics only choose nodes allowed by the action mask, so they never
+violate memory constraints while a node has room for the module.
+
+Usage: python heuristics.py <# Scenarios> [--heuristics fastest best_fit] [--seed 0] [--output results.json]"""
+
+from environment.envs.vector_application_placement_env import VectorApplicationPlacementEnv
+from replay_buffer import ReplayBuffer
+from evaluate import summarize
+import environment
+import numpy as np
+import argparse
+import json
+import time
+
+# The statistics recorded for every scenario solved by a heuristic
+SCENARIO_STATISTICS = ("reward", "makespan")
+
+def _next_modules(envs: VectorApplicationPlacementEnv) -> np.ndarray:
+    """Returns the index of the next module to place in every sub-environment
+    (clamped for sub-environments that have placed every module)."""
+    return np.minimum(envs.cursor, envs.num_modules - 1)
+
+def fastest(envs: VectorApplicationPlacementEnv, masks: np.ndarray) -> np.ndarray:
+    """Places every module on the fastest allowed node."""
+    return np.argmax(np.where(masks, envs.node_speed, -1), axis=1)
+
+def best_fit(envs: VectorApplicationPlacementEnv, masks: np.ndarray) -> np.ndarray:
+    """Places every module on the allowed node with the least memory left
+    over. If no node fits the module, the node closest to fitting it is
+    chosen."""
+    memory_required = envs.module_memory[envs.env_index, _next_modules(envs)]
+    leftover = envs.node_available_memory - memory_required[:, None]
+    # Nodes that fit always rank before those that don't
+    key = np.where(leftover >= 0, leftover, np.iinfo(np.int64).max // 2 - leftover)
+    return np.argmin(np.where(masks, key, np.iinfo(np.int64).max), axis=1)
+
+def earliest_finish(envs: VectorApplicationPlacementEnv, masks: np.ndarray) -> np.ndarray:
+    """Places every module on the allowed node it would finish on soonest,
+    after the modules already queued there."""
+    instructions = envs.module_instructions[envs.env_index, _next_modules(envs)]
+    finish_time = np.maximum(envs.now[:, None], envs.node_busy_until) + instructions[:, None] / envs.node_speed
+    return np.argmin(np.where(masks, finish_time, np.inf), axis=1)
+
+HEURISTICS = {"fastest": fastest, "best_fit": best_fit, "earliest_finish": earliest_finish}
+
+def solve(heuristic, num_scenarios: int, seed=None, num_modules=None, num_nodes=None,
+          replay_buffer: ReplayBuffer | None = None) -> dict:
+    """Places every module of num_scenarios generated scenarios with a
+    heuristic, stepping all of them together in one vector environment, and
+    returns the total reward and makespan of each scenario. The same seed
+    gives the same scenarios for every heuristic.
+
+    If a replay buffer is given, every transition is stored in it as a
+    demonstration."""
+    envs = VectorApplicationPlacementEnv(num_scenarios, num_modules, num_nodes)
+    states, infos = envs.reset(seed=seed)
+    # Sub-environments are reset automatically when they terminate, so only
+    # the first episode of each is followed
+    active = np.ones(num_scenarios, dtype=bool)
+    rewards = np.zeros(num_scenarios)
+    makespans = np.zeros(num_scenarios)
+    while active.any():
+        actions = heuristic(envs, infos["action_mask"])
+        next_states, step_rewards, dones, _, infos = envs.step(actions)
+        if replay_buffer is not None:
+            # Terminated sub-environments have already been reset, so their real
+            # next states are the final states
+            rows = np.flatnonzero(active)
+            replay_buffer.store_batch(states[rows], actions[rows], step_rewards[rows], infos["final_states"][rows],
+                                      dones[rows], infos["action_mask"][rows], rows)
+        rewards[active] += step_rewards[active]
+        finished = active & dones
+        makespans[finished] = infos["time"][finished]
+        active &= ~dones
+        states = next_states
+    return {"reward": rewards, "makespan": makespans}
+
+def prefill_replay_buffer(replay_buffer: ReplayBuffer, heuristic: str, num_episodes: int, seed=None,
+                          batch_size: int = 1_000) -> int:
+    """Stores the transitions of num_episodes episodes played by the named
+    heuristic in the replay buffer, solving batch_size scenarios at a time.
+    Returns the number of those transitions left in the buffer, as once it
+    is full each new transition overwrites the oldest."""
+    stored = replay_buffer.pointer
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_episodes, batch_size):
+        solve(HEURISTICS[heuristic], min(batch_size, num_episodes - start), int(rng.integers(2**31)),
+              replay_buffer=replay_buffer)
+    return min(replay_buffer.pointer - stored, replay_buffer.buffer_size)
+
+def compare_heuristics(num_scenarios: int, heuristics=tuple(HEURISTICS), seed: int = 0) -> dict:
+    """Solves the same num_scenarios scenarios with each heuristic and
+    summarizes their rewards and makespans."""
+    results = {"num_scenarios": num_scenarios, "seed": seed, "heuristics": {}}
+    for name in heuristics:
+        start_time = time.perf_counter()
+        statistics = solve(HEURISTICS[name], num_scenarios, seed)
+        wall_time = time.perf_counter() - start_time
+        scenarios = [dict(zip(SCENARIO_STATISTICS, values)) for values in zip(*statistics.values())]
+        summary = summarize(scenarios, SCENARIO_STATISTICS)
+        summary["wall_time"] = wall_time
+        summary["scenarios_per_second"] = num_scenarios / wall_time
+        results["heuristics"][name] = summary
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solves generated scenarios with heuristic placement policies.")
+    parser.add_argument("num_scenarios", type=int, help="Number of scenarios to solve with each heuristic")
+    parser.add_argument("--heuristics", nargs="+", choices=list(HEURISTICS), default=list(HEURISTICS),
+                        help="Which heuristics to run")
+    parser.add_argument("--seed", type=int, default=0, help="Seed the scenarios are generated from")
+    parser.add_argument("--output", default=None, help="File to write the JSON statistics to")
+    args = parser.parse_args()
+    assert args.num_scenarios > 0, "Need at least 1 scenario"
+
+    results = compare_heuristics(args.num_scenarios, args.heuristics, args.seed)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,134 @@
+"""A NumPy-only forward pass for trained DuelingDQN networks. The weights of
+the d1/d2/v/a layers (of a DuelingDQN or NodeEncoderDQN) are exported to a
+compact .npz file, which can then be
+used to choose actions without importing TensorFlow.
+
+Usage: python numpy_dqn.py <Model path> <Weights save path>"""
+
+from environment.envs.application_placement_env import PADDED_ROW_SIZE, padded_node_mask
+import numpy as np
+import sys
+
+# The layers of a DuelingDQN, in the order they are applied
+LAYERS = ("d1", "d2", "v", "a")
+# Matches MASKED_Q_VALUE in dueling_dqn
+MASKED_Q_VALUE = -1e9
+
+def layer_weights(model) -> dict:
+    """Returns the kernels and biases of a DuelingDQN's layers, keyed by the
+    names NumpyDuelingDQN expects."""
+    weights = {}
+    for name in LAYERS:
+        kernel, bias = getattr(model, name).get_weights()
+        weights[f"{name}_kernel"] = kernel.astype(np.float32)
+        weights[f"{name}_bias"] = bias.astype(np.float32)
+    if getattr(model, "per_node", False):
+        weights["per_node"] = np.ones(1, dtype=np.float32)
+    return weights
+
+def export_weights(model, path: str):
+    """Saves the kernels and biases of a DuelingDQN's layers to an .npz file."""
+    np.savez(path, **layer_weights(model))
+
+class NumpyDuelingDQN:
+    """Computes the same outputs as DuelingDQN (or NodeEncoderDQN) using NumPy
+    matrix products. Inputs are batches of states with shape (batch size,
+    observation size)."""
+    def __init__(self, weights):
+        for name in LAYERS:
+            setattr(self, f"{name}_kernel", np.ascontiguousarray(weights[f"{name}_kernel"], dtype=np.float32))
+            setattr(self, f"{name}_bias", np.ascontiguousarray(weights[f"{name}_bias"], dtype=np.float32))
+        # Whether the weights are a NodeEncoderDQN's, which encodes each node of
+        # a padded observation separately
+        self.per_node = "per_node" in weights
+        # The number of actions of a NodeEncoderDQN depends on the observations
+        self.num_actions = None if self.per_node else self.a_bias.shape[0]
+
+    @classmethod
+    def load(cls, path: str):
+        """Loads the weights exported by export_weights."""
+        with np.load(path) as weights:
+            return cls(dict(weights))
+
+    def _hidden(self, states):
+        """Returns the hidden layer's output and, for per-node weights, which
+        nodes are real (otherwise None)."""
+        x = np.asarray(states, dtype=np.float32)
+        mask = None
+        if self.per_node:
+            rows = x.reshape(len(x), -1, PADDED_ROW_SIZE)
+            nodes = rows[:, 1:, :2]
+            x = np.concatenate((nodes, np.broadcast_to(rows[:, :1, :2], nodes.shape)), axis=2)
+            mask = rows[:, 1:, 2] > 0
+        x = np.maximum(x @ self.d1_kernel + self.d1_bias, 0)
+        return np.maximum(x @ self.d2_kernel + self.d2_bias, 0), mask
+
+    def __call__(self, states):
+        x, mask = self._hidden(states)
+        if mask is None:
+            v = x @ self.v_kernel + self.v_bias
+            a = x @ self.a_kernel + self.a_bias
+            return v + (a - a.mean(axis=1, keepdims=True))
+        count = np.maximum(mask.sum(axis=1, keepdims=True), 1)
+        v = (x * mask[:, :, None]).sum(axis=1) / count @ self.v_kernel + self.v_bias
+        a = (x @ self.a_kernel)[:, :, 0] + self.a_bias
+        q = v + (a - (a * mask).sum(axis=1, keepdims=True) / count)
+        return np.where(mask, q, MASKED_Q_VALUE)
+
+    def advantage(self, states):
+        x, mask = self._hidden(states)
+        a = x @ self.a_kernel + self.a_bias
+        if mask is None:
+            return a
+        return np.where(mask, a[:, :, 0], MASKED_Q_VALUE)
+
+class NumpyPolicy:
+    """Chooses actions from a NumpyDuelingDQN with the same epsilon-greedy
+    policy as DQNAgent. It is greedy by default, as used for evaluation and
+    deployment."""
+    def __init__(self, dqn: NumpyDuelingDQN, epsilon=0.0):
+        self.q_net = dqn
+        self.epsilon = epsilon
+
+    def policy(self, state, mask=None) -> int:
+        """Returns the best action for a single state (or a random action with
+        a chance based on epsilon), only choosing actions allowed by the mask
+        if one is given"""
+        if mask is None and self.q_net.per_node:
+            mask = padded_node_mask(state)
+        if self.epsilon > 0 and np.random.rand() <= self.epsilon:
+            if mask is not None:
+                return int(np.random.choice(np.flatnonzero(mask)))
+            return np.random.randint(self.q_net.num_actions)
+        advantages = self.q_net.advantage(np.asarray(state)[None, :])[0]
+        if mask is not None:
+            advantages = np.where(mask, advantages, MASKED_Q_VALUE)
+        return int(np.argmax(advantages))
+
+    def policy_batch(self, states, masks=None) -> np.ndarray:
+        """Returns the best allowed action for every state in a batch"""
+        if masks is None and self.q_net.per_node:
+            masks = padded_node_mask(states)
+        advantages = self.q_net.advantage(states)
+        if masks is not None:
+            advantages = np.where(masks, advantages, MASKED_Q_VALUE)
+        actions = np.argmax(advantages, axis=1)
+        if self.epsilon > 0:
+            explore = np.random.rand(len(actions)) <= self.epsilon
+            if masks is not None:
+                # A random allowed action, as disallowed actions get no random key
+                random_actions = np.argmax(np.random.rand(*masks.shape) * masks, axis=1)
+            else:
+                random_actions = np.random.randint(self.q_net.num_actions, size=len(actions))
+            actions = np.where(explore, random_actions, actions)
+        return actions
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        # TensorFlow is only needed to read the Keras model being exported
+        import keras
+        import dueling_dqn
+        export_weights(keras.models.load_model(sys.argv[1]), sys.argv[2])
+        print(f"Exported weights to {sys.argv[2]}")
+    else:
+        print("Please provide arguments: <Model path> <Weights save path>")
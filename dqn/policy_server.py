@@ -0,0 +1,314 @@
+"""Serves placement decisions from a trained DQN to many concurrent callers.
+
+The server listens on a Unix socket or a localhost TCP port. Every request
+holds one observation (and optionally its action mask), and is answered with
+the node the greedy policy chooses for it. Requests that arrive together are
+coalesced into micro-batches: a batch is run once it holds max_batch_size
+requests or its oldest request has waited latency_budget seconds, so a
+single forward pass answers many callers.
+
+Frames are little-endian. A request is a header of (request id, number of
+observation floats, number of mask bytes) as three uint32s, followed by the
+float32 observation and one uint8 per action of the mask. A response is
+(request id as uint32, chosen node as int32, payload length as uint32) plus
+the payload. Connections can have many requests in flight, and responses are
+matched to requests by their id. A request with no observation asks for the
+server's statistics instead, returned as a JSON payload with a node of -1.
+Requests whose observation or mask doesn't fit the policy's network, or that
+the policy fails on, are answered with a node of -2.
+
+Usage:
+    python policy_server.py serve <Model path> [--unix PATH | --port 5555] [--max-batch-size 256] [--latency-budget-us 500]
+    python policy_server.py load [--unix PATH | --port 5555] [--requests 100000] [--concurrency 256]"""
+
+from evaluate import load_policy, PERCENTILES
+from numpy_dqn import NumpyDuelingDQN, layer_weights
+from environment.envs.application_placement_env import OBSERVATION_SPACE, PADDED_ROW_SIZE
+import numpy as np
+import argparse
+import asyncio
+import struct
+import json
+import time
+
+REQUEST_HEADER = struct.Struct("<III")
+RESPONSE_HEADER = struct.Struct("<IiI")
+# The number of most recent request latencies the statistics are computed from
+LATENCY_WINDOW = 100_000
+# The node answered to requests that can't be served
+INVALID_REQUEST = -2
+
+class PolicyServer:
+    """Answers placement requests with a policy loaded by load_policy (from a
+    Keras model or exported .npz weights), in micro-batches."""
+    def __init__(self, model_path: str, max_batch_size: int = 256, latency_budget: float = 500e-6):
+        assert max_batch_size > 0, "Batches must hold at least 1 request"
+        assert latency_budget >= 0, "Latency budget can't be negative"
+        self.policy = load_policy(model_path)
+        # The observation size and number of actions of the policy's network,
+        # which requests are checked against. A NodeEncoderDQN takes padded
+        # observations of any number of nodes, so these are None for it.
+        q_net = self.policy.q_net
+        if not isinstance(q_net, NumpyDuelingDQN):
+            q_net = NumpyDuelingDQN(layer_weights(q_net))
+        self.per_node = q_net.per_node
+        self.observation_size = None if self.per_node else q_net.d1_kernel.shape[0]
+        self.num_actions = q_net.num_actions
+        self.requests_rejected = 0
+        self.max_batch_size = max_batch_size
+        self.latency_budget = latency_budget
+        # Requests waiting to be batched, as (observation, mask, future, arrival)
+        self.queue = asyncio.Queue()
+        # The arrival of the first request, which throughput is measured from
+        self.start_time = None
+        self.requests_served = 0
+        self.batches_run = 0
+        # The latency of the most recent requests, in a ring
+        self.latencies = np.zeros(LATENCY_WINDOW)
+        self.batch_sizes = np.zeros(max_batch_size + 1, dtype=np.int64)
+
+    def valid_request(self, num_floats: int, num_mask_bytes: int) -> bool:
+        """Returns whether a request's observation fits the policy's network,
+        and its mask (if any) has one byte per action."""
+        if self.per_node:
+            if num_floats % PADDED_ROW_SIZE != 0 or num_floats < 2 * PADDED_ROW_SIZE:
+                return False
+            num_actions = num_floats // PADDED_ROW_SIZE - 1
+        else:
+            if num_floats != self.observation_size:
+                return False
+            num_actions = self.num_actions
+        return num_mask_bytes in (0, num_actions)
+
+    async def choose(self, observation: np.ndarray, mask: np.ndarray | None = None) -> int:
+        """Waits for the node chosen for an observation in the next batch."""
+        future = asyncio.get_running_loop().create_future()
+        arrival = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = arrival
+        await self.queue.put((observation, mask, future, arrival))
+        return await future
+
+    async def run_batches(self):
+        """Collects waiting requests into batches and answers them, forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.latency_budget
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self._answer(batch)
+
+    def _answer(self, batch: list):
+        """Runs the policy on a batch. Observations of different sizes (e.g.
+        padded to different numbers of nodes) are run as separate batches."""
+        groups = {}
+        for request in batch:
+            groups.setdefault(len(request[0]), []).append(request)
+        for requests in groups.values():
+            try:
+                states = np.stack([request[0] for request in requests])
+                masks = None
+                if any(request[1] is not None for request in requests):
+                    num_actions = next(len(request[1]) for request in requests if request[1] is not None)
+                    masks = np.stack([np.ones(num_actions, dtype=bool) if request[1] is None else request[1]
+                                      for request in requests])
+                actions = self.policy.policy_batch(states, masks)
+            except Exception as error:
+                # Only this group's callers are failed, so the batcher keeps
+                # serving every other request
+                for request in requests:
+                    if not request[2].done():
+                        request[2].set_exception(error)
+                continue
+            now = time.perf_counter()
+            for request, action in zip(requests, actions):
+                if not request[2].done():
+                    request[2].set_result(int(action))
+                self.latencies[self.requests_served % LATENCY_WINDOW] = now - request[3]
+                self.requests_served += 1
+        self.batches_run += 1
+        self.batch_sizes[len(batch)] += 1
+
+    def stats(self) -> dict:
+        """Returns the throughput since the first request, the batch sizes
+        and the latency percentiles of the most recent requests."""
+        elapsed = time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+        latencies = self.latencies[:min(self.requests_served, LATENCY_WINDOW)] * 1e6
+        stats = {
+            "requests_served": self.requests_served,
+            "requests_rejected": self.requests_rejected,
+            "batches_run": self.batches_run,
+            "requests_per_second": self.requests_served / elapsed if elapsed > 0 else 0.0,
+            "mean_batch_size": self.requests_served / max(self.batches_run, 1),
+            "max_batch_size": int(np.flatnonzero(self.batch_sizes)[-1]) if self.batches_run > 0 else 0
+        }
+        if len(latencies) > 0:
+            stats["latency_us"] = {
+                "mean": float(latencies.mean()),
+                **{f"p{p}": float(v) for p, v in zip(PERCENTILES + (99.9,), np.percentile(latencies, PERCENTILES + (99.9,)))}
+            }
+        return stats
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Reads requests from a connection until it closes, answering each as
+        soon as its batch has run."""
+        tasks = set()
+
+        async def respond(request_id, observation, mask):
+            try:
+                action = await self.choose(observation, mask)
+            except Exception:
+                self.requests_rejected += 1
+                action = INVALID_REQUEST
+            writer.write(RESPONSE_HEADER.pack(request_id, action, 0))
+
+        try:
+            while True:
+                request_id, num_floats, num_mask_bytes = REQUEST_HEADER.unpack(
+                    await reader.readexactly(REQUEST_HEADER.size)
+                )
+                if num_floats == 0:
+                    payload = json.dumps(self.stats()).encode()
+                    writer.write(RESPONSE_HEADER.pack(request_id, -1, len(payload)) + payload)
+                    continue
+                body = await reader.readexactly(4 * num_floats + num_mask_bytes)
+                if not self.valid_request(num_floats, num_mask_bytes):
+                    self.requests_rejected += 1
+                    writer.write(RESPONSE_HEADER.pack(request_id, INVALID_REQUEST, 0))
+                    continue
+                observation = np.frombuffer(body, dtype=np.float32, count=num_floats)
+                mask = np.frombuffer(body, dtype=np.uint8, offset=4 * num_floats).astype(bool) if num_mask_bytes else None
+                task = asyncio.create_task(respond(request_id, observation, mask))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def serve(self, unix_path: str | None = None, port: int = 5555):
+        """Listens on a Unix socket if a path is given, otherwise on a
+        localhost TCP port, until cancelled."""
+        batcher = asyncio.create_task(self.run_batches())
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, "127.0.0.1", port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+class PolicyClient:
+    """A connection to a PolicyServer that can have many requests in
+    flight."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.next_id = 0
+        # Futures of requests awaiting a response, keyed by request id
+        self.pending = {}
+        self.receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, unix_path: str | None = None, port: int = 5555):
+        if unix_path is not None:
+            return cls(*await asyncio.open_unix_connection(unix_path))
+        return cls(*await asyncio.open_connection("127.0.0.1", port))
+
+    async def _receive(self):
+        while True:
+            request_id, action, payload_length = RESPONSE_HEADER.unpack(
+                await self.reader.readexactly(RESPONSE_HEADER.size)
+            )
+            payload = await self.reader.readexactly(payload_length) if payload_length else None
+            self.pending.pop(request_id).set_result(json.loads(payload) if payload is not None else action)
+
+    def _request(self, frame: bytes, request_id: int):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(frame)
+        return future
+
+    async def place(self, observation, mask=None) -> int:
+        """Returns the node the server's policy chooses for an observation, or
+        INVALID_REQUEST if the server couldn't serve it."""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) % 2**32
+        observation = np.asarray(observation, dtype=np.float32)
+        mask_bytes = b"" if mask is None else np.asarray(mask, dtype=np.uint8).tobytes()
+        frame = REQUEST_HEADER.pack(request_id, len(observation), len(mask_bytes)) + observation.tobytes() + mask_bytes
+        return await self._request(frame, request_id)
+
+    async def stats(self) -> dict:
+        """Returns the server's statistics."""
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) % 2**32
+        return await self._request(REQUEST_HEADER.pack(request_id, 0, 0), request_id)
+
+    async def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def generate_load(num_requests: int, concurrency: int, unix_path: str | None = None, port: int = 5555,
+                        observation_size: int = OBSERVATION_SPACE, seed: int = 0) -> dict:
+    """Sends num_requests random placement requests to a server from
+    concurrency concurrent callers (sharing one connection) and returns the
+    client's throughput with the server's statistics."""
+    client = await PolicyClient.connect(unix_path, port)
+    rng = np.random.default_rng(seed)
+    observations = rng.random((1024, observation_size), dtype=np.float32)
+    counts = [num_requests // concurrency + (i < num_requests % concurrency) for i in range(concurrency)]
+
+    async def caller(count, offset):
+        for i in range(count):
+            await client.place(observations[(offset + i) % len(observations)])
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(caller(count, i) for i, count in enumerate(counts)))
+    elapsed = time.perf_counter() - start_time
+    results = {"requests": num_requests, "concurrency": concurrency, "wall_time": elapsed,
+               "requests_per_second": num_requests / elapsed, "server": await client.stats()}
+    await client.close()
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves placement decisions from a trained DQN.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run the policy server")
+    serve_parser.add_argument("model_path", help="Path of the trained model, or of weights exported to .npz")
+    serve_parser.add_argument("--max-batch-size", type=int, default=256, help="Most requests answered by one batch")
+    serve_parser.add_argument("--latency-budget-us", type=float, default=500,
+                              help="Longest a request waits for its batch to fill, in microseconds")
+    load_parser = subparsers.add_parser("load", help="Measure a running server with concurrent requests")
+    load_parser.add_argument("--requests", type=int, default=100_000, help="Number of requests to send")
+    load_parser.add_argument("--concurrency", type=int, default=256, help="Number of concurrent callers")
+    for subparser in (serve_parser, load_parser):
+        subparser.add_argument("--unix", default=None, help="Path of the Unix socket, instead of TCP")
+        subparser.add_argument("--port", type=int, default=5555, help="Localhost TCP port")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = PolicyServer(args.model_path, args.max_batch_size, args.latency_budget_us * 1e-6)
+        print(f"Serving {args.model_path} on {args.unix or f'127.0.0.1:{args.port}'}")
+        try:
+            asyncio.run(server.serve(args.unix, args.port))
+        except KeyboardInterrupt:
+            print(json.dumps(server.stats(), indent=2))
+    else:
+        assert args.requests > 0 and args.concurrency > 0, "Need at least 1 request and caller"
+        print(json.dumps(asyncio.run(generate_load(args.requests, args.concurrency, args.unix, args.port)), indent=2))
@@ -1,65 +1,470 @@
 from collections import deque
+from sum_tree import SumTree
 import numpy as np
 import random
+import shutil
+import json
+import os
 
 class ReplayBuffer:
-    """Stores state transitions to allow for training the dqn."""
-    
-    def __init__(self, observation_space, buffer_size=100_000):
+    """Stores state transitions to allow for training the dqn.
+
+    Experiences are sampled in proportion to their priority, which is kept in
+    a sum tree so that storing, sampling and updating priorities are all
+    O(log N). The priority of an experience is based on either:
+    - "reward": the absolute value of its reward
+    - "td": the absolute value of its TD error, which is updated after it is
+      trained on (see update_priorities). New experiences are given the
+      highest priority seen so far, so each is sampled at least once.
+
+    Observations are stored in one of two ways:
+    - "separate": every experience stores its state and next state
+    - "compact": every observation is stored once, and the next state of an
+      experience is referenced by the index of the slot holding it. While an
+      episode continues, the next state of one experience is the state of the
+      next one stored in the same stream, so this roughly halves the memory
+      used by observations even when the experiences of several streams
+      (e.g. the sub-environments of a vector environment) are interleaved.
+      An experience is only sampled once its stream's next experience has
+      been stored (or its episode has ended), as until then the slot holding
+      its next state isn't known.
+
+    If action_mask_size is given, the action mask of each experience's next
+    state is also stored (see next_mask_memory), so that training targets
+    only consider actions that were allowed.
+
+    If a storage path is given, the arrays are memory-mapped files in that
+    directory, so the buffer can be far larger than RAM and can be reloaded
+    between runs without copying (see save and load).
+
+    With n_step above 1, each stored experience is an n-step transition: its
+    reward is the discounted sum of the next n rewards (by gamma) and its next
+    state is the state n steps later, so its target bootstraps with
+    gamma ** n_step. The sums are accumulated as experiences arrive, in a
+    ring of the last n_step experiences of each stream (e.g. each
+    sub-environment of a vector environment), and an experience is stored
+    once its n rewards are known or its episode ends. Experiences still in a
+    ring aren't saved with the buffer."""
+
+    def __init__(self, observation_space, buffer_size=100_000, priority="reward",
+                 alpha=1.0, beta=0.4, beta_increment=1e-4, priority_epsilon=1e-5,
+                 storage="separate", dtype=np.float32, storage_path=None, action_mask_size=None,
+                 n_step=1, gamma=0.99):
+        assert priority in ("reward", "td"), "Priority must be 'reward' or 'td'"
+        assert storage in ("separate", "compact"), "Storage must be 'separate' or 'compact'"
+        # The next state of an n-step experience isn't the state of the next
+        # experience stored, which compact storage relies on
+        assert n_step == 1 or storage == "separate", "n-step returns need separate storage"
+        assert n_step >= 1, "n-step returns need at least 1 step"
+        self.observation_space = observation_space
         self.buffer_size = buffer_size
-        self.state_memory = np.zeros(
-            (self.buffer_size, observation_space),
-            dtype=np.int32
+        self.storage = storage
+        self.dtype = np.dtype(dtype)
+        self.storage_path = storage_path
+        if storage_path is not None:
+            os.makedirs(storage_path, exist_ok=True)
+
+        if storage == "compact":
+            # Holds the state of the experience in the same slot, or the next
+            # state of an experience whose stream didn't continue from it
+            self.obs_memory = self._allocate("obs", (self.buffer_size, observation_space), self.dtype)
+            # The index of the slot holding the next state of each experience
+            self.next_index_memory = self._allocate("next_index", (self.buffer_size,), np.int64)
+            # Whether each slot holds an experience that can be sampled (rather
+            # than padding or an experience whose next state isn't stored yet)
+            self.valid_memory = self._allocate("valid", (self.buffer_size,), np.int8)
+        else:
+            self.state_memory = self._allocate("state", (self.buffer_size, observation_space), self.dtype)
+            self.next_state_memory = self._allocate("next_state", (self.buffer_size, observation_space), self.dtype)
+        self.action_memory = self._allocate("action", (self.buffer_size,), np.int32)
+        self.reward_memory = self._allocate("reward", (self.buffer_size,), np.float32)
+        self.done_memory = self._allocate("done", (self.buffer_size,), np.int8)
+        # Whether each action was allowed in the next state of each experience
+        self.action_mask_size = action_mask_size
+        if action_mask_size is not None:
+            self.next_mask_memory = self._allocate("next_mask", (self.buffer_size, action_mask_size), np.bool_)
+        self.pointer = 0
+        # Whether the last stored experience ended an episode
+        self.last_done = True
+
+        self.priority = priority
+        self.priorities = SumTree(
+            self.buffer_size,
+            self._allocate("priorities", (2 * SumTree.num_leaves_for(self.buffer_size),), np.float64)
         )
-        self.action_memory = np.zeros(self.buffer_size, dtype=np.int32)
-        self.reward_memory = np.zeros(self.buffer_size, dtype=np.float32)
-        self.next_state_memory = np.zeros(
-            (self.buffer_size, observation_space),
-            dtype=np.int32
+        # How strongly sampling is skewed by priority (0 is uniform sampling)
+        self.alpha = alpha
+        # How strongly importance-sampling weights correct for the skew. This
+        # is annealed towards 1 over the course of training.
+        self.beta = beta
+        self.beta_increment = beta_increment
+        # Added to TD errors so that no experience has a priority of 0
+        self.priority_epsilon = priority_epsilon
+        # The highest priority given so far, which new experiences receive
+        # when prioritizing by TD error
+        self.max_priority = 1.0
+
+        self.n_step = n_step
+        self.gamma = gamma
+        self.rings = {}
+        # The latest experience of each stream with compact storage whose
+        # episode continues, as (slot, pointer it was stored at, next state),
+        # until the stream's next experience is stored
+        self.pending = {}
+
+    def _ring(self, stream):
+        """Returns the ring of experiences waiting for their n-step returns in
+        a stream, creating it if needed."""
+        ring = self.rings.get(stream)
+        if ring is None:
+            ring = self.rings[stream] = {
+                "states": np.zeros((self.n_step, self.observation_space), dtype=self.dtype),
+                "actions": np.zeros(self.n_step, dtype=np.int32),
+                "returns": np.zeros(self.n_step, dtype=np.float64),
+                # The index of the oldest experience and the number waiting
+                "head": 0,
+                "count": 0
+            }
+        return ring
+
+    def _allocate(self, name, shape, dtype):
+        """Allocates a zeroed array, as a memory-mapped file in the storage
+        path if one was given."""
+        if self.storage_path is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.lib.format.open_memmap(
+            os.path.join(self.storage_path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape
         )
-        self.done_memory = np.zeros(self.buffer_size, dtype=np.int8)
-        self.pointer = 0
 
-    def store_experience(self, state, action, reward, next_state, done):
-        """Stores an experience for later training."""
+    def store_experience(self, state, action, reward, next_state, done, next_mask=None, stream=0):
+        """Stores an experience for later training. Without a next state action
+        mask, every action is taken to be allowed. With n-step returns,
+        experiences are accumulated per stream, so interleaved episodes must
+        be given different streams."""
+        if self.n_step == 1:
+            self._store(state, action, reward, next_state, done, next_mask, stream)
+            return
+        ring = self._ring(stream)
+        n = self.n_step
+        head, count = ring["head"], ring["count"]
+        tail = (head + count) % n
+        ring["states"][tail] = state
+        ring["actions"][tail] = action
+        ring["returns"][tail] = 0.0
+        count += 1
+        # The new reward is discounted by how many steps after each waiting
+        # experience it was received
+        for age in range(count):
+            ring["returns"][(tail - age) % n] += self.gamma ** age * reward
+        if count == n:
+            # The oldest experience has all n rewards
+            self._store(ring["states"][head], ring["actions"][head], ring["returns"][head], next_state, done, next_mask)
+            head = (head + 1) % n
+            count -= 1
+        if done:
+            # The episode's remaining experiences end with it, so they have no
+            # later rewards to wait for
+            for i in range(count):
+                slot = (head + i) % n
+                self._store(ring["states"][slot], ring["actions"][slot], ring["returns"][slot], next_state, True, next_mask)
+            head, count = 0, 0
+        ring["head"], ring["count"] = head, count
+
+    def store_batch(self, states, actions, rewards, next_states, dones, next_masks=None, streams=None):
+        """Stores a batch of experiences in order, such as a whole episode or
+        one step of every sub-environment of a vector environment. With
+        separate storage and single-step returns, each array and the sum tree
+        are written with one slice assignment (two if the batch wraps around
+        the end of the buffer). Otherwise the experiences are stored one at a
+        time, each in its stream (0 by default)."""
+        if self.n_step > 1 or self.storage == "compact":
+            for i in range(len(states)):
+                self.store_experience(states[i], actions[i], rewards[i], next_states[i], dones[i],
+                                      None if next_masks is None else next_masks[i], 0 if streams is None else streams[i])
+            return
+        count = len(states)
+        if count == 0:
+            return
+        rewards = np.asarray(rewards)
+        dones = np.asarray(dones).astype(np.int8)
+        # Of a batch larger than the buffer, only the newest experiences fit
+        skip = max(0, count - self.buffer_size)
+        kept = count - skip
+        start = (self.pointer + skip) % self.buffer_size
+        first = min(kept, self.buffer_size - start)
+        for slots, rows in ((slice(start, start + first), slice(skip, skip + first)),
+                            (slice(0, kept - first), slice(skip + first, count))):
+            self.state_memory[slots] = states[rows]
+            self.next_state_memory[slots] = next_states[rows]
+            self.action_memory[slots] = actions[rows]
+            self.reward_memory[slots] = rewards[rows]
+            self.done_memory[slots] = 1 - dones[rows]
+            if self.action_mask_size is not None:
+                self.next_mask_memory[slots] = True if next_masks is None else next_masks[rows]
+        if self.priority == "reward":
+            priorities = np.abs(rewards[skip:]) ** self.alpha
+        else:
+            priorities = np.full(kept, self.max_priority)
+        self.priorities.update_range(start, priorities[:first])
+        if kept > first:
+            self.priorities.update_range(0, priorities[first:])
+        self.last_done = bool(dones[-1])
+        self.pointer += count
+
+    def _store(self, state, action, reward, next_state, done, next_mask=None, stream=0):
+        """Writes an experience to the buffer's arrays."""
         # Buffer is calculated module self.buffer_size so it doesn't get larger
         # than the buffer size
         idx = self.pointer % self.buffer_size
         # Stores the new experience in the replay buffer
-        self.state_memory[idx] = state
+        if self.storage == "compact":
+            idx = self._store_compact(np.asarray(state, dtype=self.dtype), next_state, done, stream)
+        else:
+            self.state_memory[idx] = state
+            self.next_state_memory[idx] = next_state
         self.action_memory[idx] = action
         self.reward_memory[idx] = reward
-        self.next_state_memory[idx] = next_state
         self.done_memory[idx] = 1 - done
+        if self.action_mask_size is not None:
+            self.next_mask_memory[idx] = True if next_mask is None else next_mask
+        if self.storage == "compact" and not done:
+            # Not sampled until its next state is linked
+            self.priorities.update([idx], [0.0])
+        else:
+            self.priorities.update([idx], [self._new_priority(reward)])
+        self.last_done = bool(done)
         # Increments the pointer variable
         self.pointer += 1
 
+    def _new_priority(self, reward):
+        if self.priority == "reward":
+            return abs(reward) ** self.alpha
+        return self.max_priority
+
+    def _store_compact(self, state, next_state, done, stream):
+        """Writes an experience's state to the next slot with compact storage
+        and returns the slot, linking the stream's previous experience to it.
+        The state is compared with that experience's next state at the
+        precision the buffer stores. If it doesn't continue from it (e.g. the
+        episode was cut short), the next state is written to a padding slot
+        first."""
+        pending = self.pending.pop(stream, None)
+        # An experience that has since been overwritten has nothing to link
+        if pending is not None and self.pointer - pending[1] < self.buffer_size:
+            previous, _, previous_next_state = pending
+            if not np.array_equal(previous_next_state, state):
+                padding = self.pointer % self.buffer_size
+                self.obs_memory[padding] = previous_next_state
+                self.valid_memory[padding] = 0
+                self.priorities.update([padding], [0.0])
+                self._link(previous, padding)
+                self.pointer += 1
+            else:
+                self._link(previous, self.pointer % self.buffer_size)
+        idx = self.pointer % self.buffer_size
+        self.obs_memory[idx] = state
+        if done:
+            # The targets of experiences that end an episode don't use their
+            # next state, so it isn't kept
+            self.next_index_memory[idx] = idx
+            self.valid_memory[idx] = 1
+        else:
+            self.valid_memory[idx] = 0
+            self.pending[stream] = (idx, self.pointer, np.array(next_state, dtype=self.dtype))
+        return idx
+
+    def _link(self, idx, next_idx):
+        """Points a pending experience at the slot holding its next state,
+        making it valid to sample."""
+        self.next_index_memory[idx] = next_idx
+        self.valid_memory[idx] = 1
+        self.priorities.update([idx], [self._new_priority(self.reward_memory[idx])])
+
     def sample_batch(self, batch_size=64):
         """Samples a batch of experiences from the buffer."""
-        # Before the buffer gets completely full, we want to only sample from
-        # the part of the buffer that has been filled (up to self.pointer)
+        states, actions, rewards, next_states, dones, _, _ = self.sample_prioritized(batch_size)
+        return states, actions, rewards, next_states, dones
+
+    def sample_prioritized(self, batch_size=64):
+        """Samples a batch of experiences from the buffer in proportion to their
+        priorities. Also returns the buffer indices of the experiences (to
+        update their priorities with) and their importance-sampling weights."""
+        # Before the buffer gets completely full, we only sample from the part
+        # of the buffer that has been filled (up to self.pointer)
         max_memory = min(self.pointer, self.buffer_size)
 
-        # Calculates the priorities of different experiences in the buffer,
-        # based on the absolute value of the reward (the greater the
-        # magnitude of the reward, the higher the priority)
-        priorities = np.zeros(max_memory)
-        for i in range(max_memory):
-            priorities[i] = abs(self.reward_memory[i])
-        priority_sum = np.sum(priorities)
-        # The probability that an experience is selected is proportional to
-        # it's priority (the absolute value of it's reward)
-        probabilities = priorities / priority_sum
-
-        # Generates indices for the replay buffer based on the probability
-        # array
-        sample_indices = np.random.choice(
-            range(max_memory), size=batch_size, p=probabilities
-        )
-        # Obtains the randomly sampled experiences and returns them
-        states = self.state_memory[sample_indices]
+        total = self.priorities.total()
+        if total > 0:
+            sample_indices = self.priorities.sample(batch_size)
+            probabilities = self.priorities.get(sample_indices) / total
+        else:
+            # If every experience has a priority of 0, they are sampled
+            # uniformly instead
+            sample_indices = np.random.randint(max_memory, size=batch_size)
+            if self.storage == "compact":
+                # Padding slots and experiences whose next state isn't stored
+                # yet can't be sampled, so they are resampled from valid slots
+                valid = np.flatnonzero(self.valid_memory[:max_memory])
+                sample_indices = valid[np.random.randint(len(valid), size=batch_size)]
+            probabilities = np.full(batch_size, 1 / max_memory)
+
+        # Importance-sampling weights correct for the bias of prioritized
+        # sampling. They are scaled so that the largest weight is 1.
+        weights = (max_memory * probabilities) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        # Obtains the sampled experiences and returns them
+        if self.storage == "compact":
+            states = self.obs_memory[sample_indices]
+            next_states = self.obs_memory[self.next_index_memory[sample_indices]]
+        else:
+            states = self.state_memory[sample_indices]
+            next_states = self.next_state_memory[sample_indices]
         actions = self.action_memory[sample_indices]
         rewards = self.reward_memory[sample_indices]
-        next_states = self.next_state_memory[sample_indices]
         dones = self.done_memory[sample_indices]
-        return states, actions, rewards, next_states, dones
\ No newline at end of file
+        return states, actions, rewards, next_states, dones, sample_indices, weights
+
+    def update_priorities(self, indices, td_errors):
+        """Updates the priorities of the experiences at the given indices from
+        their latest TD errors. Only used when prioritizing by TD error."""
+        if self.priority != "td":
+            return
+        priorities = (np.abs(td_errors) + self.priority_epsilon) ** self.alpha
+        self.priorities.update(indices, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
+    def _arrays(self):
+        """Returns the buffer's arrays, keyed by the name of the file they are
+        saved to."""
+        arrays = {
+            "action": self.action_memory,
+            "reward": self.reward_memory,
+            "done": self.done_memory,
+            "priorities": self.priorities.tree
+        }
+        if self.storage == "compact":
+            arrays["obs"] = self.obs_memory
+            arrays["next_index"] = self.next_index_memory
+            arrays["valid"] = self.valid_memory
+        else:
+            arrays["state"] = self.state_memory
+            arrays["next_state"] = self.next_state_memory
+        if self.action_mask_size is not None:
+            arrays["next_mask"] = self.next_mask_memory
+        return arrays
+
+    def save(self, path):
+        """Saves the buffer to a directory of .npy files plus a metadata file.
+        If the buffer is already memory-mapped in that directory, its files
+        are only flushed."""
+        os.makedirs(path, exist_ok=True)
+        in_place = self.storage_path is not None and os.path.samefile(path, self.storage_path)
+        if in_place:
+            for array in self._arrays().values():
+                array.flush()
+            self.write_snapshot(path, {}, self._metadata())
+        else:
+            self.write_snapshot(path, self._arrays(), self._metadata())
+
+    def snapshot(self):
+        """Returns what write_snapshot needs to write the buffer (e.g. on
+        another thread) while it keeps changing: in-memory copies of its
+        arrays, its metadata and the buffer whose files are copied, if any.
+        A memory-mapped buffer isn't read into RAM. Its files are flushed, and
+        only its arrays with one value per slot are copied, leaving the
+        observations and next masks (nearly all of its size) in the files."""
+        arrays = self._arrays()
+        if self.storage_path is None:
+            return {name: np.array(array) for name, array in arrays.items()}, self._metadata(), None
+        for array in arrays.values():
+            array.flush()
+        return {name: np.array(array) for name, array in arrays.items() if array.ndim == 1}, self._metadata(), self
+
+    @staticmethod
+    def write_snapshot(path, arrays, metadata, source=None):
+        """Writes arrays and metadata in the format read by load, along with
+        the files of any arrays of a memory-mapped source buffer that aren't
+        given. Those files may already hold experiences stored since the
+        snapshot was taken, so their slots are given no priority (and marked
+        invalid), to be overwritten again once the buffer is loaded."""
+        os.makedirs(path, exist_ok=True)
+        if source is not None:
+            for name in source._arrays():
+                if name not in arrays:
+                    shutil.copyfile(os.path.join(source.storage_path, f"{name}.npy"), os.path.join(path, f"{name}.npy"))
+            # Read once the files are copied, so it covers every slot written
+            # while copying, plus the one that may be being written
+            start = metadata["pointer"]
+            end = min(source.pointer + 1, start + metadata["buffer_size"])
+            stale = np.arange(start, end) % metadata["buffer_size"]
+            SumTree(metadata["buffer_size"], arrays["priorities"]).update(stale, np.zeros(len(stale)))
+            if "valid" in arrays:
+                arrays["valid"][stale] = 0
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+
+    def _metadata(self):
+        """Returns the settings and counters needed to reload the buffer."""
+        return {
+            "observation_space": self.observation_space,
+            "buffer_size": self.buffer_size,
+            "priority": self.priority,
+            "alpha": self.alpha,
+            "beta": self.beta,
+            "beta_increment": self.beta_increment,
+            "priority_epsilon": self.priority_epsilon,
+            "storage": self.storage,
+            "dtype": self.dtype.name,
+            "pointer": self.pointer,
+            "last_done": self.last_done,
+            "max_priority": self.max_priority,
+            "action_mask_size": self.action_mask_size,
+            "n_step": self.n_step,
+            "gamma": self.gamma
+        }
+
+    @classmethod
+    def load(cls, path, mmap_mode="r+"):
+        """Loads a buffer saved with save. With a memory-map mode the arrays are
+        mapped straight from their files without being copied into RAM, and
+        any new experiences are written back to those files."""
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        # The buffer is created without allocating its arrays, which are then
+        # replaced by the saved ones
+        buffer = cls.__new__(cls)
+        for key in ("observation_space", "buffer_size", "priority", "alpha", "beta",
+                    "beta_increment", "priority_epsilon", "storage", "pointer",
+                    "last_done", "max_priority"):
+            setattr(buffer, key, metadata[key])
+        buffer.dtype = np.dtype(metadata["dtype"])
+        # Buffers saved before action masks were stored have none, and those
+        # saved before n-step returns store single steps
+        buffer.action_mask_size = metadata.get("action_mask_size")
+        buffer.n_step = metadata.get("n_step", 1)
+        buffer.gamma = metadata.get("gamma", 0.99)
+        buffer.rings = {}
+        buffer.pending = {}
+        buffer.storage_path = path if mmap_mode == "r+" else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        if buffer.storage == "compact":
+            buffer.obs_memory = load_array("obs")
+            buffer.next_index_memory = load_array("next_index")
+            buffer.valid_memory = load_array("valid")
+        else:
+            buffer.state_memory = load_array("state")
+            buffer.next_state_memory = load_array("next_state")
+        buffer.action_memory = load_array("action")
+        buffer.reward_memory = load_array("reward")
+        buffer.done_memory = load_array("done")
+        if buffer.action_mask_size is not None:
+            buffer.next_mask_memory = load_array("next_mask")
+        buffer.priorities = SumTree(buffer.buffer_size, load_array("priorities"))
+        return buffer
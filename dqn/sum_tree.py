@@ -0,0 +1,94 @@
+import numpy as np
+
+class SumTree:
+    """A binary tree stored in a flat array where each leaf holds the priority
+    of one slot and each internal node holds the sum of its children. Updating
+    a priority and sampling a slot in proportion to its priority both take
+    O(log N) time, and both are vectorized over batches of slots."""
+
+    def __init__(self, capacity, tree=None):
+        self.capacity = capacity
+        # The root is at index 1 and the children of node i are at 2i and
+        # 2i + 1, so the leaves start at index self.num_leaves.
+        self.num_leaves = self.num_leaves_for(capacity)
+        self.depth = self.num_leaves.bit_length() - 1
+        # An existing array (e.g. a memory-mapped one) can be used to hold the
+        # tree, otherwise a new one is allocated
+        if tree is None:
+            tree = np.zeros(2 * self.num_leaves, dtype=np.float64)
+        assert len(tree) == 2 * self.num_leaves
+        self.tree = tree
+
+    @staticmethod
+    def num_leaves_for(capacity) -> int:
+        """Returns the number of leaves in a tree with the given capacity. This
+        is rounded up to a power of 2 so the tree is complete."""
+        num_leaves = 1
+        while num_leaves < capacity:
+            num_leaves *= 2
+        return num_leaves
+
+    def total(self) -> float:
+        """Returns the sum of all priorities."""
+        return self.tree[1]
+
+    def get(self, indices):
+        """Returns the priorities of the given slots."""
+        return self.tree[np.asarray(indices) + self.num_leaves]
+
+    def update(self, indices, priorities):
+        """Sets the priorities of the given slots and recomputes the sums of
+        all their ancestors, one level of the tree at a time."""
+        if len(indices) == 1:
+            # A single slot is cheaper to update with plain Python indexing
+            node = int(indices[0]) + self.num_leaves
+            self.tree[node] = priorities[0]
+            while node > 1:
+                node //= 2
+                self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            return
+        nodes = np.asarray(indices, dtype=np.int64) + self.num_leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            # Recomputing each sum from its children (rather than adding the
+            # change) prevents floating point error from accumulating.
+            # Duplicate parents all compute the same value.
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def update_range(self, start, priorities):
+        """Sets the priorities of the consecutive slots from start onwards.
+        The ancestors of consecutive slots are consecutive at every level, so
+        their sums are recomputed with slices rather than indexing."""
+        low = start + self.num_leaves
+        high = low + len(priorities)
+        self.tree[low:high] = priorities
+        for _ in range(self.depth):
+            low //= 2
+            high = (high - 1) // 2 + 1
+            self.tree[low:high] = self.tree[2 * low:2 * high:2] + self.tree[2 * low + 1:2 * high:2]
+
+    def find(self, values):
+        """Returns, for each value in [0, total], the slot whose range of
+        cumulative priority contains it."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            # Goes right if the value is past the left subtree. Subtrees with no
+            # priority are never entered, even with floating point error.
+            go_right = (values > left_sum) & (self.tree[left + 1] > 0)
+            values -= left_sum * go_right
+            nodes = left + go_right
+        return nodes - self.num_leaves
+
+    def sample(self, batch_size):
+        """Samples batch_size slots in proportion to their priorities. The
+        total priority is split into equal segments and one value is drawn
+        from each, which reduces the variance of the sample."""
+        segment = self.total() / batch_size
+        # Values are drawn from (0, segment] so that they never land on a
+        # leading slot with no priority
+        values = (np.arange(batch_size) + 1 - np.random.rand(batch_size)) * segment
+        return self.find(values)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The dqn modules import each other by name, as when run from the dqn directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from traces import TraceWriter, TraceDataset
+
+def write_trace(path, num_transitions : int, chunk_size : int):
+    """Writes a trace whose transitions are numbered by their action."""
+    with TraceWriter(str(path), 4, action_mask_size=3, chunk_size=chunk_size) as writer:
+        for i in range(num_transitions):
+            writer.append(np.full(4, i), i, float(i), np.full(4, i + 1), i % 10 == 9, [True, False, True])
+    return writer
+
+def test_closing_writes_the_last_partial_chunk(tmp_path):
+    writer = write_trace(tmp_path, 100, chunk_size=32)
+    assert writer.transitions_written == 100
+    dataset = TraceDataset(str(tmp_path))
+    assert len(dataset) == 100
+    np.testing.assert_array_equal(dataset.chunk_lengths, [32, 32, 32, 4])
+
+@pytest.mark.parametrize("chunk_size, batch_size, shuffle_chunks", [(7, 8, 3), (32, 10, 1), (5, 64, 4), (100, 16, 2)])
+def test_every_epoch_yields_every_transition_once(tmp_path, chunk_size, batch_size, shuffle_chunks):
+    write_trace(tmp_path, 100, chunk_size)
+    dataset = TraceDataset(str(tmp_path))
+    rng = np.random.default_rng(0)
+    for _ in range(3):
+        actions = []
+        for states, batch_actions, rewards, next_states, dones, next_masks in dataset.batches(batch_size, shuffle_chunks, rng):
+            assert len(batch_actions) == batch_size
+            # Columns stay aligned through the shuffle
+            np.testing.assert_array_equal(states[:, 0], batch_actions)
+            np.testing.assert_array_equal(rewards, batch_actions)
+            np.testing.assert_array_equal(next_states[:, 0], batch_actions + 1)
+            np.testing.assert_array_equal(dones, batch_actions % 10 == 9)
+            assert next_masks.shape == (batch_size, 3)
+            actions.extend(batch_actions.tolist())
+        # Only a final partial batch is left out
+        assert len(actions) == len(set(actions)) == 100 - 100 % batch_size
@@ -0,0 +1,215 @@
+"""Recording of transitions to disk, and offline training from the recordings.
+
+A trace is a directory of chunks, each holding a fixed number of transitions
+(the last may hold fewer) as one .npy file per column:
+
+    metadata.json   The observation size, action mask size and dtype
+    chunk_000000/   state.npy, action.npy, reward.npy, next_state.npy,
+    chunk_000001/   done.npy and (with action masks) next_mask.npy
+    ...
+
+Transitions are appended to an in-memory chunk, which is only written once it
+is full, so recording costs one row copy per transition. Chunks are written
+to a temporary directory and then renamed, so a trace never holds a partial
+chunk, and new runs can append more chunks to an existing trace.
+
+TraceDataset memory-maps the chunks and yields shuffled minibatches while
+only holding a few chunks in RAM at once, so DQNAgent can be trained on
+traces far larger than memory without re-simulating them.
+
+Usage: python traces.py <Trace Path> <Model Save Path> [--epochs 1] [--batch-size 64] [--shuffle-chunks 4]"""
+
+from environment.profiling import PROFILER
+from typing import TYPE_CHECKING
+import numpy as np
+import argparse
+import json
+import os
+
+if TYPE_CHECKING:
+    from dqn_agent import DQNAgent
+
+# The columns every chunk holds, besides next_mask
+COLUMNS = ("state", "action", "reward", "next_state", "done")
+
+WRITE_TIMER = PROFILER.timer("traces.write_chunk")
+
+def _chunk_names(path: str) -> list:
+    return sorted(name for name in os.listdir(path) if name.startswith("chunk_") and not name.endswith(".tmp"))
+
+class TraceWriter:
+    """Appends transitions to the trace in a directory, creating it if it
+    doesn't exist. Appending to an existing trace requires the same
+    observation size, action mask size and dtype.
+
+    Only full chunks are written as transitions are appended, so the writer
+    must be closed (or used as a context manager) to write the last chunk,
+    or the transitions in it are lost."""
+    def __init__(self, path: str, observation_space: int, action_mask_size: int | None = None,
+                 chunk_size: int = 65_536, dtype=np.float32, max_nodes: int | None = None):
+        assert chunk_size > 0, "Chunks must hold at least 1 transition"
+        self.path = path
+        self.chunk_size = chunk_size
+        self.metadata = {
+            "observation_space": observation_space,
+            "action_mask_size": action_mask_size,
+            "dtype": np.dtype(dtype).name,
+            # The size of padded observations, if they were recorded
+            "max_nodes": max_nodes
+        }
+        metadata_path = os.path.join(path, "metadata.json")
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                assert json.load(f) == self.metadata, "Trace was recorded with different observations or actions"
+        else:
+            os.makedirs(path, exist_ok=True)
+            with open(metadata_path, "w") as f:
+                json.dump(self.metadata, f)
+        self.num_chunks = len(_chunk_names(path))
+        self.transitions_written = 0
+
+        self.columns = {
+            "state": np.zeros((chunk_size, observation_space), dtype=dtype),
+            "action": np.zeros(chunk_size, dtype=np.int32),
+            "reward": np.zeros(chunk_size, dtype=np.float32),
+            "next_state": np.zeros((chunk_size, observation_space), dtype=dtype),
+            "done": np.zeros(chunk_size, dtype=np.int8)
+        }
+        if action_mask_size is not None:
+            self.columns["next_mask"] = np.ones((chunk_size, action_mask_size), dtype=np.bool_)
+        # The number of transitions in the current chunk
+        self.size = 0
+
+    def append(self, state, action, reward, next_state, done, next_mask=None):
+        """Records a transition. Without a next state action mask, every
+        action is taken to be allowed."""
+        i = self.size
+        self.columns["state"][i] = state
+        self.columns["action"][i] = action
+        self.columns["reward"][i] = reward
+        self.columns["next_state"][i] = next_state
+        self.columns["done"][i] = done
+        if "next_mask" in self.columns:
+            self.columns["next_mask"][i] = True if next_mask is None else next_mask
+        self.size += 1
+        if self.size == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the transitions recorded since the last chunk as a chunk."""
+        if self.size == 0:
+            return
+        with WRITE_TIMER:
+            name = f"chunk_{self.num_chunks:06d}"
+            temporary_path = os.path.join(self.path, name + ".tmp")
+            os.makedirs(temporary_path, exist_ok=True)
+            for column, array in self.columns.items():
+                np.save(os.path.join(temporary_path, f"{column}.npy"), array[:self.size])
+            os.replace(temporary_path, os.path.join(self.path, name))
+        self.num_chunks += 1
+        self.transitions_written += self.size
+        self.size = 0
+
+    def close(self):
+        """Writes any transitions recorded since the last chunk."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+class TraceDataset:
+    """Reads a trace written by TraceWriter, with every chunk memory-mapped
+    rather than loaded."""
+    def __init__(self, path: str):
+        with open(os.path.join(path, "metadata.json")) as f:
+            self.metadata = json.load(f)
+        self.observation_space = self.metadata["observation_space"]
+        self.action_mask_size = self.metadata["action_mask_size"]
+        columns = COLUMNS if self.action_mask_size is None else COLUMNS + ("next_mask",)
+        self.chunks = [
+            {column: np.load(os.path.join(path, name, f"{column}.npy"), mmap_mode="r") for column in columns}
+            for name in _chunk_names(path)
+        ]
+        self.chunk_lengths = np.array([len(chunk["action"]) for chunk in self.chunks], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return int(self.chunk_lengths.sum())
+
+    def batches(self, batch_size: int = 64, shuffle_chunks: int = 4, rng: np.random.Generator | None = None):
+        """Yields one epoch of minibatches of (states, actions, rewards,
+        next_states, dones, next_masks), with dones stored as 1 for
+        transitions that ended an episode and next_masks None without action
+        masks.
+
+        The order of the chunks is shuffled, and shuffle_chunks chunks at a
+        time are read into memory and shuffled together. Transitions left
+        over from one group are carried into the next, so every transition is
+        yielded except a final partial batch."""
+        assert batch_size > 0 and shuffle_chunks > 0, "Batches and shuffle groups can't be empty"
+        if rng is None:
+            rng = np.random.default_rng()
+        order = rng.permutation(len(self.chunks))
+        leftover = None
+        for start in range(0, len(order), shuffle_chunks):
+            group = [self.chunks[i] for i in order[start:start + shuffle_chunks]]
+            columns = {
+                column: np.concatenate(([leftover[column]] if leftover is not None else [])
+                                       + [chunk[column] for chunk in group])
+                for column in group[0]
+            }
+            indices = rng.permutation(len(columns["action"]))
+            num_batches = len(indices) // batch_size
+            for b in range(num_batches):
+                batch = indices[b * batch_size:(b + 1) * batch_size]
+                yield (columns["state"][batch], columns["action"][batch], columns["reward"][batch],
+                       columns["next_state"][batch], columns["done"][batch],
+                       columns["next_mask"][batch] if "next_mask" in columns else None)
+            rest = indices[num_batches * batch_size:]
+            leftover = {column: array[rest] for column, array in columns.items()}
+
+def train_offline(agent: "DQNAgent", dataset: TraceDataset, epochs: int = 1, batch_size: int = 64,
+                  shuffle_chunks: int = 4, seed=None) -> int:
+    """Trains the agent on every transition of a trace for a number of
+    epochs, without storing them in its replay buffer. Returns the number of
+    gradient steps taken."""
+    rng = np.random.default_rng(seed)
+    steps = 0
+    for epoch in range(epochs):
+        for states, actions, rewards, next_states, dones, next_masks in dataset.batches(batch_size, shuffle_chunks, rng):
+            # The agent's networks take dones as 0 for transitions that ended an
+            # episode, as the replay buffer stores them
+            agent.train_on_batch(states, actions, rewards, next_states, 1 - dones, next_masks)
+            steps += 1
+            PROFILER.step()
+        print(f"Finished epoch {epoch + 1} after {steps} train steps")
+    return steps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains a DQN agent offline on a recorded trace.")
+    parser.add_argument("trace_path", help="Directory of the trace to train on")
+    parser.add_argument("model_save_path", help="Path to save the trained model to")
+    parser.add_argument("--epochs", type=int, default=1, help="Number of passes over the trace")
+    parser.add_argument("--batch-size", type=int, default=64, help="Number of transitions in each minibatch")
+    parser.add_argument("--shuffle-chunks", type=int, default=4,
+                        help="Number of chunks read into memory and shuffled together")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the shuffling")
+    args = parser.parse_args()
+    assert args.epochs > 0, "Need at least 1 epoch"
+
+    dataset = TraceDataset(args.trace_path)
+    assert len(dataset) >= args.batch_size, "Trace holds fewer transitions than a batch"
+    print(f"Training on {len(dataset)} transitions from {len(dataset.chunks)} chunks")
+    from dqn_agent import DQNAgent
+    if dataset.metadata["max_nodes"] is not None:
+        agent = DQNAgent(max_nodes=dataset.metadata["max_nodes"])
+    else:
+        # Unpadded observations hold two values for the module and each node
+        agent = DQNAgent(observation_space=dataset.observation_space,
+                         action_space=dataset.action_mask_size or dataset.observation_space // 2 - 1)
+    agent.batch_size = args.batch_size
+    train_offline(agent, dataset, args.epochs, args.batch_size, args.shuffle_chunks, args.seed)
+    agent.q_net.save(args.model_save_path)
+    print(f"Saved model to {args.model_save_path}")
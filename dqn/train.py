@@ -2,40 +2,158 @@
 gameplay experiences and using them to improve results."""
 
 from environment.envs.application_placement_env import ApplicationPlacementEnv
+from environment.envs.vector_application_placement_env import VectorApplicationPlacementEnv
+from environment.module_stream import Poisson_Arrivals, Trace_Arrivals
 import gymnasium as gym
 from gymnasium.wrappers.flatten_observation import FlattenObservation
 import environment
-from dqn_agent import DQNAgent
 from replay_buffer import ReplayBuffer
-import asyncio
-import keras
-import sys
+from numpy_dqn import export_weights
+from actor_learner import train_distributed
+from checkpoint import Checkpointer, load_checkpoint
+from heuristics import HEURISTICS, prefill_replay_buffer
+from traces import TraceWriter
+from environment.profiling import PROFILER
+from typing import TYPE_CHECKING
+import numpy as np
+import argparse
+import time
+
+# TensorFlow is only imported once training starts. Actor processes re-import
+# this module when they are spawned, and they shouldn't import TensorFlow.
+if TYPE_CHECKING:
+    from dqn_agent import DQNAgent
 
 MODEL_PATH = "model.keras"
 
-async def train(render: bool, num_episodes: int, model_save_path: str):
-    agent = DQNAgent()
+# Timers for the phases of the training loops (see environment.profiling)
+POLICY_TIMER = PROFILER.timer("train.policy")
+ENV_STEP_TIMER = PROFILER.timer("train.env_step")
+STORE_TIMER = PROFILER.timer("train.store")
+TRAIN_TIMER = PROFILER.timer("train.agent_train")
+
+class UpdateScheduler:
+    """Decides when the agent trains during a training loop. Training happens
+    in rounds of gradient_steps gradient steps, either:
+    - every train_every environment steps, or
+    - with train_fraction set, whenever the time spent training is below that
+      fraction of the wall time since the replay buffer could first be
+      trained on, so training keeps pace with however fast the environment
+      runs"""
+    def __init__(self, train_every: int = 1, gradient_steps: int = 1, train_fraction: float | None = None):
+        assert train_every >= 1, "Training must be at least every environment step"
+        assert gradient_steps >= 1, "Rounds need at least 1 gradient step"
+        assert train_fraction is None or 0 < train_fraction < 1, "Training fraction must be between 0 and 1"
+        self.train_every = train_every
+        self.gradient_steps = gradient_steps
+        self.train_fraction = train_fraction
+        # Environment steps since the last round
+        self.env_steps = 0
+        self.train_time = 0.0
+        self.start_time = None
+
+    def step(self, agent: "DQNAgent", env_steps: int = 1):
+        """Records env_steps environment steps and trains the agent for any
+        rounds that are due."""
+        if agent.replay_buffer.pointer < agent.batch_size:
+            PROFILER.count("agent.train_skipped")
+            return
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        self.env_steps += env_steps
+        rounds = self.env_steps // self.train_every
+        self.env_steps -= rounds * self.train_every
+        with TRAIN_TIMER:
+            if self.train_fraction is None:
+                for _ in range(rounds * self.gradient_steps):
+                    agent.train()
+            else:
+                # Rounds continue until training has caught up with its share
+                # of the wall time
+                while self.train_time < self.train_fraction * (now - self.start_time):
+                    for _ in range(self.gradient_steps):
+                        agent.train()
+                    previous, now = now, time.perf_counter()
+                    self.train_time += now - previous
+
+def train(render: bool, num_episodes: int, model_save_path: str, real_time: bool = False, num_envs: int = 1,
+          replay_buffer: ReplayBuffer | None = None, num_workers: int = 0, max_nodes: int | None = None,
+          record_path: str | None = None, frame_skip: int = 0, checkpointer: Checkpointer | None = None,
+          resume_path: str | None = None, network_model: bool = False, trace_writer: TraceWriter | None = None,
+          scheduler: UpdateScheduler | None = None, dag_max_parents: int | None = None,
+          critical_path_weight: float = 0.0, arrivals=None, stream_length: int | None = None,
+          stream_capacity: int = 1_024):
+    """Trains a new agent for num_episodes episodes. With a checkpointer, the
+    full training state is checkpointed in the background as training goes,
+    and resume_path continues training from such a checkpoint. With a trace
+    writer, every transition is also recorded to a trace (see traces.py).
+    The scheduler decides when the agent trains, by default once per
+    environment step (or per step of every sub-environment). Setting
+    dag_max_parents trains on applications with dependencies between their
+    modules (see environment.application_dag), and setting arrivals trains on
+    streams of modules instead (see environment.module_stream)."""
+    if num_workers > 0:
+        return train_distributed(num_workers, num_episodes, model_save_path, num_envs, replay_buffer,
+                                 checkpointer, resume_path)
+    from dqn_agent import DQNAgent
+    agent = DQNAgent(replay_buffer=replay_buffer, max_nodes=max_nodes)
+    if scheduler is None:
+        scheduler = UpdateScheduler(num_envs)
+    if num_envs > 1:
+        train_vector(agent, num_envs, num_episodes, model_save_path, checkpointer, resume_path, trace_writer, scheduler)
+        return agent
     if render:
-        env = ApplicationPlacementEnv(render_mode="human")
+        env = ApplicationPlacementEnv(render_mode="human", real_time=real_time, max_nodes=max_nodes,
+                                      record_path=record_path, frame_skip=frame_skip, network_model=network_model,
+                                      dag_max_parents=dag_max_parents, critical_path_weight=critical_path_weight,
+                                      backend="objects" if arrivals is None else "arrays", arrivals=arrivals,
+                                      stream_length=stream_length, stream_capacity=stream_capacity)
     else:
-        env = ApplicationPlacementEnv()
+        env = ApplicationPlacementEnv(real_time=real_time, max_nodes=max_nodes,
+                                      record_path=record_path, frame_skip=frame_skip, network_model=network_model,
+                                      dag_max_parents=dag_max_parents, critical_path_weight=critical_path_weight,
+                                      backend="objects" if arrivals is None else "arrays", arrivals=arrivals,
+                                      stream_length=stream_length, stream_capacity=stream_capacity)
     total_reward = 0
+    start_episode = 0
+    if resume_path is not None:
+        progress = load_checkpoint(resume_path, agent, env.np_random)
+        start_episode = progress["episodes_finished"]
+        total_reward = progress["total_reward"]
+        print(f"Resumed training from {resume_path} after {start_episode} episodes")
     try:
-        for s in range(num_episodes):
+        for s in range(start_episode, num_episodes):
             print(f"Training Episode: {s + 1}")
             done = False
-            state, _ = env.reset()
+            state, info = env.reset()
             episode_reward = 0
             while not done:
-                action = agent.policy(state)
-                next_state, reward, done, _, _ = await env.step(action)
+                # Only placements that fit in memory are chosen
+                with POLICY_TIMER:
+                    action = agent.policy(state, info["action_mask"])
+                with ENV_STEP_TIMER:
+                    next_state, reward, done, _, info = env.step(action)
                 if next_state is not None:
-                    agent.store_experience(state, action, reward, next_state, done)
-                    agent.train()
+                    with STORE_TIMER:
+                        agent.store_experience(state, action, reward, next_state, done, info["action_mask"])
+                        if trace_writer is not None:
+                            trace_writer.append(state, action, reward, next_state, done, info["action_mask"])
+                    scheduler.step(agent)
                     state = next_state
                     episode_reward += reward
+                PROFILER.step()
             total_reward += episode_reward
             print(f"Reward for episode {s + 1} is {episode_reward} and epsilon is {agent.epsilon}")
+            if arrivals is not None:
+                stats = env.stream_statistics()
+                print(f"Stream throughput was {stats['throughput']:.2f} modules/s, with {stats['mean_waiting']:.2f} "
+                      f"waiting on average and {stats['dropped']} of {stats['arrived']} arrivals dropped")
+            # Checkpoints are only taken between episodes, so resuming from
+            # one continues with the next episode the run would have played
+            if checkpointer is not None:
+                checkpointer.maybe_save(agent, {"episodes_finished": s + 1, "total_reward": total_reward},
+                                        env.np_random)
     except KeyboardInterrupt:
         print("Training interrupted")
         agent.q_net.save(model_save_path)
@@ -45,14 +163,210 @@ async def train(render: bool, num_episodes: int, model_save_path: str):
         print(f"Average reward is {total_reward / num_episodes}")
         agent.q_net.save(model_save_path)
         print(f"Saved model to {model_save_path}")
+        if checkpointer is not None:
+            checkpointer.save(agent, {"episodes_finished": num_episodes, "total_reward": total_reward},
+                              env.np_random, wait=True)
+    # Waits for the render thread to finish drawing any recorded frames
+    env.close()
+    return agent
 
-if __name__ == '__main__':
-    if len(sys.argv) == 4:
-        render = sys.argv[1]
-        assert render == "h" or render == "n", "Render mode must be 'h' (human) or 'n' (none)"
-        render = True if render == "h" else False
-        num_episodes = int(sys.argv[2])
-        assert num_episodes > 0, "Number of episodes must be at least 1"
-        asyncio.run(train(render, num_episodes, sys.argv[3]))
+def train_vector(agent: "DQNAgent", num_envs: int, num_episodes: int, model_save_path: str,
+                 checkpointer: Checkpointer | None = None, resume_path: str | None = None,
+                 trace_writer: TraceWriter | None = None, scheduler: UpdateScheduler | None = None):
+    """Trains the agent on a vector environment of num_envs sub-environments.
+    Actions for every sub-environment are chosen with a single call to the DQN,
+    each step's transitions are stored as one batch, and the agent is trained
+    once per batch of num_envs transitions unless a scheduler says otherwise.
+
+    Sub-environments are never all between episodes at once, so the episodes
+    in progress when a checkpoint is taken are replayed from new scenarios
+    when resuming from it."""
+    envs = VectorApplicationPlacementEnv(num_envs)
+    if scheduler is None:
+        scheduler = UpdateScheduler(num_envs)
+    streams = range(num_envs)
+    total_reward = 0
+    episodes_finished = 0
+    if resume_path is not None:
+        progress = load_checkpoint(resume_path, agent, envs.np_random)
+        episodes_finished = progress["episodes_finished"]
+        total_reward = progress["total_reward"]
+        print(f"Resumed training from {resume_path} after {episodes_finished} episodes")
+    try:
+        states, infos = envs.reset()
+        episode_rewards = [0.0] * num_envs
+        while episodes_finished < num_episodes:
+            with POLICY_TIMER:
+                actions = agent.policy_batch(states, infos["action_mask"])
+            with ENV_STEP_TIMER:
+                next_states, rewards, dones, _, infos = envs.step(actions)
+            # Sub-environments that terminated have already been reset, so their
+            # real next states are the final states
+            final_states = infos["final_states"]
+            # The masks of terminated sub-environments belong to their reset
+            # state, but terminal experiences don't use the next state's mask
+            with STORE_TIMER:
+                agent.store_batch(states, actions, rewards, final_states, dones, infos["action_mask"], streams)
+            for i in range(num_envs):
+                if trace_writer is not None:
+                    trace_writer.append(states[i], actions[i], rewards[i], final_states[i], dones[i], infos["action_mask"][i])
+                episode_rewards[i] += rewards[i]
+                if dones[i]:
+                    episodes_finished += 1
+                    total_reward += episode_rewards[i]
+                    print(f"Reward for episode {episodes_finished} is {episode_rewards[i]} and epsilon is {agent.epsilon}")
+                    episode_rewards[i] = 0.0
+            scheduler.step(agent, num_envs)
+            states = next_states
+            if checkpointer is not None:
+                checkpointer.maybe_save(agent, {"episodes_finished": episodes_finished, "total_reward": total_reward},
+                                        envs.np_random)
+            PROFILER.step()
+    except KeyboardInterrupt:
+        print("Training interrupted")
     else:
-        print("Please provide arguments: <Render mode> <# Episodes> <Model save path>")
\ No newline at end of file
+        print(f"Total reward for {episodes_finished} episodes is {total_reward}.")
+        print(f"Average reward is {total_reward / episodes_finished}")
+        if checkpointer is not None:
+            checkpointer.save(agent, {"episodes_finished": episodes_finished, "total_reward": total_reward},
+                              envs.np_random, wait=True)
+    agent.q_net.save(model_save_path)
+    print(f"Saved model to {model_save_path}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Trains the DQN agent.")
+    parser.add_argument("render", choices=["h", "n"], help="Render mode: 'h' (human) or 'n' (none)")
+    parser.add_argument("num_episodes", type=int, help="Number of episodes to train for")
+    parser.add_argument("model_save_path", help="Path to save the trained model to")
+    parser.add_argument("--real-time", action="store_true",
+                        help="Process modules in real time instead of on a virtual clock")
+    parser.add_argument("--num-envs", type=int, default=1,
+                        help="Number of environments stepped together in a vector environment (per worker)")
+    parser.add_argument("--num-workers", type=int, default=0,
+                        help="Number of actor processes collecting experiences for a separate learner")
+    parser.add_argument("--buffer-storage", choices=["separate", "compact"], default="separate",
+                        help="Whether the replay buffer stores each observation once ('compact') or twice")
+    parser.add_argument("--buffer-dtype", choices=["float16", "float32"], default="float32",
+                        help="Data type the replay buffer stores observations with")
+    parser.add_argument("--buffer-path", default=None,
+                        help="Directory to memory-map the replay buffer in, instead of holding it in RAM")
+    parser.add_argument("--buffer-size", type=int, default=100_000, help="Capacity of the replay buffer")
+    parser.add_argument("--n-step", type=int, default=1,
+                        help="Train on n-step returns, accumulated as experiences are stored (needs separate storage)")
+    parser.add_argument("--export-weights", default=None,
+                        help="Also export the trained weights to this .npz file for NumPy-only inference")
+    parser.add_argument("--max-nodes", type=int, default=None,
+                        help="Train on topologies of varying size, with observations padded to this many nodes")
+    parser.add_argument("--record", default=None,
+                        help="Stream rendered frames to this frame file (see environment.renderer)")
+    parser.add_argument("--frame-skip", type=int, default=0,
+                        help="Number of steps skipped between rendered or recorded frames")
+    parser.add_argument("--profile", default=None,
+                        help="Time the phases of training and dump their statistics to this .csv or .json file")
+    parser.add_argument("--profile-every", type=int, default=10_000,
+                        help="Number of steps between dumps of the profiling statistics")
+    parser.add_argument("--cprofile", default=None,
+                        help="Capture a cProfile of a window of training steps and save its stats to this file")
+    parser.add_argument("--cprofile-start", type=int, default=1_000, help="Step the cProfile window starts at")
+    parser.add_argument("--cprofile-steps", type=int, default=1_000, help="Number of steps the cProfile window covers")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Directory to periodically checkpoint the full training state to (see checkpoint.py)")
+    parser.add_argument("--checkpoint-every", type=int, default=1_000,
+                        help="Number of train steps between checkpoints")
+    parser.add_argument("--resume", default=None, help="Checkpoint directory to resume training from")
+    parser.add_argument("--network-model", action="store_true",
+                        help="Include the transfer time of module input data over a SAGIN link model")
+    parser.add_argument("--dag-max-parents", type=int, default=None,
+                        help="Generate dependencies between modules, with up to this many parents per module")
+    parser.add_argument("--critical-path-weight", type=float, default=0.0,
+                        help="Weight processing time in the reward by how much of the critical path is left at each module")
+    parser.add_argument("--arrival-rate", type=float, default=None,
+                        help="Stream modules arriving as a Poisson process of this many modules per simulated second")
+    parser.add_argument("--arrival-trace", default=None,
+                        help="Stream modules arriving as recorded in this trace directory (see environment.module_stream)")
+    parser.add_argument("--stream-length", type=int, default=1_000,
+                        help="Number of streamed modules per episode (trace streams also end with their trace)")
+    parser.add_argument("--stream-capacity", type=int, default=1_024,
+                        help="Number of streamed modules that can be in the system at once before arrivals are dropped")
+    parser.add_argument("--prefill", choices=list(HEURISTICS), default=None,
+                        help="Pre-fill the replay buffer with demonstrations from this heuristic (see heuristics.py)")
+    parser.add_argument("--prefill-episodes", type=int, default=1_000,
+                        help="Number of heuristic episodes to pre-fill the replay buffer with")
+    parser.add_argument("--train-every", type=int, default=None,
+                        help="Number of environment steps between training rounds (default: one step of every environment)")
+    parser.add_argument("--gradient-steps", type=int, default=1, help="Number of gradient steps in each training round")
+    parser.add_argument("--train-fraction", type=float, default=None,
+                        help="Instead of training every few steps, train whenever training has used less than this fraction of the wall time")
+    parser.add_argument("--trace", default=None,
+                        help="Directory to record every transition to as a trace for offline training (see traces.py)")
+    args = parser.parse_args()
+    assert args.num_episodes > 0, "Number of episodes must be at least 1"
+    assert args.num_envs > 0, "Need at least 1 environment"
+    assert args.num_envs == 1 or not (args.render == "h" or args.real_time), \
+        "Vector environments only support the virtual clock without rendering"
+    assert args.num_workers >= 0, "Number of workers can't be negative"
+    assert args.num_workers == 0 or not (args.render == "h" or args.real_time), \
+        "Actor processes only support the virtual clock without rendering"
+    assert args.max_nodes is None or (args.num_envs == 1 and args.num_workers == 0 and not args.real_time), \
+        "Varying topology sizes are only supported by a single environment on the virtual clock"
+    assert args.record is None or (args.num_envs == 1 and args.num_workers == 0), \
+        "Frames can only be recorded from a single environment"
+    assert not args.network_model or (args.num_envs == 1 and args.num_workers == 0 and not args.real_time), \
+        "The network model is only supported by a single environment on the virtual clock"
+    assert args.dag_max_parents is None or (args.num_envs == 1 and args.num_workers == 0 and not args.real_time), \
+        "Dependencies are only supported by a single environment on the virtual clock"
+    assert args.arrival_rate is None or args.arrival_trace is None, "Streams have one arrival process"
+    streaming = args.arrival_rate is not None or args.arrival_trace is not None
+    assert not streaming or (args.num_envs == 1 and args.num_workers == 0 and not args.real_time
+                             and args.dag_max_parents is None and args.prefill is None), \
+        "Streams are only supported by a single environment on the virtual clock, without dependencies or demonstrations"
+    assert args.prefill is None or (args.max_nodes is None and not args.network_model and args.dag_max_parents is None
+                                    and args.resume is None), \
+        "Heuristic demonstrations are only generated for fixed topologies of independent modules without the network model, and not on resume"
+    assert args.trace is None or args.num_workers == 0, "Traces can't be recorded from actor processes"
+    assert args.num_workers == 0 or (args.train_every is None and args.gradient_steps == 1 and args.train_fraction is None), \
+        "The learner trains continuously while actors collect experiences"
+    if args.profile is not None or args.cprofile is not None:
+        PROFILER.configure(dump_path=args.profile, dump_every=args.profile_every, cprofile_path=args.cprofile,
+                           cprofile_start=args.cprofile_start, cprofile_steps=args.cprofile_steps)
+    from dqn_agent import OBSERVATION_SPACE, ACTION_SPACE
+    from environment.envs.application_placement_env import PADDED_ROW_SIZE
+    observation_space = OBSERVATION_SPACE if args.max_nodes is None else PADDED_ROW_SIZE * (args.max_nodes + 1)
+    action_space = ACTION_SPACE if args.max_nodes is None else args.max_nodes
+    replay_buffer = ReplayBuffer(observation_space, buffer_size=args.buffer_size, storage=args.buffer_storage,
+                                 dtype=args.buffer_dtype, storage_path=args.buffer_path, action_mask_size=action_space,
+                                 n_step=args.n_step)
+    if args.prefill is not None:
+        stored = prefill_replay_buffer(replay_buffer, args.prefill, args.prefill_episodes)
+        print(f"Pre-filled the replay buffer with {stored} {args.prefill} transitions")
+    checkpointer = Checkpointer(args.checkpoint, args.checkpoint_every) if args.checkpoint is not None else None
+    trace_writer = None
+    if args.trace is not None:
+        trace_writer = TraceWriter(args.trace, observation_space, action_space, max_nodes=args.max_nodes)
+    scheduler = UpdateScheduler(args.train_every or args.num_envs, args.gradient_steps, args.train_fraction)
+    arrivals = None
+    if args.arrival_rate is not None:
+        arrivals = Poisson_Arrivals(args.arrival_rate)
+    elif args.arrival_trace is not None:
+        arrivals = Trace_Arrivals.load(args.arrival_trace)
+    agent = train(args.render == "h", args.num_episodes, args.model_save_path, args.real_time, args.num_envs,
+                  replay_buffer, args.num_workers, args.max_nodes, args.record, args.frame_skip,
+                  checkpointer, args.resume, args.network_model, trace_writer, scheduler, args.dag_max_parents,
+                  args.critical_path_weight, arrivals, args.stream_length, args.stream_capacity)
+    if trace_writer is not None:
+        trace_writer.close()
+        print(f"Recorded {trace_writer.transitions_written} transitions to {args.trace}")
+    if checkpointer is not None:
+        # Waits for the last checkpoint to be written
+        checkpointer.close()
+        print(f"Saved {checkpointer.checkpoints_written} checkpoints to {args.checkpoint}")
+    if args.export_weights is not None:
+        export_weights(agent.q_net, args.export_weights)
+        print(f"Exported weights to {args.export_weights}")
+    PROFILER.close()
+    if args.profile is not None:
+        print(f"Saved profiling statistics to {args.profile}")
+    if args.buffer_path is not None:
+        # Writes the metadata needed to reload the memory-mapped buffer
+        replay_buffer.save(args.buffer_path)
+        print(f"Saved replay buffer to {args.buffer_path}")
@@ -0,0 +1,181 @@
+"""Data dependencies between the modules of an application, as a directed
+acyclic graph (DAG).
+
+An edge (parent, child) means the child takes the parent's output as input,
+so it can only be placed once the parent has finished. Edges are stored in
+compressed sparse row (CSR) form, as one flat array of the successors (and
+one of the parents) of every module with offsets into it, so a graph of
+thousands of modules is a handful of NumPy arrays.
+
+Each module has a counter of its unfinished parents, which is decremented
+when a parent finishes. Modules whose counter reaches 0 are appended to the
+ready queue. Every module becomes ready, and is placed, exactly once, so the
+queue is a single array with head and tail indices: order[:head] holds the
+modules in the order they were placed and order[head:tail] the ready set.
+Finding the next module to place is O(1), and finishing a module costs
+O(number of successors).
+
+The critical path of each module (the most instructions along any chain of
+dependencies starting at it, itself included) is computed once per DAG,
+level by level in reverse topological order, with one vectorized pass per
+level."""
+
+import numpy as np
+
+def generate_dag(rng : np.random.Generator, num_modules : int, max_parents : int = 2) -> tuple[np.ndarray, np.ndarray]:
+    """Generates random dependencies between num_modules modules, returned as
+    arrays of the parent and child of each edge. Each module takes input from
+    between 0 and max_parents modules before it, so the module indices are a
+    topological order. Duplicate edges are removed by Application_Dag."""
+    indices = np.arange(num_modules)
+    # Module 0 has no modules before it to depend on
+    num_parents = np.minimum(rng.integers(0, max_parents, num_modules, endpoint=True), indices)
+    children = np.repeat(indices, num_parents)
+    parents = (rng.random(len(children)) * children).astype(np.int64)
+    return parents, children
+
+def _gather(offsets : np.ndarray, targets : np.ndarray, nodes : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the edges of the given nodes in a CSR graph, as the position of
+    each edge's node within nodes and each edge's target."""
+    starts = offsets[nodes]
+    counts = offsets[nodes + 1] - starts
+    segments = np.repeat(np.arange(len(nodes)), counts)
+    # The position of every edge in targets: its node's start plus its rank
+    # among that node's edges
+    ranks = np.arange(len(segments)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return segments, targets[starts[segments] + ranks]
+
+def _csr(sources : np.ndarray, targets : np.ndarray, num_nodes : int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the offsets and targets of a CSR graph with the given edges."""
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=offsets[1:])
+    return offsets, targets[order]
+
+class Application_Dag:
+    """The dependencies between an application's modules, with the ready set
+    of modules whose parents have all finished."""
+    def __init__(self, num_modules : int, parents, children, module_instructions):
+        parents = np.asarray(parents, dtype=np.int64)
+        children = np.asarray(children, dtype=np.int64)
+        assert parents.shape == children.shape, "Every edge needs a parent and a child"
+        assert len(parents) == 0 or (min(parents.min(), children.min()) >= 0
+                                     and max(parents.max(), children.max()) < num_modules), \
+            "Dependencies refer to modules that don't exist"
+        # A duplicate edge would be counted twice in its child's counter, but
+        # only decremented once
+        edges = np.unique(parents * num_modules + children)
+        parents, children = edges // num_modules, edges % num_modules
+        self.num_modules = num_modules
+        self.num_edges = len(edges)
+
+        # The successors and parents of module i are successors[successor_offsets[i]:successor_offsets[i + 1]]
+        # and parents[parent_offsets[i]:parent_offsets[i + 1]]
+        self.successor_offsets, self.successors = _csr(parents, children, num_modules)
+        self.parent_offsets, self.parents = _csr(children, parents, num_modules)
+        self.in_degree = np.diff(self.parent_offsets)
+
+        self.levels = self._levels()
+        assert sum(len(level) for level in self.levels) == num_modules, "Dependencies must form a DAG"
+        self.critical_path = self._critical_paths(np.asarray(module_instructions, dtype=np.float64))
+        # The longest chain of instructions in the application, which bounds
+        # its makespan from below on a single node of a given speed
+        self.critical_path_length = float(self.critical_path.max()) if num_modules > 0 else 0.0
+        # The share of the application's critical path left at each module, in
+        # (0, 1], as a measure of how much delaying it delays the application
+        self.criticality = self.critical_path / max(self.critical_path_length, 1.0)
+
+        # The number of unfinished parents of each module
+        self.remaining = self.in_degree.copy()
+        # Modules in the order they became ready: placed before head, ready
+        # from head to tail
+        self.order = np.zeros(num_modules, dtype=np.int64)
+        self.head = 0
+        self.tail = 0
+        self._push(self.levels[0] if len(self.levels) > 0 else np.zeros(0, dtype=np.int64))
+        # The node each placed module was placed on, which holds its output data
+        # (-1 if it hasn't been placed)
+        self.module_node = np.full(num_modules, -1, dtype=np.int64)
+        self.num_finished = 0
+
+    def _levels(self) -> list:
+        """Returns the modules grouped by their depth in the DAG (the modules
+        without parents, then the modules whose parents are all in the first
+        level, and so on), using Kahn's algorithm on whole levels at once.
+        Modules on a cycle are never reached."""
+        remaining = self.in_degree.copy()
+        frontier = np.flatnonzero(remaining == 0)
+        levels = []
+        while len(frontier) > 0:
+            levels.append(frontier)
+            _, successors = _gather(self.successor_offsets, self.successors, frontier)
+            np.subtract.at(remaining, successors, 1)
+            successors = successors[remaining[successors] == 0]
+            frontier = np.unique(successors)
+        return levels
+
+    def _critical_paths(self, module_instructions : np.ndarray) -> np.ndarray:
+        """Returns the critical path of every module, from the deepest level
+        up, as every successor of a module is in a deeper level."""
+        critical_path = np.zeros(self.num_modules, dtype=np.float64)
+        for level in reversed(self.levels):
+            segments, successors = _gather(self.successor_offsets, self.successors, level)
+            longest = np.zeros(len(level), dtype=np.float64)
+            np.maximum.at(longest, segments, critical_path[successors])
+            critical_path[level] = module_instructions[level] + longest
+        return critical_path
+
+    def _push(self, modules : np.ndarray):
+        self.order[self.tail:self.tail + len(modules)] = modules
+        self.tail += len(modules)
+
+    def next_ready(self):
+        """Returns the ready module that became ready first, or None if no
+        module is ready."""
+        if self.head < self.tail:
+            return int(self.order[self.head])
+        return None
+
+    def pop_ready(self, node : int) -> int:
+        """Removes the next ready module from the ready set, as it has been
+        placed on the given node, and returns it."""
+        module = int(self.order[self.head])
+        self.head += 1
+        self.module_node[module] = node
+        return module
+
+    def finish(self, module : int):
+        """Decrements the counters of a finished module's successors, and
+        makes those with no unfinished parents left ready."""
+        self.num_finished += 1
+        successors = self.successors[self.successor_offsets[module]:self.successor_offsets[module + 1]]
+        if len(successors) == 0:
+            return
+        self.remaining[successors] -= 1
+        self._push(successors[self.remaining[successors] == 0])
+
+    def parents_of(self, module : int) -> np.ndarray:
+        """Returns the modules a module takes its input data from."""
+        return self.parents[self.parent_offsets[module]:self.parent_offsets[module + 1]]
+
+    def all_done(self) -> bool:
+        return self.num_finished == self.num_modules
+
+    def get_state(self) -> dict:
+        """Returns copies of the counters and queue, which set_state restores."""
+        return {
+            "remaining": self.remaining.copy(),
+            "order": self.order[:self.tail].copy(),
+            "module_node": self.module_node.copy(),
+            "head": self.head,
+            "num_finished": self.num_finished
+        }
+
+    def set_state(self, state : dict):
+        """Restores the state of the same DAG from get_state."""
+        np.copyto(self.remaining, state["remaining"])
+        self.tail = len(state["order"])
+        self.order[:self.tail] = state["order"]
+        np.copyto(self.module_node, state["module_node"])
+        self.head = state["head"]
+        self.num_finished = state["num_finished"]
@@ -1 +1,2 @@
-from environment.envs.application_placement_env import ApplicationPlacementEnv
\ No newline at end of file
+from environment.envs.application_placement_env import ApplicationPlacementEnv, padded_node_mask
+from environment.envs.vector_application_placement_env import VectorApplicationPlacementEnv
\ No newline at end of file
@@ -1,10 +1,21 @@
 import random
 import numpy as np
 import gymnasium as gym
-import pygame as pg
 import asyncio
 from environment.application_module import Application_Module
 from environment.network_node import Network_Node
+from environment.event_queue import Event_Queue
+from environment.placement_state import Placement_State
+from environment.application_dag import Application_Dag, generate_dag
+from environment.module_stream import Streaming_State
+from environment.scenario_corpus import (
+    Scenario_Corpus, generate_modules, MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND,
+    MODULE_MEMORY_REQUIRED_LOWER_BOUND, MODULE_MEMORY_REQUIRED_UPPER_BOUND, MODULE_DATA_SIZE_LOWER_BOUND,
+    MODULE_DATA_SIZE_UPPER_BOUND
+)
+from environment.sagin_network import Sagin_Network
+from environment.profiling import PROFILER
+from environment.renderer import Render_Thread, draw_snapshot, canvas_to_rgb
 
 # These represent the lower and upper bounds on the number of
 # activity modules in the environment
@@ -16,6 +27,11 @@ NUM_MODULES_UPPER_BOUND = 15
 NUM_NODES_LOWER_BOUND = 5
 NUM_NODES_UPPER_BOUND = 5
 
+# The size of unpadded observations, which hold two values for the module and
+# each node, and the number of actions, for the most nodes a scenario can have
+OBSERVATION_SPACE = 2 * (NUM_NODES_UPPER_BOUND + 1)
+ACTION_SPACE = NUM_NODES_UPPER_BOUND
+
 # These represent the lower and upper bounds on the processing speed
 # of network nodes in Instructions Per Second (IPS)
 NODE_SPEED_LOWER_BOUND = 3_000_000_000
@@ -31,40 +47,146 @@ NODE_BANDWIDTH_UPPER_BOUND = 8_000_000
 NODE_MEMORY_LOWER_BOUND = 12_000_000
 NODE_MEMORY_UPPER_BOUND = 15_000_000
 
-# These represent the lower and upper bounds on the size of activity
-# modules in # of Instructions
-MODULE_SIZE_LOWER_BOUND = 1_500_000_000
-MODULE_SIZE_UPPER_BOUND = 2_500_000_000
-
-# These represent the lower and upper bounds on the required memory
-# of acitivy modules in Bytes
-MODULE_MEMORY_REQUIRED_LOWER_BOUND = 1_000_000
-MODULE_MEMORY_REQUIRED_UPPER_BOUND = 3_000_000
-
-# These represent the lower and upper bound on the amount of data
-# required for a module to execute in Bytes
-MODULE_DATA_SIZE_LOWER_BOUND = 200_000
-MODULE_DATA_SIZE_UPPER_BOUND = 800_000
-
 # Maximum amount of time a module is afforded for processing (seconds)
 MAXIMUM_MODULE_PROCESSING_TIME = 1
 
+# The network model routes data along the paths that are fastest for a module
+# of average data size (see Sagin_Network)
+ROUTING_DATA_SIZE = (MODULE_DATA_SIZE_LOWER_BOUND + MODULE_DATA_SIZE_UPPER_BOUND) / 2
+
+# The number of columns in each row of a padded observation: the two features
+# of the module or node, and whether the row holds a real module or node (1)
+# or padding (0)
+PADDED_ROW_SIZE = 3
+
+# Timers for the phases of a step (see environment.profiling)
+PLACE_TIMER = PROFILER.timer("env.place")
+EVENTS_TIMER = PROFILER.timer("env.process_events")
+OBS_TIMER = PROFILER.timer("env.get_obs")
+
+def generate_scenarios(rng : np.random.Generator, num_scenarios : int, num_modules : int,
+                       num_nodes : int) -> dict[str, np.ndarray]:
+    """Generates the properties of the modules and nodes of num_scenarios
+    scenarios at once, each drawn uniformly between the set bounds. Every
+    array has shape (num_scenarios, num_modules) or (num_scenarios, num_nodes)."""
+    node_shape = (num_scenarios, num_nodes)
+    return {
+        **generate_modules(rng, (num_scenarios, num_modules)),
+        "node_speed": rng.integers(NODE_SPEED_LOWER_BOUND, NODE_SPEED_UPPER_BOUND, node_shape, endpoint=True),
+        "node_bandwidth": rng.integers(NODE_BANDWIDTH_LOWER_BOUND, NODE_BANDWIDTH_UPPER_BOUND, node_shape, endpoint=True),
+        "node_memory": rng.integers(NODE_MEMORY_LOWER_BOUND, NODE_MEMORY_UPPER_BOUND, node_shape, endpoint=True)
+    }
+
+def padded_node_mask(observations) -> np.ndarray:
+    """Returns whether each node of a padded observation (or of a batch of
+    them) is a real node, i.e. a valid action."""
+    observations = np.asarray(observations)
+    rows = observations.reshape(observations.shape[:-1] + (-1, PADDED_ROW_SIZE))
+    return rows[..., 1:, 2] > 0
+
 class ApplicationPlacementEnv(gym.Env):
     """ A Gymnasium environment that represents a SAGIN via
     nodes (network devices). Modules are discrete pieces of an
     application that require processing on a node. This environment
     creates the nodes and modules and allows for modules to be placed
-    on nodes for processing. It also enforces some constraints."""
+    on nodes for processing. It also enforces some constraints.
+
+    By default the environment runs on a virtual clock: module processing is
+    simulated with a heap-based event queue and step() advances simulated time
+    instantly to the next relevant event. Setting real_time=True instead
+    processes modules with asyncio, taking real wall time.
+
+    The state is stored as Application_Module and Network_Node objects by
+    default. Setting backend="arrays" stores it in contiguous NumPy arrays
+    instead (see Placement_State), which keeps the cost of each step flat as
+    the number of modules and nodes grows.
+
+    If max_nodes is set, the number of nodes can vary between episodes (drawn
+    between min_nodes and max_nodes, unless num_nodes fixes it), and
+    observations are padded to max_nodes nodes. Each row of a padded
+    observation has a third column marking whether it holds a real module or
+    node, and placing a module on a padding node is rejected.
+
+    Rendering runs on a background thread from snapshots of the state (see
+    environment.renderer), so it doesn't slow down step. Setting record_path
+    streams the drawn frames to a compact frame file, with or without a
+    window.
+
+    The info returned by reset and step holds an "action_mask" of the nodes
+    with enough available memory for the next module. If no node has enough,
+    every real node is allowed, as a rejected placement is then the only way
+    to advance the clock.
+
+    Setting network_model=True places the nodes in a space-air-ground network
+    (see Sagin_Network) whose links change over time. Each module's input data
+    is then sent from the node the previous module was placed on (or from node
+    0 for the first module), and the module only starts once it has arrived.
+    The transfer time is looked up in O(1) and counts against the placement's
+    reward alongside the processing time.
+
+    On the virtual clock, get_state snapshots an episode mid-way as copies of
+    flat arrays (and the event heap's list), and set_state rolls the
+    environment back to such a snapshot, so planners can try many candidate
+    placements from the same state without deep-copying the environment.
+
+    Modules are independent by default. Setting dag_max_parents generates a
+    DAG of data dependencies for every scenario instead (see
+    Application_Dag), in which each module takes input from up to that many
+    earlier modules, and reset also accepts dependencies as
+    options={"dependencies": (parents, children)}. A module can then only be
+    placed once its parents have finished, the next module is the one that
+    became ready first, and the clock skips ahead while no module is ready.
+    With the network model, a module's input data is sent from its parents'
+    nodes in equal shares. Setting critical_path_weight weights the processing
+    time in a placement's reward by 1 + critical_path_weight times the share
+    of the application's critical path left at the module.
+
+    Setting arrivals (a Poisson_Arrivals or Trace_Arrivals, see
+    environment.module_stream) streams modules instead of generating a fixed
+    set at reset. Modules arrive on the virtual clock and are placed in the
+    order they arrived, into stream_capacity recycled slots (arrivals that find
+    every slot in use are dropped). While no node has room for the waiting
+    module, the clock skips ahead until a module finishes and frees enough
+    memory. The episode ends once stream_length modules have arrived and
+    finished, or never if it is None. Streams require the arrays backend.
+    Their throughput, queue length and latency statistics are returned by
+    stream_statistics.
+
+    Scenarios are generated from the environment's seeded random number
+    generator. If a Scenario_Corpus (or its path) is given, reset can instead
+    load a pre-generated scenario with options={"scenario_id": i}."""
 
     metadata = {"render_modes": ["human", "rgb_array"], "render_fps": 120}
 
-    def __init__(self, render_mode=None):
-        self.num_modules = random.randint(
-            NUM_MODULES_LOWER_BOUND, NUM_MODULES_UPPER_BOUND
-        )
-        self.num_nodes = random.randint(
-            NUM_NODES_LOWER_BOUND, NUM_NODES_UPPER_BOUND
-        )
+    def __init__(self, render_mode=None, real_time=False, backend="objects",
+                 num_modules=None, num_nodes=None, scenario_corpus=None, max_nodes=None, min_nodes=None,
+                 frame_skip=0, record_path=None, network_model=False, dag_max_parents=None,
+                 critical_path_weight=0.0, arrivals=None, stream_capacity=1_024, stream_length=None):
+        # The number of modules and nodes can be set explicitly, otherwise they
+        # are chosen randomly between the set bounds
+        if num_modules is None:
+            num_modules = random.randint(
+                NUM_MODULES_LOWER_BOUND, NUM_MODULES_UPPER_BOUND
+            )
+        # With padded observations, the number of nodes is drawn from this range
+        # for every episode
+        self.padded = max_nodes is not None
+        if self.padded:
+            if num_nodes is not None:
+                min_nodes = num_nodes
+            elif min_nodes is None:
+                min_nodes = min(NUM_NODES_LOWER_BOUND, max_nodes)
+            assert 1 <= min_nodes <= max_nodes, "Need 1 <= min_nodes <= max_nodes"
+            self.node_range = (min_nodes, max_nodes)
+            num_nodes = max_nodes
+        if num_nodes is None:
+            num_nodes = random.randint(
+                NUM_NODES_LOWER_BOUND, NUM_NODES_UPPER_BOUND
+            )
+        self.num_modules = num_modules
+        self.num_nodes = num_nodes
+        # The number of nodes observations and actions are sized for
+        self.max_nodes = num_nodes
         """self.observation_space = gym.spaces.Dict(
             {
                 "first_module" : gym.spaces.Box(
@@ -87,14 +209,10 @@ class ApplicationPlacementEnv(gym.Env):
                 )
             }
         )"""
-        low=np.concatenate((np.array([0, MODULE_SIZE_LOWER_BOUND, MODULE_MEMORY_REQUIRED_LOWER_BOUND,
-            MODULE_DATA_SIZE_LOWER_BOUND])[None, :], np.resize(np.array([0, NODE_SPEED_LOWER_BOUND,
-            NODE_BANDWIDTH_LOWER_BOUND, NODE_MEMORY_LOWER_BOUND]), (self.num_nodes, 4))))
-        high=np.concatenate((np.array([NUM_MODULES_UPPER_BOUND, MODULE_SIZE_UPPER_BOUND,
-            MODULE_MEMORY_REQUIRED_UPPER_BOUND, MODULE_DATA_SIZE_UPPER_BOUND])[None, :],
-            np.resize(np.array([NUM_NODES_UPPER_BOUND, NODE_SPEED_UPPER_BOUND, NODE_BANDWIDTH_UPPER_BOUND,
-            NODE_MEMORY_UPPER_BOUND]), (self.num_nodes, 4))))
-        self.observation_space = gym.spaces.Box(low, high, shape=(self.num_nodes + 1, 4), dtype=np.int64)
+        # Observations are the normalized features of the first module followed
+        # by the normalized features of every node, flattened
+        self.row_size = PADDED_ROW_SIZE if self.padded else 2
+        self.observation_space = gym.spaces.Box(0.0, 1.0, shape=(self.row_size * (self.max_nodes + 1),), dtype=np.float64)
 
         # The action taken by an agent will be placing a specific module on
         # a specific node for processing.
@@ -103,7 +221,8 @@ class ApplicationPlacementEnv(gym.Env):
             high = np.array([NUM_MODULES_UPPER_BOUND, NUM_NODES_UPPER_BOUND])
         )"""
 
-        self.action_space = gym.spaces.Discrete(1, 0)
+        # The action is the index of the node to place the first module on
+        self.action_space = gym.spaces.Discrete(self.max_nodes)
 
         self.window_size = 1024
 
@@ -111,46 +230,281 @@ class ApplicationPlacementEnv(gym.Env):
         # or it is one of the accepted render methods
         assert render_mode is None or render_mode in self.metadata["render_modes"]
         self.render_mode = render_mode
-        self.window = None
-        self.clock = None
-
+        # Frames are drawn on a separate thread in human mode, or when they are
+        # recorded to a frame file (see environment.renderer), from a snapshot
+        # taken after every reset and step. Only one of every frame_skip + 1
+        # snapshots is drawn.
+        self.record_path = record_path
+        self.frame_skip = frame_skip
+        self.threaded_rendering = render_mode == "human" or record_path is not None
+        self.renderer = None
+        self.num_snapshots = 0
+
+        # Whether modules are processed in real time using asyncio, rather
+        # than on a virtual clock
+        self.real_time = real_time
+
+        # Ensures the state backend is known, and that the arrays backend
+        # (which only runs on a virtual clock) isn't used in real-time mode
+        assert backend in ("objects", "arrays")
+        assert not (real_time and backend == "arrays"), "The arrays backend requires the virtual clock"
+        assert not (real_time and self.padded), "Padded observations require the virtual clock"
+        assert not (real_time and network_model), "The network model requires the virtual clock"
+        assert not (real_time and dag_max_parents is not None), "Dependencies require the virtual clock"
+        assert arrivals is None or backend == "arrays", "Streams require the arrays backend"
+        assert arrivals is None or dag_max_parents is None, "Streamed modules can't have dependencies"
+        self.backend = backend
+        # Preallocated buffer that observations are built in by the arrays
+        # backend. Row 0 is the first module and the other rows are nodes.
+        self.obs_buffer = np.zeros((self.max_nodes + 1, self.row_size), dtype=np.float64)
+        # Preallocated buffer that action masks are built in
+        self.mask_buffer = np.zeros(self.max_nodes, dtype=bool)
+        # The event loop used to drive step_async when step() is called in
+        # real-time mode
+        self.loop = None
+
+        # The link-latency model of the current scenario's nodes, and the node
+        # holding the next module's input data
+        self.network_model = network_model
+        self.network = None
+        self.data_node = 0
+
+        # The maximum number of parents of each module in generated DAGs (None
+        # for independent modules), and the dependencies of the current scenario
+        self.dag_max_parents = dag_max_parents
+        self.critical_path_weight = critical_path_weight
+        self.dag = None
+
+        # The arrival process of streamed modules (None for a fixed set of
+        # modules per episode)
+        self.arrivals = arrivals
+        self.stream_capacity = stream_capacity
+        self.stream_length = stream_length
+
+        # Counts resets, so that snapshots are only restored in their episode
+        self.episode = 0
+
+        # Pre-generated scenarios that reset can load by index
+        if isinstance(scenario_corpus, str):
+            scenario_corpus = Scenario_Corpus(scenario_corpus)
+        self.scenario_corpus = scenario_corpus
+
+    @PROFILER.timed("env.reset")
     def reset(self, seed=None, options=None):
         """Resets the environment by generating a new set of modules and nodes
-        with random characteristics"""
+        with random characteristics, or by loading the scenario given by
+        options["scenario_id"] from the scenario corpus"""
         super().reset(seed=seed)
+        # Counts placements rejected because the node didn't have enough memory
+        self.memory_violations = 0
+        self.episode += 1
+
+        if options is not None and "scenario_id" in options:
+            assert self.scenario_corpus is not None, "Loading a scenario requires a scenario corpus"
+            scenario = self.scenario_corpus.scenario(options["scenario_id"])
+        else:
+            if self.padded:
+                self.num_nodes = int(self.np_random.integers(*self.node_range, endpoint=True))
+            # Streamed modules aren't part of the scenario
+            num_modules = self.num_modules if self.arrivals is None else 0
+            scenario = {
+                name: values[0] for name, values in
+                generate_scenarios(self.np_random, 1, num_modules, self.num_nodes).items()
+            }
+        # The number of modules can vary between scenarios, but the number of
+        # nodes is limited by the shape of the observations
+        if self.padded:
+            self.num_nodes = len(scenario["node_speed"])
+            assert self.num_nodes <= self.max_nodes, "Scenario has too many nodes"
+        assert len(scenario["node_speed"]) == self.num_nodes, "Scenario has the wrong number of nodes"
+
+        num_modules = len(scenario["module_instructions"])
+        if options is not None and "dependencies" in options:
+            assert self.arrivals is None, "Streamed modules can't have dependencies"
+            assert not self.real_time, "Dependencies require the virtual clock"
+            self.dag = Application_Dag(num_modules, *options["dependencies"], scenario["module_instructions"])
+        elif self.dag_max_parents is not None:
+            self.dag = Application_Dag(num_modules, *generate_dag(self.np_random, num_modules, self.dag_max_parents),
+                                       scenario["module_instructions"])
+        else:
+            self.dag = None
+
+        if self.backend == "arrays":
+            self.state = self._create_state(scenario)
+            self.event_queue = self.state.event_queue
+            if self.arrivals is not None:
+                # The clock starts at the first arrival, so there is always a
+                # module to place until the stream ends
+                self.state.advance_to_placeable()
+            # Module features and node speeds don't change during an episode, so
+            # they are normalized once here rather than on every observation
+            self.module_features = np.stack((
+                self.normalize(self.state.module_instructions, MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND),
+                self.normalize(self.state.module_memory, MODULE_MEMORY_REQUIRED_LOWER_BOUND, MODULE_MEMORY_REQUIRED_UPPER_BOUND)
+            ), axis=1)
+            if self.padded:
+                # Padding rows stay zeroed, and real rows are marked
+                self.obs_buffer[:] = 0
+                self.obs_buffer[:self.num_nodes + 1, 2] = 1
+            self.obs_buffer[1:self.num_nodes + 1, 0] = self.normalize(self.state.node_speed, NODE_SPEED_LOWER_BOUND, NODE_SPEED_UPPER_BOUND)
+        else:
+            self.modules = self._create_modules(scenario)
+            self.nodes = self._create_nodes(scenario)
+            # The index of each module object, for snapshots of node queues
+            self.module_indices = {module: i for i, module in self.modules.items()}
+            self.event_queue = Event_Queue()
 
-        self.modules = self._generate_modules(self.num_modules)
-        self.nodes = self._generate_nodes(self.num_nodes)
+        if self.network_model:
+            self.network = Sagin_Network(self.np_random, scenario["node_bandwidth"], ROUTING_DATA_SIZE)
+            self.data_node = 0
 
-        if self.render_mode == "human":
-            self._render_frame()
+        if self.threaded_rendering:
+            self._submit_frame()
 
-        return self._get_obs(), {}
+        return self._get_obs(), {"action_mask": self._action_mask()}
     
     def _first_module(self):
-        """Returns the first module that hasn't started being processed yet"""
+        """Returns the first module that hasn't started being processed yet
+        (with dependencies, the ready module that became ready first)"""
+        if self.backend == "arrays":
+            return self.state.first_module()
+        if self.dag is not None:
+            module = self.dag.next_ready()
+            return self.modules[module] if module is not None else None
         for (_, v) in self.modules.items():
             if not v.processing:
                 return v
         return None
 
-    async def step(self, action: int):
+    def _all_modules_done(self):
+        """Returns whether every module has finished being processed"""
+        if self.backend == "arrays":
+            return self.state.all_done()
+        if self.dag is not None:
+            return self.dag.all_done()
+        for _, v in self.modules.items():
+            if not v.done:
+                return False
+        return True
+
+    def _process_next_event(self):
+        """Advances the virtual clock to the next module completion and
+        finishes that module. Returns False if there are no pending events."""
+        if self.backend == "arrays":
+            return self.state.process_next_event()
+        if len(self.event_queue) == 0:
+            return False
+        node = self.event_queue.pop_next()
+        module = node.finish_module()
+        if self.dag is not None:
+            self.dag.finish(self.module_indices[module])
+        return True
+
+    def step(self, action: int):
         """Moves the environment forward by 1 step (assigning a module to a
         node for processing)"""
+        if self.real_time:
+            # step_async is driven to completion on the environment's own event
+            # loop. Background processing tasks only progress while the loop
+            # runs, so they catch up on the elapsed wall time every step.
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+            return self.loop.run_until_complete(self.step_async(action))
+
+        first_module = self._first_module()
+        reward = 0
+
+        if first_module is not None:
+            transfer_time = 0.0
+            with PLACE_TIMER:
+                if action >= self.num_nodes:
+                    # Padding nodes don't exist, so nothing can be placed on them
+                    placed = False
+                else:
+                    if self.network is not None:
+                        transfer_time = self._transfer_time(first_module, action)
+                    if self.backend == "arrays":
+                        placed = self.state.place(action, transfer_time)
+                    else:
+                        placed = self.nodes[action].schedule_module(first_module, self.event_queue, transfer_time)
+                        if placed and self.dag is not None:
+                            self.dag.pop_ready(action)
+
+            if not placed:
+                reward = -10
+                self.memory_violations += 1
+                PROFILER.count("env.memory_violations")
+                # Nothing can change until a module finishes and frees up
+                # memory, so the clock jumps straight to the next completion
+                with EVENTS_TIMER:
+                    self._process_next_event()
+            else:
+                # The next module's input data is this module's output
+                self.data_node = action
+                time_weight = 1.0
+                if self.dag is not None:
+                    time_weight += self.critical_path_weight * self.dag.criticality[self._module_index(first_module)]
+                if self.backend == "arrays":
+                    reward = self._placement_reward(
+                        self.state.module_instructions[first_module],
+                        self.state.module_memory[first_module],
+                        self.state.node_speed[action],
+                        self.state.node_available_memory[action],
+                        transfer_time,
+                        time_weight
+                    )
+                else:
+                    reward = self._placement_reward(
+                        first_module.num_instructions,
+                        first_module.memory_required,
+                        self.nodes[action].processing_speed,
+                        self.nodes[action].available_memory,
+                        transfer_time,
+                        time_weight
+                    )
+
+        # While no module can be placed there are no decisions to make, so
+        # processing is simulated until a module becomes ready, or (once every
+        # module has been placed) until all modules are done
+        if self.arrivals is not None:
+            # Streamed modules keep arriving, so processing is also simulated
+            # while no node has room for the waiting module, rather than the
+            # agent being left a placement that can only be rejected
+            with EVENTS_TIMER:
+                self.state.advance_to_placeable()
+        elif self._first_module() is None:
+            with EVENTS_TIMER:
+                while self._first_module() is None and self._process_next_event():
+                    pass
+
+        terminated = self._all_modules_done()
+
+        if self.threaded_rendering:
+            self._submit_frame()
+
+        info = {
+            "time": self.event_queue.now,
+            "memory_violations": self.memory_violations,
+            "action_mask": self._action_mask()
+        }
+        if self.arrivals is not None:
+            # The number of streamed modules waiting to be placed
+            info["waiting"] = self.state.waiting()
+        with OBS_TIMER:
+            observation = self._get_obs()
+        return observation, reward, terminated, False, info
+
+    async def step_async(self, action: int):
+        """Moves the environment forward by 1 step (assigning a module to a
+        node for processing) in real-time mode"""
+        assert self.real_time, "step_async requires real_time=True"
         first_module = self._first_module()
         observation = None
         reward = None
 
         # The environment terminates if all modules have finished being
         # processed
-        terminated = True
-        for _, v in self.modules.items():
-            if not v.done:
-                terminated = False
-                break
-        
-        if self.render_mode == "human":
-            self._render_frame()
+        terminated = self._all_modules_done()
 
         if first_module is not None:
             module = first_module
@@ -158,6 +512,7 @@ class ApplicationPlacementEnv(gym.Env):
 
             if module.memory_required > node.available_memory:
                 reward = -10
+                self.memory_violations += 1
                 await asyncio.sleep(0)
             else:
                 # Adding the module to the node's processing queue
@@ -177,15 +532,10 @@ class ApplicationPlacementEnv(gym.Env):
                 # to finish before continuing.
                 await asyncio.sleep(0)
 
-                if self.render_mode == "human":
-                    self._render_frame()
-                
-                # Calculates the processing time of the module
-                processing_time = module.num_instructions / node.processing_speed
-                # Calculates the resource overhead of the current module
-                resource_overhead = module.memory_required / node.available_memory
-                # Calculates the reward for the processing of this module
-                reward = (MAXIMUM_MODULE_PROCESSING_TIME - processing_time) + MAXIMUM_MODULE_PROCESSING_TIME * (1 - resource_overhead)
+                reward = self._placement_reward(
+                    module.num_instructions, module.memory_required,
+                    node.processing_speed, node.available_memory
+                )
 
             observation = self._get_obs()
         else:
@@ -199,149 +549,256 @@ class ApplicationPlacementEnv(gym.Env):
             # environment can't terminate yet. How???
             reward = 0
 
-        if self.render_mode == "human":
-            self._render_frame()
+        if self.threaded_rendering:
+            self._submit_frame()
 
-        return observation, reward, terminated, False, {}
+        info = {"memory_violations": self.memory_violations, "action_mask": self._action_mask()}
+        return observation, reward, terminated, False, info
     
+    @PROFILER.timed("env.get_state")
+    def get_state(self) -> dict:
+        """Returns a snapshot of the current episode that set_state can roll
+        the environment back to, including its random number generator. Only
+        supported on the virtual clock, as real-time processing happens in
+        asyncio tasks that can't be copied."""
+        assert not self.real_time, "Snapshots require the virtual clock"
+        if self.backend == "arrays":
+            state = self.state.get_state()
+        else:
+            state = self._get_object_state()
+        state["episode"] = self.episode
+        state["memory_violations"] = self.memory_violations
+        state["data_node"] = self.data_node
+        state["rng"] = self.np_random.bit_generator.state
+        if self.dag is not None:
+            state["dag"] = self.dag.get_state()
+        if self.network is not None:
+            state["network"] = self.network.get_state()
+        return state
+
+    @PROFILER.timed("env.set_state")
+    def set_state(self, state : dict):
+        """Rolls the environment back to a snapshot from get_state taken in the
+        current episode, and returns its observation and info like reset."""
+        assert state["episode"] == self.episode, "Snapshots can only be restored in the episode they were taken in"
+        # Node queues of the objects backend are rebuilt in the order the DAG
+        # placed their modules, so it is restored first
+        if self.dag is not None:
+            self.dag.set_state(state["dag"])
+        if self.backend == "arrays":
+            self.state.set_state(state)
+        else:
+            self._set_object_state(state)
+        self.memory_violations = state["memory_violations"]
+        self.data_node = state["data_node"]
+        self.np_random.bit_generator.state = state["rng"]
+        if self.network is not None:
+            self.network.set_state(state["network"])
+        return self._get_obs(), {"action_mask": self._action_mask()}
+
+    def _get_object_state(self) -> dict:
+        """Copies the state of the module and node objects into flat arrays, in
+        the same layout as Placement_State.get_state. Completion events refer
+        to the node objects, which stay the same for the whole episode."""
+        modules = self.modules.values()
+        module_node = np.full(len(self.modules), -1, dtype=np.int64)
+        for i, node in self.nodes.items():
+            for module in node.modules:
+                module_node[self.module_indices[module]] = i
+        return {
+            "module_processing": np.fromiter((v.processing for v in modules), bool, len(self.modules)),
+            "module_done": np.fromiter((v.done for v in modules), bool, len(self.modules)),
+            # The node each queued module is on (-1 for other modules)
+            "module_node": module_node,
+            "node_available_memory": np.fromiter((v.available_memory for v in self.nodes.values()), np.int64, self.num_nodes),
+            "node_busy_until": np.fromiter((v.busy_until for v in self.nodes.values()), np.float64, self.num_nodes),
+            "node_processing": np.fromiter((v.processing for v in self.nodes.values()), bool, self.num_nodes),
+            "event_queue": self.event_queue.get_state()
+        }
+
+    def _set_object_state(self, state : dict):
+        """Restores the module and node objects from _get_object_state."""
+        for i, module in self.modules.items():
+            module.processing = bool(state["module_processing"][i])
+            module.done = bool(state["module_done"][i])
+        for i, node in self.nodes.items():
+            node.available_memory = int(state["node_available_memory"][i])
+            node.busy_until = float(state["node_busy_until"][i])
+            node.processing = bool(state["node_processing"][i])
+            node.modules.clear()
+        # Modules are queued in the order they were placed, which is index
+        # order without dependencies, and the front of each queue is its right
+        # end
+        if self.dag is not None:
+            placed = self.dag.order[:self.dag.head]
+            placed = placed[state["module_node"][placed] >= 0]
+        else:
+            placed = np.flatnonzero(state["module_node"] >= 0)
+        for i in placed:
+            self.nodes[int(state["module_node"][i])].modules.appendleft(self.modules[int(i)])
+        self.event_queue.set_state(state["event_queue"])
+
+    def _transfer_time(self, module, node : int) -> float:
+        """Returns the time taken to send a module's input data to a node from
+        the node holding it, with the network's links as of the current
+        simulated time."""
+        self.network.advance_to(self.event_queue.now)
+        if self.backend == "arrays":
+            data_size = self.state.module_data_size[module]
+        else:
+            data_size = module.data_size
+        if self.dag is None:
+            return self.network.transfer_time(self.data_node, node, data_size)
+        parents = self.dag.parents_of(self._module_index(module))
+        if len(parents) == 0:
+            # The application's initial input data is held by node 0
+            return self.network.transfer_time(0, node, data_size)
+        # Each parent sends an equal share of the input data at the same time,
+        # so the module waits for the slowest
+        share = data_size / len(parents)
+        return max(self.network.transfer_time(parent_node, node, share)
+                   for parent_node in self.dag.module_node[parents].tolist())
+
+    def _module_index(self, module) -> int:
+        """Returns the index of a module given by the backend's _first_module."""
+        return module if self.backend == "arrays" else self.module_indices[module]
+
+    @staticmethod
+    def _placement_reward(num_instructions, memory_required, processing_speed, available_memory, transfer_time=0.0,
+                          time_weight=1.0):
+        """Calculates the reward for placing a module on a node. Must be
+        called after the module's memory has been reserved on the node."""
+        # Calculates the processing time of the module, including the time
+        # taken to transfer its input data to the node, weighted by how
+        # critical the module is
+        processing_time = time_weight * (num_instructions / processing_speed + transfer_time)
+        # Calculates the resource overhead of the current module
+        resource_overhead = memory_required / available_memory
+        # Calculates the reward for the processing of this module
+        return (MAXIMUM_MODULE_PROCESSING_TIME - processing_time) + MAXIMUM_MODULE_PROCESSING_TIME * (1 - resource_overhead)
+
+    def stream_statistics(self) -> dict:
+        """Returns the throughput, queue length and latency statistics of the
+        current episode's stream of modules."""
+        assert self.arrivals is not None, "Statistics are only kept for streams"
+        return self.state.statistics.stats()
+
     def render(self):
-        """Returns an rgb array representing the environment."""
-        return self._render_frame()
+        """Returns an rgb array representing the environment. In human mode,
+        frames are drawn by the render thread after every step instead."""
+        if self.render_mode == "rgb_array":
+            return self._render_frame()
 
+    @PROFILER.timed("env.render")
     def _render_frame(self):
-        """Renders the environment's state using PyGame."""
-        # Initializes pygame, and creates a window and/or clock object if they
-        # aren't created already
-        if self.window is None and self.render_mode == "human":
-            pg.init()
-            pg.display.init()
-            pg.font.init()
-            #self.text_font = pg.font.SysFont("Arial", 20)
-            self.window = pg.display.set_mode((self.window_size, self.window_size))
-
-        if self.clock is None and self.render_mode == "human":
-            self.clock = pg.time.Clock()
-
-        # Creates the canvas with a white background to draw on
-        canvas = pg.Surface((self.window_size, self.window_size))
-        canvas.fill((255,255,255))
-
-        """module_text_surface = self.text_font.render("Modules:", False, (0,0,0))
-        canvas.blit(module_text_surface, (10, 10))
-
-        node_text_surface = self.text_font.render("Nodes:", False, (0,0,0))
-        canvas.blit(node_text_surface, (self.window_size - 112, 10))"""
-
-        #TODO: Add labels to illustrations
-
-        #============================ Drawing Modules ==============================#
-        module_radius = 10
-        module_padding = 5 # Distance between modules
-        base_x = 2 * module_radius + module_padding # X-Coordinate of first module
-        base_y = base_x # Y-Coordinate of first module
-        module_colour = (37, 58, 76) # Dark blue
-        column = 0 # Stores the column of the current module
-        row = 0 # Stores the row of the current module
-        for i, (k, v) in enumerate(self.modules.items()):
-            # Iterates through all modules and draws them if they haven't begun
-            # processing
-            if v.processing == False:
-                module_y = base_y + base_y * row
-                module_x = base_x + column * (module_radius * 2 + module_padding)
-                # If the module has reached the bottom of the window, increment the
-                # column
-                if module_y + module_radius + module_padding > self.window_size:
-                    row = 0
-                    column += 1
-                    module_y = base_y + base_y * row
-                    module_x = base_x + column * (module_radius * 2 + module_padding)
-                
-                pg.draw.circle(canvas, module_colour, (module_x, module_y), module_radius)
-                row += 1
-        
-        #============================ Drawing Nodes ==============================#
-        node_x = self.window_size - 712 # Constant X-Coordinate for all nodes
-        node_colour = (226, 131, 89) # Orange
-        node_dims = (40, 20) # Length and height (respectively) of nodes
-        node_padding = 5 # Distance between nodes
-        base_y = node_padding # Y-Coordinate of first node
-        for i, (k, v) in enumerate(self.nodes.items()):
-            # Iterates through all nodes and draws them
-            node_y = base_y + (node_dims[1] + node_padding) * i
-            pg.draw.rect(canvas, node_colour, pg.Rect((node_x, node_y), node_dims))
-            # Draws the modules that are currently assigned to each node.
-            #print(f"Node {k} has {len(v.modules)} modules")
-            if len(v.modules) > 0:
-                for j in range(len(v.modules)):
-                    pg.draw.circle(
-                        canvas,
-                        module_colour,
-                        (node_x + node_dims[0] + (module_radius + node_padding) * ((j + 1) * 2), node_y + module_radius),
-                        module_radius
-                    )
-
-        if self.render_mode == "human":
-            self.window.blit(canvas, canvas.get_rect()) # type: ignore
-            pg.event.pump()
-            pg.display.update()
-            self.clock.tick(self.metadata["render_fps"]) # type: ignore
+        """Draws the environment's current state and returns it as an rgb
+        array."""
+        return canvas_to_rgb(draw_snapshot(self.window_size, *self._snapshot()))
+
+    def _snapshot(self):
+        """Returns the part of the state that is drawn: the number of modules
+        waiting to be placed and the number queued on each node."""
+        if self.backend == "arrays":
+            num_waiting = self.state.waiting()
+            queue_lengths = tuple(self.state.node_queue_length.tolist())
         else:
-            return np.transpose(
-                np.array(pg.surfarray.pixels3d(canvas)), axes=(1,0,2)
+            num_waiting = sum(1 for v in self.modules.values() if not v.processing)
+            queue_lengths = tuple(len(v.modules) for v in self.nodes.values())
+        return num_waiting, queue_lengths
+
+    def _submit_frame(self):
+        """Hands a snapshot of the state to the render thread (starting it if
+        needed), skipping frame_skip snapshots after each one handed over."""
+        self.num_snapshots += 1
+        if (self.num_snapshots - 1) % (self.frame_skip + 1) != 0:
+            return
+        if self.renderer is None:
+            self.renderer = Render_Thread(
+                self.window_size, self.metadata["render_fps"], self.render_mode == "human", self.record_path
             )
+        self.renderer.submit(self.num_snapshots, self._snapshot())
 
     def close(self):
         """Closes all open resources once the environment terminates."""
-        if self.window is not None:
-            pg.display.quit()
-            pg.quit()
-
-    def _generate_modules(self, num_modules : int) -> dict[int, Application_Module]:
-        """Generates a dictionary of Application_Module objects each with randomly
-        generated properties."""
+        if self.renderer is not None:
+            self.renderer.close()
+            self.renderer = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+    def _create_modules(self, scenario : dict) -> dict[int, Application_Module]:
+        """Creates a dictionary of Application_Module objects with the
+        properties of a scenario's modules."""
         modules = {}
-        for i in range(num_modules):
-            # Generates properties of the new modules randomly between set
-            # bounds
-            num_instructions = random.randint(
-                MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND
-            )
-            memory_required = random.randint(
-                MODULE_MEMORY_REQUIRED_LOWER_BOUND,
-                MODULE_MEMORY_REQUIRED_UPPER_BOUND
-            )
-            data_size = random.randint(
-                MODULE_DATA_SIZE_LOWER_BOUND, MODULE_DATA_SIZE_UPPER_BOUND
-            )
-            # Creates the new module using the properties and appends it to
-            # a dictionary
-            modules[i] = Application_Module(num_instructions,
-                                            memory_required, data_size)
+        properties = zip(scenario["module_instructions"].tolist(), scenario["module_memory"].tolist(),
+                         scenario["module_data_size"].tolist())
+        for i, (num_instructions, memory_required, data_size) in enumerate(properties):
+            modules[i] = Application_Module(num_instructions, memory_required, data_size)
         return modules
-    
-    def _generate_nodes(self, num_nodes : int) -> dict[int, Network_Node]:
-        """Generates a dictionary of Node objects each with randomly generated
-        properties."""
+
+    def _create_nodes(self, scenario : dict) -> dict[int, Network_Node]:
+        """Creates a dictionary of Network_Node objects with the properties of
+        a scenario's nodes."""
         nodes = {}
-        for i in range(num_nodes):
-            # Generates properties of the new nodes randomly between set
-            # bounds
-            processing_speed = random.randint(
-                NODE_SPEED_LOWER_BOUND, NODE_SPEED_UPPER_BOUND
-            )
-            bandwidth = random.randint(
-                NODE_BANDWIDTH_LOWER_BOUND, NODE_BANDWIDTH_UPPER_BOUND
-            )
-            memory = random.randint(
-                NODE_MEMORY_LOWER_BOUND, NODE_MEMORY_UPPER_BOUND
-            )
-            # Creates the new node using the properties and appends it to
-            # a dictionary
-            nodes[i] = Network_Node(processing_speed, bandwidth, memory, NUM_MODULES_UPPER_BOUND)
+        num_modules = len(scenario["module_instructions"])
+        properties = zip(scenario["node_speed"].tolist(), scenario["node_bandwidth"].tolist(),
+                         scenario["node_memory"].tolist())
+        for i, (processing_speed, bandwidth, memory) in enumerate(properties):
+            nodes[i] = Network_Node(processing_speed, bandwidth, memory, num_modules)
         return nodes
-    
+
+    def _create_state(self, scenario : dict) -> Placement_State:
+        """Creates a Placement_State holding a scenario's modules and nodes, for
+        use by the arrays backend, or a Streaming_State of its nodes that
+        modules arrive into."""
+        if self.arrivals is not None:
+            return Streaming_State(self.stream_capacity, scenario["node_speed"], scenario["node_bandwidth"],
+                                   scenario["node_memory"], self.arrivals, self.np_random, self.stream_length)
+        return Placement_State(
+            scenario["module_instructions"], scenario["module_memory"], scenario["module_data_size"],
+            scenario["node_speed"], scenario["node_bandwidth"], scenario["node_memory"], self.dag
+        )
+
+    def _action_mask(self):
+        """Returns whether each action places the next module on a node with
+        enough available memory for it, comparing against every node at once.
+        Padding nodes are never allowed."""
+        mask = self.mask_buffer
+        mask[:] = False
+        if self.backend == "arrays":
+            available_memory = self.state.node_available_memory
+            first_module = self.state.first_module()
+            memory_required = self.state.module_memory[first_module] if first_module is not None else 0
+        else:
+            available_memory = np.fromiter((v.available_memory for v in self.nodes.values()), np.int64, self.num_nodes)
+            first_module = self._first_module()
+            memory_required = first_module.memory_required if first_module is not None else 0
+        real = mask[:self.num_nodes]
+        np.less_equal(memory_required, available_memory, out=real)
+        if not real.any():
+            real[:] = True
+        return mask.copy()
+
     def _get_obs(self):
         """Translates the environment's current state into an observation"""
+        if self.backend == "arrays":
+            # Fills the preallocated buffer with a single vectorized
+            # normalization of the node memory (the other columns are filled at
+            # reset) and returns a flattened copy of it
+            first_module = self.state.first_module()
+            if first_module is not None and self.arrivals is not None:
+                # Streamed modules are recycled into slots, so their features
+                # are normalized as they are observed
+                self.obs_buffer[0, 0] = self.normalize(self.state.module_instructions[first_module], MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND)
+                self.obs_buffer[0, 1] = self.normalize(self.state.module_memory[first_module], MODULE_MEMORY_REQUIRED_LOWER_BOUND, MODULE_MEMORY_REQUIRED_UPPER_BOUND)
+            elif first_module is not None:
+                self.obs_buffer[0, :2] = self.module_features[first_module]
+            else:
+                self.obs_buffer[0, :2] = 0
+            np.divide(self.state.node_available_memory, NODE_MEMORY_UPPER_BOUND, out=self.obs_buffer[1:self.num_nodes + 1, 1])
+            return self.obs_buffer.flatten()
+
         first_module = self._first_module()
         if first_module is not None:
             module = first_module
@@ -359,7 +816,13 @@ class ApplicationPlacementEnv(gym.Env):
                 self.normalize(v.available_memory, 0, int(NODE_MEMORY_UPPER_BOUND))
             ]
 
-        return np.concatenate((module_data[None, :], nodes)).flatten()
+        observation = np.concatenate((module_data[None, :], nodes))
+        if self.padded:
+            padded = np.zeros((self.max_nodes + 1, PADDED_ROW_SIZE))
+            padded[:len(observation), :2] = observation
+            padded[:len(observation), 2] = 1
+            observation = padded
+        return observation.flatten()
     
     @staticmethod
     def normalize(val, min_val, max_val):
@@ -0,0 +1,199 @@
+import random
+import numpy as np
+import gymnasium as gym
+from environment.envs.application_placement_env import (
+    ApplicationPlacementEnv, generate_scenarios, NUM_MODULES_LOWER_BOUND, NUM_MODULES_UPPER_BOUND,
+    NUM_NODES_LOWER_BOUND, NUM_NODES_UPPER_BOUND, NODE_SPEED_LOWER_BOUND,
+    NODE_SPEED_UPPER_BOUND, NODE_MEMORY_UPPER_BOUND, MODULE_SIZE_LOWER_BOUND,
+    MODULE_SIZE_UPPER_BOUND, MODULE_MEMORY_REQUIRED_LOWER_BOUND,
+    MODULE_MEMORY_REQUIRED_UPPER_BOUND
+)
+
+class VectorApplicationPlacementEnv(gym.vector.VectorEnv):
+    """Runs N independent application placement scenarios at once. The state
+    of every scenario is held in batched NumPy arrays (one row per
+    sub-environment), so a single call to step() places a module in every
+    sub-environment using vectorized operations instead of a Python loop.
+
+    Each sub-environment follows the same rules as ApplicationPlacementEnv on
+    its virtual clock. Sub-environments that terminate are reset automatically;
+    their final observation is returned in info["final_observation"], and
+    info["final_states"] holds every sub-environment's observation from
+    before the reset (the real next states of the step's experiences)."""
+
+    def __init__(self, num_envs : int, num_modules=None, num_nodes=None):
+        # Every sub-environment has the same number of modules and nodes so
+        # that their state can be stacked into arrays
+        if num_modules is None:
+            num_modules = random.randint(
+                NUM_MODULES_LOWER_BOUND, NUM_MODULES_UPPER_BOUND
+            )
+        if num_nodes is None:
+            num_nodes = random.randint(
+                NUM_NODES_LOWER_BOUND, NUM_NODES_UPPER_BOUND
+            )
+        self.num_modules = num_modules
+        self.num_nodes = num_nodes
+
+        single_env = ApplicationPlacementEnv(num_modules=num_modules, num_nodes=num_nodes)
+        super().__init__(num_envs, single_env.observation_space, single_env.action_space)
+
+        # Index of every sub-environment, used for fancy indexing
+        self.env_index = np.arange(num_envs)
+        # Preallocated buffer that observations are built in. Row 0 of each
+        # sub-environment is the first module and the other rows are nodes.
+        self.obs_buffer = np.zeros((num_envs, num_nodes + 1, 2), dtype=np.float64)
+
+    def reset(self, *, seed=None, options=None):
+        """Resets every sub-environment by generating new sets of modules and
+        nodes with random characteristics"""
+        if seed is not None:
+            self._np_random, _ = gym.utils.seeding.np_random(seed)
+
+        N, M, K = self.num_envs, self.num_modules, self.num_nodes
+        # The number of instructions, memory required and input data size of
+        # each module in each sub-environment
+        self.module_instructions = np.zeros((N, M), dtype=np.int64)
+        self.module_memory = np.zeros((N, M), dtype=np.int64)
+        self.module_data_size = np.zeros((N, M), dtype=np.int64)
+        # The node each module was placed on (-1 if it hasn't been placed)
+        self.module_node = np.full((N, M), -1, dtype=np.int64)
+        # The simulated time each placed module will finish at. Modules that
+        # haven't been placed, or have already finished, are set to infinity
+        self.module_finish_time = np.full((N, M), np.inf)
+        # The processing speed, bandwidth, total memory, available memory and
+        # the time the last queued module finishes for each node
+        self.node_speed = np.zeros((N, K), dtype=np.int64)
+        self.node_bandwidth = np.zeros((N, K), dtype=np.int64)
+        self.node_total_memory = np.zeros((N, K), dtype=np.int64)
+        self.node_available_memory = np.zeros((N, K), dtype=np.int64)
+        self.node_busy_until = np.zeros((N, K), dtype=np.float64)
+        # Normalized module features, computed once per scenario
+        self.module_features = np.zeros((N, M, 2), dtype=np.float64)
+        # The index of the next module to place, the number of finished modules
+        # and the virtual clock of each sub-environment
+        self.cursor = np.zeros(N, dtype=np.int64)
+        self.num_finished = np.zeros(N, dtype=np.int64)
+        self.now = np.zeros(N, dtype=np.float64)
+
+        self._reset_envs(np.ones(N, dtype=bool))
+        return self._get_obs(), {"action_mask": self._action_mask()}
+
+    def _reset_envs(self, mask):
+        """Generates new scenarios for the sub-environments selected by the
+        boolean mask."""
+        scenarios = generate_scenarios(self.np_random, int(mask.sum()), self.num_modules, self.num_nodes)
+
+        self.module_instructions[mask] = scenarios["module_instructions"]
+        self.module_memory[mask] = scenarios["module_memory"]
+        self.module_data_size[mask] = scenarios["module_data_size"]
+        self.module_node[mask] = -1
+        self.module_finish_time[mask] = np.inf
+
+        self.node_speed[mask] = scenarios["node_speed"]
+        self.node_bandwidth[mask] = scenarios["node_bandwidth"]
+        self.node_total_memory[mask] = scenarios["node_memory"]
+        self.node_available_memory[mask] = self.node_total_memory[mask]
+        self.node_busy_until[mask] = 0.0
+
+        normalize = ApplicationPlacementEnv.normalize
+        self.module_features[mask, :, 0] = normalize(self.module_instructions[mask], MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND)
+        self.module_features[mask, :, 1] = normalize(self.module_memory[mask], MODULE_MEMORY_REQUIRED_LOWER_BOUND, MODULE_MEMORY_REQUIRED_UPPER_BOUND)
+        self.obs_buffer[mask, 1:, 0] = normalize(self.node_speed[mask], NODE_SPEED_LOWER_BOUND, NODE_SPEED_UPPER_BOUND)
+
+        self.cursor[mask] = 0
+        self.num_finished[mask] = 0
+        self.now[mask] = 0.0
+
+    def step(self, actions):
+        """Places the first unplaced module of every sub-environment on the
+        node given by the corresponding entry of the (N,) action array"""
+        actions = np.asarray(actions, dtype=np.int64)
+        idx = self.env_index
+        modules = self.cursor
+        rewards = np.zeros(self.num_envs, dtype=np.float64)
+
+        # Checks which sub-environments have enough memory on the chosen node
+        memory_required = self.module_memory[idx, modules]
+        placed = memory_required <= self.node_available_memory[idx, actions]
+
+        #=========================== Successful placements ===========================#
+        p, pm, pn = idx[placed], modules[placed], actions[placed]
+        self.node_available_memory[p, pn] -= memory_required[placed]
+        # Modules are processed in FIFO order on each node
+        start_time = np.maximum(self.now[p], self.node_busy_until[p, pn])
+        finish_time = start_time + self.module_instructions[p, pm] / self.node_speed[p, pn]
+        self.node_busy_until[p, pn] = finish_time
+        self.module_finish_time[p, pm] = finish_time
+        self.module_node[p, pm] = pn
+        self.cursor[p] += 1
+        rewards[p] = ApplicationPlacementEnv._placement_reward(
+            self.module_instructions[p, pm], memory_required[placed],
+            self.node_speed[p, pn], self.node_available_memory[p, pn]
+        )
+
+        #============================= Failed placements =============================#
+        # Nothing can change until a module finishes, so the clock of these
+        # sub-environments jumps to their next completion
+        f = idx[~placed]
+        rewards[f] = -10
+        next_completion = self.module_finish_time[f].min(axis=1)
+        self.now[f] = np.where(np.isfinite(next_completion), next_completion, self.now[f])
+
+        # Sub-environments with every module placed simulate the remaining
+        # processing until all of their modules are done
+        all_placed = self.cursor == self.num_modules
+        self.now[all_placed] = np.maximum(self.now[all_placed], self.node_busy_until[all_placed].max(axis=1))
+
+        #============================ Module completions =============================#
+        # Every module whose finish time has been reached is marked as done
+        # and its memory is released
+        finished_env, finished_module = np.nonzero(self.module_finish_time <= self.now[:, None])
+        np.add.at(
+            self.node_available_memory,
+            (finished_env, self.module_node[finished_env, finished_module]),
+            self.module_memory[finished_env, finished_module]
+        )
+        self.module_finish_time[finished_env, finished_module] = np.inf
+        self.num_finished += np.bincount(finished_env, minlength=self.num_envs)
+
+        terminated = self.num_finished == self.num_modules
+        truncated = np.zeros(self.num_envs, dtype=bool)
+        obs = self._get_obs()
+        infos = {"time": self.now.copy()}
+
+        # Terminated sub-environments are reset automatically, following the
+        # Gymnasium vector environment conventions
+        infos["final_states"] = obs.copy()
+        if terminated.any():
+            final_observation = np.empty(self.num_envs, dtype=object)
+            for i in np.flatnonzero(terminated):
+                final_observation[i] = obs[i].copy()
+            infos["final_observation"] = final_observation
+            infos["_final_observation"] = terminated.copy()
+            self._reset_envs(terminated)
+            obs[terminated] = self._get_obs()[terminated]
+        # Computed after the autoreset, so that the masks match the returned
+        # observations
+        infos["action_mask"] = self._action_mask()
+
+        return obs, rewards, terminated, truncated, infos
+
+    def _action_mask(self):
+        """Returns whether each action of every sub-environment places its next
+        module on a node with enough available memory, in one comparison. If
+        no node of a sub-environment has enough, all of its nodes are allowed."""
+        modules = np.minimum(self.cursor, self.num_modules - 1)
+        memory_required = np.where(self.cursor < self.num_modules, self.module_memory[self.env_index, modules], 0)
+        mask = memory_required[:, None] <= self.node_available_memory
+        mask[~mask.any(axis=1)] = True
+        return mask
+
+    def _get_obs(self):
+        """Translates the current state of every sub-environment into a batch
+        of observations"""
+        has_module = self.cursor < self.num_modules
+        modules = np.minimum(self.cursor, self.num_modules - 1)
+        self.obs_buffer[:, 0] = self.module_features[self.env_index, modules] * has_module[:, None]
+        np.divide(self.node_available_memory, NODE_MEMORY_UPPER_BOUND, out=self.obs_buffer[:, 1:, 1])
+        return self.obs_buffer.reshape(self.num_envs, -1).copy()
@@ -0,0 +1,56 @@
+import heapq
+
+class Event_Queue:
+    """A virtual clock paired with a heap of pending events. Rather than waiting
+    in real time, the simulation jumps straight from one event to the next, so
+    simulated seconds cost no wall time."""
+    def __init__(self):
+        # The current simulated time in seconds
+        self.now = 0.0
+        # A heap of (time, sequence number, payload) tuples. The sequence number
+        # breaks ties so that events scheduled for the same time are processed
+        # in the order they were scheduled (and payloads are never compared)
+        self.events = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def schedule(self, time : float, payload):
+        """Schedules an event carrying the given payload at the given time."""
+        heapq.heappush(self.events, (time, self.sequence, payload))
+        self.sequence += 1
+
+    def next_time(self):
+        """Returns the time of the earliest pending event, or None if there are
+        no pending events."""
+        if len(self.events) > 0:
+            return self.events[0][0]
+        return None
+
+    def pop_next(self):
+        """Advances the clock to the earliest pending event, removes it from the
+        queue and returns its payload."""
+        time, _, payload = heapq.heappop(self.events)
+        # The clock never moves backwards
+        self.now = max(self.now, time)
+        return payload
+
+    def get_state(self) -> dict:
+        """Returns a copy of the clock and the pending events, which set_state
+        restores. Events are immutable tuples, so copying the heap's list is
+        enough."""
+        return {"now": self.now, "sequence": self.sequence, "events": list(self.events)}
+
+    def set_state(self, state : dict):
+        """Restores the clock and pending events from get_state."""
+        self.now = state["now"]
+        self.sequence = state["sequence"]
+        self.events = list(state["events"])
+
+    def pop_until(self, time : float):
+        """Yields the payloads of all events scheduled at or before the given
+        time in timestamp order, then advances the clock to that time."""
+        while len(self.events) > 0 and self.events[0][0] <= time:
+            yield self.pop_next()
+        self.now = max(self.now, time)
@@ -0,0 +1,342 @@
+"""A continuous stream of modules arriving over simulated time.
+
+Rather than every module of an episode being generated at reset, modules
+arrive according to an arrival process: a Poisson process of a given rate,
+or the arrival times (and properties) recorded in a trace. Arrivals are
+scheduled on the virtual clock one at a time, and drawn from the process in
+blocks, so the stream costs the same per module however long it runs.
+
+Module state lives in fixed-capacity slots, the same arrays Placement_State
+uses for a whole scenario, and each slot is recycled once its module
+finishes. Free slots and arrived modules waiting to be placed are each held
+in a ring of slot indices. A module that arrives while every slot is in use
+(or that needs more memory than any node has) is dropped, so an arbitrarily
+long episode runs in constant memory.
+
+Placing a module doesn't advance the clock, so once the nodes' memory is
+taken the waiting module can't be placed anywhere. Rather than leaving the
+agent a placement that can only be rejected, processing is then simulated
+until a module finishes and frees enough memory for it.
+
+Throughput, queue length and latency statistics are maintained online in
+Stream_Statistics, with O(1) work per event and a fixed-size latency
+histogram.
+
+A trace is a directory of .npy files of equal length, arrival_time.npy
+(seconds from the start of the episode, in increasing order) and one file
+per module property (see scenario_corpus.MODULE_PROPERTIES), which are
+memory-mapped rather than loaded."""
+
+from environment.placement_state import Placement_State
+from environment.scenario_corpus import MODULE_PROPERTIES, generate_modules
+import numpy as np
+import math
+import os
+
+# The event payload of the next module arrival (completion events carry the
+# finishing module's slot)
+ARRIVAL = -1
+# The number of arrivals drawn from the arrival process at a time
+ARRIVAL_BLOCK_SIZE = 1_024
+
+# The bounds of the logarithmically spaced latency histogram, in simulated
+# seconds. Latencies outside them are counted in the first or last bin.
+LATENCY_HISTOGRAM_BOUNDS = (1e-3, 1e4)
+LATENCY_HISTOGRAM_BINS = 140
+# The latency percentiles reported by Stream_Statistics.stats
+LATENCY_PERCENTILES = (50, 95, 99)
+
+class Poisson_Arrivals:
+    """Modules arriving as a Poisson process of rate modules per simulated
+    second, with properties drawn uniformly between the environment's
+    bounds."""
+    def __init__(self, rate : float):
+        assert rate > 0, "Arrival rate must be positive"
+        self.rate = rate
+
+    def block(self, rng : np.random.Generator, index : int, last_time : float, size : int) -> dict:
+        """Returns the arrival times and properties of the next size modules,
+        after an arrival at last_time."""
+        block = {"arrival_time": last_time + np.cumsum(rng.exponential(1 / self.rate, size))}
+        block.update(generate_modules(rng, size))
+        return block
+
+class Trace_Arrivals:
+    """Modules arriving at the times, and with the properties, recorded in a
+    trace. The stream ends with the trace."""
+    def __init__(self, arrival_time, module_instructions, module_memory, module_data_size):
+        self.columns = {
+            "arrival_time": arrival_time,
+            "module_instructions": module_instructions,
+            "module_memory": module_memory,
+            "module_data_size": module_data_size
+        }
+        assert all(len(column) == len(arrival_time) for column in self.columns.values()), \
+            "Every module in a trace needs an arrival time and every property"
+
+    def __len__(self):
+        return len(self.columns["arrival_time"])
+
+    @classmethod
+    def load(cls, path : str):
+        """Memory-maps a trace saved in a directory."""
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        return cls(load("arrival_time"), *(load(name) for name in MODULE_PROPERTIES))
+
+    def save(self, path : str):
+        os.makedirs(path, exist_ok=True)
+        for name, column in self.columns.items():
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(column))
+
+    def block(self, rng : np.random.Generator, index : int, last_time : float, size : int) -> dict:
+        """Returns the arrival times and properties of the size modules after
+        the first index modules of the trace (fewer at its end)."""
+        return {name: np.asarray(column[index:index + size]) for name, column in self.columns.items()}
+
+class Stream_Statistics:
+    """Online statistics of a stream of modules. The number of modules
+    waiting to be placed and the number queued (or processing) on nodes are
+    averaged over simulated time, by integrating them between the events that
+    change them, and latencies (from a module's arrival to its completion) are
+    summarized by their running mean, variance and maximum, and by a
+    histogram that percentiles are estimated from."""
+    def __init__(self):
+        self.arrived = 0
+        self.dropped = 0
+        self.completed = 0
+        # The time the queue lengths were last integrated up to, and their
+        # integrals over time
+        self.last_time = 0.0
+        self.waiting_area = 0.0
+        self.queued_area = 0.0
+        self.max_waiting = 0
+        self.max_queued = 0
+        # The running mean and sum of squared deviations of the latencies
+        # (Welford's algorithm), and their maximum
+        self.latency_mean = 0.0
+        self.latency_m2 = 0.0
+        self.latency_max = 0.0
+        self.latency_histogram = np.zeros(LATENCY_HISTOGRAM_BINS, dtype=np.int64)
+
+    def advance(self, now : float, num_waiting : int, num_queued : int):
+        """Integrates the queue lengths, which held since the last call, up
+        to the current time. Called before every change to them."""
+        elapsed = now - self.last_time
+        self.waiting_area += num_waiting * elapsed
+        self.queued_area += num_queued * elapsed
+        self.last_time = now
+        self.max_waiting = max(self.max_waiting, num_waiting)
+        self.max_queued = max(self.max_queued, num_queued)
+
+    def record_completion(self, latency : float):
+        self.completed += 1
+        delta = latency - self.latency_mean
+        self.latency_mean += delta / self.completed
+        self.latency_m2 += delta * (latency - self.latency_mean)
+        self.latency_max = max(self.latency_max, latency)
+        low, high = LATENCY_HISTOGRAM_BOUNDS
+        position = math.log(max(latency, low) / low) / math.log(high / low)
+        self.latency_histogram[min(int(position * LATENCY_HISTOGRAM_BINS), LATENCY_HISTOGRAM_BINS - 1)] += 1
+
+    def latency_percentile(self, percentile : float) -> float:
+        """Estimates a latency percentile as the geometric midpoint of the
+        histogram bin it falls in."""
+        cumulative = np.cumsum(self.latency_histogram)
+        index = int(np.searchsorted(cumulative, percentile / 100 * cumulative[-1]))
+        low, high = LATENCY_HISTOGRAM_BOUNDS
+        return float(low * (high / low) ** ((index + 0.5) / LATENCY_HISTOGRAM_BINS))
+
+    def stats(self) -> dict:
+        """Returns the statistics of the stream so far."""
+        elapsed = float(self.last_time)
+        stats = {
+            "time": elapsed,
+            "arrived": self.arrived,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "throughput": self.completed / elapsed if elapsed > 0 else 0.0,
+            "mean_waiting": float(self.waiting_area) / elapsed if elapsed > 0 else 0.0,
+            "max_waiting": self.max_waiting,
+            "mean_queued": float(self.queued_area) / elapsed if elapsed > 0 else 0.0,
+            "max_queued": self.max_queued,
+            "mean_in_system": float(self.waiting_area + self.queued_area) / elapsed if elapsed > 0 else 0.0
+        }
+        if self.completed > 0:
+            stats["latency"] = {
+                "mean": float(self.latency_mean),
+                "std": math.sqrt(self.latency_m2 / self.completed),
+                "max": float(self.latency_max),
+                **{f"p{p}": self.latency_percentile(p) for p in LATENCY_PERCENTILES}
+            }
+        return stats
+
+    def get_state(self) -> dict:
+        state = dict(vars(self))
+        state["latency_histogram"] = self.latency_histogram.copy()
+        return state
+
+    def set_state(self, state : dict):
+        vars(self).update(state)
+        self.latency_histogram = state["latency_histogram"].copy()
+
+class Streaming_State(Placement_State):
+    """A Placement_State whose modules arrive over time into capacity
+    recycled slots. Modules are placed in the order they arrived, and the
+    stream ends after stream_length arrivals (or never, if it is None, or
+    when a trace runs out)."""
+    def __init__(self, capacity : int, node_speed, node_bandwidth, node_memory, arrivals,
+                 rng : np.random.Generator, stream_length : int | None = None):
+        assert capacity > 0, "Streams need at least 1 slot"
+        super().__init__(np.zeros(capacity, dtype=np.int64), np.zeros(capacity, dtype=np.int64),
+                         np.zeros(capacity, dtype=np.int64), node_speed, node_bandwidth, node_memory)
+        self.capacity = capacity
+        self.arrivals = arrivals
+        self.rng = rng
+        self.stream_length = stream_length
+        # The simulated time each slot's module arrived
+        self.module_arrival_time = np.zeros(capacity, dtype=np.float64)
+
+        # Slots are taken from the head of the free ring and returned to its
+        # tail. Arrived modules wait in the other ring until they are placed.
+        self.free_slots = np.arange(capacity, dtype=np.int64)
+        self.free_head = 0
+        self.num_free = capacity
+        self.waiting_slots = np.zeros(capacity, dtype=np.int64)
+        self.waiting_head = 0
+        self.num_waiting = 0
+
+        # The current block of arrivals drawn from the process, and the number
+        # of arrivals drawn so far
+        self.block = None
+        self.block_position = 0
+        self.num_drawn = 0
+        self.last_arrival_time = 0.0
+        self.statistics = Stream_Statistics()
+        self._schedule_arrival()
+
+    def first_module(self):
+        """Returns the slot of the module that has waited longest, or None if
+        no module is waiting."""
+        if self.num_waiting > 0:
+            return int(self.waiting_slots[self.waiting_head])
+        return None
+
+    def all_done(self) -> bool:
+        """Returns whether the stream has ended and every module that arrived
+        has finished."""
+        return self.block is None and self.num_free == self.capacity
+
+    def waiting(self) -> int:
+        """Returns the number of modules that have arrived but haven't been
+        placed yet."""
+        return self.num_waiting
+
+    def advance_to_placeable(self):
+        """Processes events until a module is waiting and some node has
+        enough memory available for it, or there are no pending events."""
+        while True:
+            slot = self.first_module()
+            if slot is not None and self.module_memory[slot] <= self.node_available_memory.max():
+                return
+            if not self.process_next_event():
+                return
+
+    def place(self, node : int, transfer_time : float = 0.0) -> bool:
+        """Places the module that has waited longest on the given node, as
+        Placement_State.place."""
+        self._advance()
+        if not super().place(node, transfer_time):
+            return False
+        self.waiting_head = (self.waiting_head + 1) % self.capacity
+        self.num_waiting -= 1
+        return True
+
+    def process_next_event(self) -> bool:
+        """Advances the virtual clock to the next arrival or module
+        completion. A finished module frees its memory and its slot. Returns
+        False if there are no pending events."""
+        if len(self.event_queue) == 0:
+            return False
+        slot = self.event_queue.pop_next()
+        self._advance()
+        if slot == ARRIVAL:
+            self._arrive()
+            return True
+        node = self.module_node[slot]
+        self.module_done[slot] = True
+        self.node_available_memory[node] += self.module_memory[slot]
+        self.node_queue_length[node] -= 1
+        self.num_finished += 1
+        self.statistics.record_completion(self.event_queue.now - self.module_arrival_time[slot])
+        self.free_slots[(self.free_head + self.num_free) % self.capacity] = slot
+        self.num_free += 1
+        return True
+
+    def _advance(self):
+        self.statistics.advance(self.event_queue.now, self.num_waiting,
+                                self.capacity - self.num_free - self.num_waiting)
+
+    def _schedule_arrival(self):
+        """Schedules the next arrival, drawing a new block of arrivals if the
+        current one is used up, and ends the stream if there are none left."""
+        if self.stream_length is not None and self.num_drawn >= self.stream_length:
+            self.block = None
+            return
+        if self.block is None or self.block_position == len(self.block["arrival_time"]):
+            self.block = self.arrivals.block(self.rng, self.num_drawn, self.last_arrival_time, ARRIVAL_BLOCK_SIZE)
+            self.block_position = 0
+            if len(self.block["arrival_time"]) == 0:
+                self.block = None
+                return
+        self.num_drawn += 1
+        self.last_arrival_time = float(self.block["arrival_time"][self.block_position])
+        self.event_queue.schedule(self.last_arrival_time, ARRIVAL)
+
+    def _arrive(self):
+        """Moves the module arriving now into a free slot and the waiting
+        ring, or drops it if every slot is in use."""
+        self.statistics.arrived += 1
+        # A module that no node could ever hold would wait forever
+        if self.num_free == 0 or self.block["module_memory"][self.block_position] > self.node_total_memory.max():
+            self.statistics.dropped += 1
+        else:
+            slot = self.free_slots[self.free_head]
+            self.free_head = (self.free_head + 1) % self.capacity
+            self.num_free -= 1
+            i = self.block_position
+            self.module_instructions[slot] = self.block["module_instructions"][i]
+            self.module_memory[slot] = self.block["module_memory"][i]
+            self.module_data_size[slot] = self.block["module_data_size"][i]
+            self.module_arrival_time[slot] = self.event_queue.now
+            self.module_processing[slot] = False
+            self.module_done[slot] = False
+            self.module_node[slot] = -1
+            self.waiting_slots[(self.waiting_head + self.num_waiting) % self.capacity] = slot
+            self.num_waiting += 1
+        self.block_position += 1
+        self._schedule_arrival()
+
+    def get_state(self) -> dict:
+        """Returns copies of the slots, rings, current block of arrivals and
+        statistics alongside Placement_State.get_state."""
+        state = super().get_state()
+        for name in ("module_instructions", "module_memory", "module_data_size", "module_arrival_time",
+                     "free_slots", "waiting_slots"):
+            state[name] = getattr(self, name).copy()
+        for name in ("free_head", "num_free", "waiting_head", "num_waiting", "block_position", "num_drawn",
+                     "last_arrival_time"):
+            state[name] = getattr(self, name)
+        # Blocks are replaced rather than modified, so they are shared
+        state["block"] = self.block
+        state["statistics"] = self.statistics.get_state()
+        return state
+
+    def set_state(self, state : dict):
+        super().set_state(state)
+        for name in ("module_instructions", "module_memory", "module_data_size", "module_arrival_time",
+                     "free_slots", "waiting_slots"):
+            np.copyto(getattr(self, name), state[name])
+        for name in ("free_head", "num_free", "waiting_head", "num_waiting", "block_position", "num_drawn",
+                     "last_arrival_time", "block"):
+            setattr(self, name, state[name])
+        self.statistics.set_state(state["statistics"])
@@ -1,4 +1,5 @@
 from environment.application_module import Application_Module
+from environment.event_queue import Event_Queue
 from collections import deque
 import asyncio
 
@@ -19,6 +20,9 @@ class Network_Node:
         self.modules = deque([], max_modules)
         # Indicates whet
         self.processing = False
+        # The simulated time at which the last module in the queue will finish.
+        # Only used when the node runs on a virtual clock.
+        self.busy_until = 0.0
     
     async def add_module(self, new_module : Application_Module) -> int:
         """Adds a new module into this node's queue of modules to be processed."""
@@ -56,4 +60,39 @@ class Network_Node:
             self.available_memory += module_to_process.memory_required
         # If the node finishes all the modules in its queue then it is no longer
         # processing
-        self.processing = False
\ No newline at end of file
+        self.processing = False
+
+    def schedule_module(self, new_module : Application_Module, event_queue : Event_Queue,
+                        transfer_time : float = 0.0) -> int:
+        """Adds a new module into this node's queue of modules to be processed
+        and schedules its completion on the virtual clock of the event queue.
+        The module's input data takes transfer_time seconds to arrive."""
+
+        # Checks that the node has the memory available to store this module
+        if new_module.memory_required <= self.available_memory:
+            new_module.start_processing()
+            self.modules.appendleft(new_module)
+            self.available_memory -= new_module.memory_required
+            self.processing = True
+
+            # Modules are processed in FIFO order, so the new module starts
+            # once its input data has arrived and every module ahead of it in
+            # the queue has finished
+            start_time = max(event_queue.now + transfer_time, self.busy_until)
+            self.busy_until = start_time + new_module.num_instructions / self.processing_speed
+            event_queue.schedule(self.busy_until, self)
+
+            return 1
+        return 0
+
+    def finish_module(self) -> Application_Module:
+        """Finishes the module at the front of the queue and returns it. Called
+        by the event queue when the module's scheduled completion time is
+        reached."""
+        module_to_process = self.modules.pop()
+        module_to_process.finish_processing()
+        # Frees up the memory occupied by the recently finished module
+        self.available_memory += module_to_process.memory_required
+        if len(self.modules) == 0:
+            self.processing = False
+        return module_to_process
@@ -0,0 +1,141 @@
+from environment.event_queue import Event_Queue
+from environment.application_dag import Application_Dag
+import numpy as np
+
+# The arrays of a Placement_State that change during an episode, which are
+# copied by get_state (the others are fixed by the scenario)
+MUTABLE_ARRAYS = ("module_processing", "module_done", "module_node",
+                  "node_available_memory", "node_busy_until", "node_queue_length")
+
+class Placement_State:
+    """Stores the modules and nodes of an environment as a struct of
+    contiguous NumPy arrays rather than as Python objects. Modules are placed
+    in index order, so the next module to place is tracked with a cursor and
+    termination is checked with a counter of finished modules. Module
+    processing runs on a virtual clock driven by an event queue.
+
+    If the modules have dependencies, they are instead placed in the order
+    they become ready in the Application_Dag, which is updated as modules
+    finish. The DAG's state is snapshotted by the environment."""
+    def __init__(self, module_instructions, module_memory, module_data_size,
+                 node_speed, node_bandwidth, node_memory, dag : Application_Dag | None = None):
+        #================================ Modules ================================#
+        # The number of instructions in each module
+        self.module_instructions = np.asarray(module_instructions, dtype=np.int64)
+        # The memory required by each module in order to execute, in Bytes
+        self.module_memory = np.asarray(module_memory, dtype=np.int64)
+        # The amount of data required by each module as input, in Bytes
+        self.module_data_size = np.asarray(module_data_size, dtype=np.int64)
+        # Whether each module has been placed (and so is queued or processing)
+        self.module_processing = np.zeros(len(self.module_instructions), dtype=bool)
+        # Whether each module has finished processing
+        self.module_done = np.zeros(len(self.module_instructions), dtype=bool)
+        # The node each module was placed on (-1 if it hasn't been placed)
+        self.module_node = np.full(len(self.module_instructions), -1, dtype=np.int64)
+
+        #================================= Nodes =================================#
+        # The processing speed of each node in Instructions Per Second
+        self.node_speed = np.asarray(node_speed, dtype=np.int64)
+        # The bandwidth available to each node in Bytes Per Second
+        self.node_bandwidth = np.asarray(node_bandwidth, dtype=np.int64)
+        # The total memory of each node in Bytes
+        self.node_total_memory = np.asarray(node_memory, dtype=np.int64)
+        # The available memory of each node in Bytes
+        self.node_available_memory = self.node_total_memory.copy()
+        # The simulated time at which the last module queued on each node will
+        # finish
+        self.node_busy_until = np.zeros(len(self.node_speed), dtype=np.float64)
+        # The number of modules queued or processing on each node
+        self.node_queue_length = np.zeros(len(self.node_speed), dtype=np.int64)
+
+        self.num_modules = len(self.module_instructions)
+        self.num_nodes = len(self.node_speed)
+        # The number of modules placed so far, which is also the index of the
+        # next module to place without dependencies
+        self.cursor = 0
+        self.dag = dag
+        # The number of modules that have finished processing
+        self.num_finished = 0
+        # Module completions are scheduled on the virtual clock, with the index
+        # of the finishing module as the payload
+        self.event_queue = Event_Queue()
+
+    def first_module(self):
+        """Returns the index of the first module that hasn't been placed yet, or
+        None if all modules have been placed (or, with dependencies, if no
+        module is ready)."""
+        if self.dag is not None:
+            return self.dag.next_ready()
+        if self.cursor < self.num_modules:
+            return self.cursor
+        return None
+
+    def waiting(self) -> int:
+        """Returns the number of modules that haven't been placed yet."""
+        return self.num_modules - self.cursor
+
+    def all_done(self) -> bool:
+        """Returns whether every module has finished being processed."""
+        return self.num_finished == self.num_modules
+
+    def place(self, node : int, transfer_time : float = 0.0) -> bool:
+        """Places the next module to place on the given node, whose input data
+        takes transfer_time seconds to arrive there. Returns False (leaving the
+        state unchanged) if the node doesn't have enough memory available for
+        the module."""
+        module = self.first_module()
+        memory_required = self.module_memory[module]
+        if memory_required > self.node_available_memory[node]:
+            return False
+
+        self.node_available_memory[node] -= memory_required
+        self.node_queue_length[node] += 1
+        self.module_processing[module] = True
+        self.module_node[module] = node
+
+        # Modules are processed in FIFO order, so the new module starts once
+        # its input data has arrived and every module ahead of it in the node's
+        # queue has finished
+        start_time = max(self.event_queue.now + transfer_time, self.node_busy_until[node])
+        finish_time = start_time + self.module_instructions[module] / self.node_speed[node]
+        self.node_busy_until[node] = finish_time
+        self.event_queue.schedule(finish_time, module)
+
+        if self.dag is not None:
+            self.dag.pop_ready(node)
+        self.cursor += 1
+        return True
+
+    def get_state(self) -> dict:
+        """Returns copies of the arrays, counters and event queue that change
+        during an episode, which set_state restores."""
+        state = {name: getattr(self, name).copy() for name in MUTABLE_ARRAYS}
+        state["cursor"] = self.cursor
+        state["num_finished"] = self.num_finished
+        state["event_queue"] = self.event_queue.get_state()
+        return state
+
+    def set_state(self, state : dict):
+        """Restores the state of the same scenario from get_state, copying into
+        the existing arrays."""
+        for name in MUTABLE_ARRAYS:
+            np.copyto(getattr(self, name), state[name])
+        self.cursor = state["cursor"]
+        self.num_finished = state["num_finished"]
+        self.event_queue.set_state(state["event_queue"])
+
+    def process_next_event(self) -> bool:
+        """Advances the virtual clock to the next module completion, marks that
+        module as done and frees its memory. Returns False if there are no
+        pending events."""
+        if len(self.event_queue) == 0:
+            return False
+        module = self.event_queue.pop_next()
+        node = self.module_node[module]
+        self.module_done[module] = True
+        self.node_available_memory[node] += self.module_memory[module]
+        self.node_queue_length[node] -= 1
+        self.num_finished += 1
+        if self.dag is not None:
+            self.dag.finish(module)
+        return True
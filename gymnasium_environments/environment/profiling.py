@@ -0,0 +1,224 @@
+"""Lightweight instrumentation of the environment and training loops.
+
+Phases of work are timed with named Phase_Timers, used as context managers,
+and events are tallied with named counters. Both belong to the global
+PROFILER, which is disabled by default: a disabled timer only checks a flag
+on entry and exit, so the instrumentation can stay in hot paths.
+
+Timings are aggregated into log-scale histograms (four buckets per power of
+two nanoseconds), from which percentiles are estimated, and can be dumped to
+CSV or JSON periodically. A cProfile capture can also be taken over a window
+of steps."""
+
+from time import perf_counter
+import functools
+import cProfile
+import math
+import json
+import csv
+
+# The number of histogram buckets per power of two
+BUCKETS_PER_OCTAVE = 4
+# Enough buckets for phases of up to 2^48 nanoseconds (about 3 days)
+NUM_BUCKETS = 48 * BUCKETS_PER_OCTAVE
+# The percentiles reported for each timer
+PERCENTILES = (50, 90, 99)
+
+def bucket_lower_bound(bucket : int) -> float:
+    """Returns the smallest duration (in seconds) that falls in a bucket."""
+    exponent, step = divmod(bucket, BUCKETS_PER_OCTAVE)
+    return (0.5 + step / (2 * BUCKETS_PER_OCTAVE)) * 2.0 ** exponent * 1e-9
+
+class Phase_Timer:
+    """Times a named phase each time it is entered as a context manager, while
+    its profiler is enabled."""
+    __slots__ = ("profiler", "name", "start", "count", "total", "min", "max", "histogram")
+
+    def __init__(self, profiler, name : str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.histogram = [0] * NUM_BUCKETS
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            self.record(perf_counter() - self.start)
+            self.start = None
+
+    def record(self, elapsed : float):
+        """Records one timing of the phase, in seconds."""
+        self.count += 1
+        self.total += elapsed
+        if elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        # The mantissa (in [0.5, 1)) picks the bucket within the power of two
+        mantissa, exponent = math.frexp(elapsed * 1e9)
+        bucket = exponent * BUCKETS_PER_OCTAVE + int((mantissa - 0.5) * 2 * BUCKETS_PER_OCTAVE)
+        self.histogram[min(max(bucket, 0), NUM_BUCKETS - 1)] += 1
+
+    def percentile(self, p : float) -> float:
+        """Estimates a percentile of the phase's duration from its histogram,
+        as the upper bound of the bucket it falls in (capped at the max)."""
+        if self.count == 0:
+            return 0.0
+        target = p / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target and n > 0:
+                return min(bucket_lower_bound(bucket + 1), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """Returns the phase's statistics, with durations in microseconds."""
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_us": self.total / self.count * 1e6 if self.count else 0.0,
+            "min_us": self.min * 1e6 if self.count else 0.0,
+            "max_us": self.max * 1e6,
+            **{f"p{p}_us": self.percentile(p) * 1e6 for p in PERCENTILES}
+        }
+
+class Profiler:
+    """Holds the phase timers and counters of a process. Disabled until
+    configure is called with enabled=True."""
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        self.counters = {}
+        # Statistics are dumped to dump_path every dump_every steps (if set)
+        self.dump_path = None
+        self.dump_every = None
+        # A cProfile capture is taken over cprofile_steps steps, starting at
+        # step cprofile_start, and its stats saved to cprofile_path (if set)
+        self.cprofile_path = None
+        self.cprofile_start = 0
+        self.cprofile_steps = 0
+        self.cprofile = None
+        self.steps = 0
+
+    def configure(self, enabled=True, dump_path=None, dump_every=None, cprofile_path=None,
+                  cprofile_start=0, cprofile_steps=1000):
+        """Enables or disables profiling and sets where results are dumped."""
+        assert dump_path is None or dump_path.endswith((".csv", ".json")), "Dump path must be a .csv or .json file"
+        self.enabled = enabled
+        self.dump_path = dump_path
+        self.dump_every = dump_every
+        self.cprofile_path = cprofile_path
+        self.cprofile_start = cprofile_start
+        self.cprofile_steps = cprofile_steps
+
+    def timer(self, name : str) -> Phase_Timer:
+        """Returns the timer with the given name, creating it if needed. Timers
+        in hot paths should be fetched once and kept, rather than looked up on
+        every use."""
+        if name not in self.timers:
+            self.timers[name] = Phase_Timer(self, name)
+        return self.timers[name]
+
+    def timed(self, name : str):
+        """Decorates a function so that every call to it is timed as the named
+        phase."""
+        timer = self.timer(name)
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with timer:
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name : str, n : int = 1):
+        """Adds n to the counter with the given name, while enabled."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def step(self):
+        """Marks the end of one step of a training or evaluation loop. Starts
+        and stops the cProfile window and dumps statistics when they are due."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.cprofile_path is not None:
+            if self.cprofile is None and self.steps >= self.cprofile_start:
+                self.cprofile = cProfile.Profile()
+                self.cprofile.enable()
+            elif self.cprofile is not None and self.steps >= self.cprofile_start + self.cprofile_steps:
+                self.cprofile.disable()
+                self.cprofile.dump_stats(self.cprofile_path)
+                self.cprofile = None
+                # Only one window is captured
+                self.cprofile_path = None
+        if self.dump_every is not None and self.dump_path is not None and self.steps % self.dump_every == 0:
+            self.dump()
+
+    def reset(self):
+        """Clears every timer and counter."""
+        for timer in self.timers.values():
+            timer.reset()
+        self.counters.clear()
+        self.steps = 0
+
+    def summary(self) -> dict:
+        """Returns the statistics of every timer that has run, and every
+        counter."""
+        return {
+            "steps": self.steps,
+            "timers": {name: timer.summary() for name, timer in self.timers.items() if timer.count > 0},
+            "counters": dict(self.counters)
+        }
+
+    def histograms(self) -> dict:
+        """Returns each timer's non-empty histogram buckets, keyed by the lower
+        bound of the bucket in microseconds."""
+        return {
+            name: {f"{bucket_lower_bound(b) * 1e6:.6g}": n for b, n in enumerate(timer.histogram) if n > 0}
+            for name, timer in self.timers.items() if timer.count > 0
+        }
+
+    def dump(self, path=None):
+        """Writes the current statistics to a .json file (including histograms)
+        or a .csv file (one row per timer or counter)."""
+        path = path if path is not None else self.dump_path
+        summary = self.summary()
+        if path.endswith(".json"):
+            summary["histograms_us"] = self.histograms()
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=2)
+            return
+        columns = ["count", "total_s", "mean_us", "min_us", "max_us"] + [f"p{p}_us" for p in PERCENTILES]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "kind"] + columns)
+            for name, stats in summary["timers"].items():
+                writer.writerow([name, "timer"] + [stats[column] for column in columns])
+            for name, count in summary["counters"].items():
+                writer.writerow([name, "counter", count] + [""] * (len(columns) - 1))
+
+    def close(self):
+        """Stops an unfinished cProfile window (saving what it captured) and
+        writes a final dump."""
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            self.cprofile = None
+        if self.enabled and self.dump_path is not None:
+            self.dump()
+
+# The profiler shared by everything in the process
+PROFILER = Profiler()
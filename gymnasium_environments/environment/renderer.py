@@ -0,0 +1,238 @@
+"""Draws the application placement environment off the simulation's hot path.
+
+The environment only hands small snapshots of its state (the number of
+waiting modules and the queue length of each node) to a Render_Thread, which
+only redraws when the snapshot has changed. It can show frames in a window,
+skipping frames whenever drawing falls behind, and/or stream every frame to
+a frame file. Frames are drawn onto offscreen surfaces on the thread, while
+the window and its events stay on the thread that created the renderer, as
+SDL doesn't support windows on other threads on every platform (e.g. macOS).
+
+Frame files hold a header followed by one record per frame: the step the
+frame was taken at, and the frame's RGB pixels compressed with zlib. They
+can be read back with read_frames."""
+
+from environment.profiling import PROFILER
+import numpy as np
+import pygame as pg
+from collections import deque
+import threading
+import time
+import struct
+import zlib
+
+# Identifies frame files, followed by the height and width of their frames
+FRAME_FILE_MAGIC = b"APFRAMES"
+FRAME_FILE_HEADER = struct.Struct("<8sII")
+# The step of a frame and the length of its compressed pixels
+FRAME_RECORD_HEADER = struct.Struct("<qI")
+
+DRAW_TIMER = PROFILER.timer("render.draw")
+
+def draw_snapshot(window_size : int, num_waiting : int, queue_lengths) -> pg.Surface:
+    """Draws the waiting modules and every node's queue onto a new canvas."""
+    # Creates the canvas with a white background to draw on
+    canvas = pg.Surface((window_size, window_size))
+    canvas.fill((255,255,255))
+
+    """module_text_surface = self.text_font.render("Modules:", False, (0,0,0))
+    canvas.blit(module_text_surface, (10, 10))
+
+    node_text_surface = self.text_font.render("Nodes:", False, (0,0,0))
+    canvas.blit(node_text_surface, (window_size - 112, 10))"""
+
+    #TODO: Add labels to illustrations
+
+    #============================ Drawing Modules ==============================#
+    module_radius = 10
+    module_padding = 5 # Distance between modules
+    base_x = 2 * module_radius + module_padding # X-Coordinate of first module
+    base_y = base_x # Y-Coordinate of first module
+    module_colour = (37, 58, 76) # Dark blue
+    column = 0 # Stores the column of the current module
+    row = 0 # Stores the row of the current module
+    # Only modules that haven't begun processing are drawn here, and the
+    # number of modules queued on each node is drawn next to the node
+    for _ in range(num_waiting):
+        # Iterates through all waiting modules and draws them
+        module_y = base_y + base_y * row
+        module_x = base_x + column * (module_radius * 2 + module_padding)
+        # If the module has reached the bottom of the window, increment the
+        # column
+        if module_y + module_radius + module_padding > window_size:
+            row = 0
+            column += 1
+            module_y = base_y + base_y * row
+            module_x = base_x + column * (module_radius * 2 + module_padding)
+
+        pg.draw.circle(canvas, module_colour, (module_x, module_y), module_radius)
+        row += 1
+
+    #============================ Drawing Nodes ==============================#
+    node_x = window_size - 712 # Constant X-Coordinate for all nodes
+    node_colour = (226, 131, 89) # Orange
+    node_dims = (40, 20) # Length and height (respectively) of nodes
+    node_padding = 5 # Distance between nodes
+    base_y = node_padding # Y-Coordinate of first node
+    for i, queue_length in enumerate(queue_lengths):
+        # Iterates through all nodes and draws them
+        node_y = base_y + (node_dims[1] + node_padding) * i
+        pg.draw.rect(canvas, node_colour, pg.Rect((node_x, node_y), node_dims))
+        # Draws the modules that are currently assigned to each node.
+        if queue_length > 0:
+            for j in range(queue_length):
+                pg.draw.circle(
+                    canvas,
+                    module_colour,
+                    (node_x + node_dims[0] + (module_radius + node_padding) * ((j + 1) * 2), node_y + module_radius),
+                    module_radius
+                )
+    return canvas
+
+def canvas_to_rgb(canvas : pg.Surface) -> np.ndarray:
+    """Returns a canvas's pixels as a (height, width, 3) array."""
+    return np.transpose(np.array(pg.surfarray.pixels3d(canvas)), axes=(1,0,2))
+
+class Frame_Writer:
+    """Streams frames to a frame file."""
+    def __init__(self, path : str, window_size : int):
+        self.file = open(path, "wb")
+        self.file.write(FRAME_FILE_HEADER.pack(FRAME_FILE_MAGIC, window_size, window_size))
+
+    def write(self, step : int, frame : np.ndarray):
+        # Frames are mostly background, so even the fastest compression level
+        # shrinks them by orders of magnitude
+        pixels = zlib.compress(np.ascontiguousarray(frame, dtype=np.uint8).tobytes(), 1)
+        self.file.write(FRAME_RECORD_HEADER.pack(step, len(pixels)))
+        self.file.write(pixels)
+
+    def close(self):
+        self.file.close()
+
+def read_frames(path : str):
+    """Yields the step and (height, width, 3) pixels of every frame in a frame
+    file."""
+    with open(path, "rb") as f:
+        magic, height, width = FRAME_FILE_HEADER.unpack(f.read(FRAME_FILE_HEADER.size))
+        assert magic == FRAME_FILE_MAGIC, "Not a frame file"
+        while True:
+            header = f.read(FRAME_RECORD_HEADER.size)
+            if len(header) < FRAME_RECORD_HEADER.size:
+                return
+            step, length = FRAME_RECORD_HEADER.unpack(header)
+            pixels = np.frombuffer(zlib.decompress(f.read(length)), dtype=np.uint8)
+            yield step, pixels.reshape(height, width, 3)
+
+class Render_Thread:
+    """Draws snapshots of the environment on a background thread, showing
+    them in a window (human=True) and/or writing them to a frame file.
+
+    The window only shows the latest snapshot, so snapshots submitted while a
+    frame is being drawn are skipped. Recording keeps every snapshot (they
+    are tiny) and writes each one that differs from the last, so recordings
+    are complete even if drawing falls behind the environment.
+
+    The window is created, updated and has its events pumped by the thread
+    that creates the renderer (normally the main thread), from submit and
+    close, at most render_fps times a second. The background thread only
+    hands it the latest drawn canvas."""
+    def __init__(self, window_size : int, render_fps : int, human : bool, record_path=None):
+        self.window_size = window_size
+        self.render_fps = render_fps
+        self.human = human
+        self.writer = Frame_Writer(record_path, window_size) if record_path is not None else None
+        # Submitted snapshots (and the steps they were taken at) not yet drawn
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+        # The latest canvas drawn for the window that it hasn't shown yet
+        self.canvas = None
+        self.frame_interval = 1 / render_fps
+        if human:
+            pg.init()
+            pg.display.init()
+            self.window = pg.display.set_mode((window_size, window_size))
+            self.last_shown = 0.0
+        self.thread = threading.Thread(target=self._run, name="Render_Thread", daemon=True)
+        self.thread.start()
+
+    def submit(self, step : int, snapshot):
+        """Hands a snapshot to the thread without waiting for it to be drawn."""
+        with self.condition:
+            if self.writer is None and self.pending:
+                # Only the latest snapshot is shown in the window
+                self.frames_skipped += len(self.pending)
+                self.pending.clear()
+            self.pending.append((step, snapshot))
+            self.condition.notify()
+        if self.human:
+            self._show()
+
+    def _show(self, force=False):
+        """Pumps the window's events and shows the latest drawn canvas, unless
+        this was already done within the last frame (or force is set)."""
+        now = time.perf_counter()
+        if not force and now - self.last_shown < self.frame_interval:
+            return
+        self.last_shown = now
+        pg.event.pump()
+        with self.condition:
+            canvas = self.canvas
+            self.canvas = None
+        if canvas is not None:
+            self.window.blit(canvas, canvas.get_rect())
+            pg.display.update()
+
+    def _draw(self, snapshot) -> pg.Surface:
+        with DRAW_TIMER:
+            canvas = draw_snapshot(self.window_size, *snapshot)
+        self.frames_drawn += 1
+        return canvas
+
+    def _run(self):
+        last_snapshot = None
+        canvas = None
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    break
+                snapshots = list(self.pending)
+                self.pending.clear()
+            # Nothing is redrawn if the state hasn't changed
+            changed = False
+            for step, snapshot in snapshots:
+                if snapshot == last_snapshot:
+                    continue
+                last_snapshot = snapshot
+                changed = True
+                if self.writer is not None:
+                    canvas = self._draw(snapshot)
+                    self.writer.write(step, canvas_to_rgb(canvas))
+                else:
+                    canvas = None
+            if self.human and changed:
+                if canvas is None:
+                    canvas = self._draw(last_snapshot)
+                with self.condition:
+                    self.canvas = canvas
+                    # Frames drawn faster than the window shows them would
+                    # only be skipped, so this thread keeps to the frame rate
+                    self.condition.wait_for(lambda: self.stopping, self.frame_interval)
+
+    def close(self):
+        """Draws the pending snapshots, then stops the thread, shows the last
+        frame and closes the window and frame file."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        if self.writer is not None:
+            self.writer.close()
+        if self.human:
+            self._show(force=True)
+            pg.display.quit()
+            pg.quit()
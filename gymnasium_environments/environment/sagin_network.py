@@ -0,0 +1,405 @@
+"""A link-latency model of a space-air-ground integrated network (SAGIN).
+
+Every node belongs to a tier: ground stations, air nodes (e.g. UAVs) or
+space nodes (satellites). Nodes are connected by a graph of links, each with
+a propagation delay drawn for the pair of tiers it joins, and the bandwidth
+of the slower of its two nodes. Ground nodes form a fixed, connected
+backbone, every air node links to ground nodes, and every space node links
+to the ground and air nodes it can currently see. Mobile nodes may also link
+to other nodes in their tier (UAV-to-UAV and inter-satellite links). Each
+link belongs to the mobile node that drew it, and only that node redraws
+it, so the graph is always connected.
+
+Data is routed along the path that is fastest for a typical transfer, and
+store-and-forward over that path takes
+
+    propagation delay + data size * seconds per byte
+
+where both terms are summed over the path's links. Both terms are
+precomputed for every pair of nodes, so looking up a transfer time is O(1).
+
+Air and space nodes move, so their links are redrawn on an ephemeris
+schedule. The node before each node on every row's fastest paths is kept
+in a predecessor matrix, so each row's fastest-path tree is known. When
+links change, the relinked nodes' rows are recomputed, and in other rows
+only the paths below a removed link in the row's tree are repaired (with
+Bellman-Ford passes over the nodes' links, for all of those rows at once).
+The new links are then relaxed into every row with a vectorized O(N^2)
+pass, rather than recomputing every pair."""
+
+from environment.event_queue import Event_Queue
+from environment.profiling import PROFILER
+import numpy as np
+
+# The tiers a node can belong to
+GROUND, AIR, SPACE = range(3)
+TIER_NAMES = ("ground", "air", "space")
+# The probability of a node belonging to each tier. Node 0, which holds the
+# application's initial input data, is always on the ground.
+TIER_PROBABILITIES = (0.5, 0.3, 0.2)
+
+# The lower and upper bounds on the propagation delay of a link between each
+# pair of tiers, in seconds
+LINK_DELAY_LOWER_BOUNDS = np.array([
+    [1e-3, 1e-4, 2e-3],
+    [1e-4, 1e-4, 2e-3],
+    [2e-3, 2e-3, 5e-3]
+])
+LINK_DELAY_UPPER_BOUNDS = np.array([
+    [5e-3, 1e-3, 1.5e-2],
+    [1e-3, 1e-3, 1.5e-2],
+    [1.5e-2, 1.5e-2, 2e-2]
+])
+
+# The expected number of links each ground node has besides the links that
+# keep the backbone connected. Degrees stay bounded as the number of nodes
+# grows, as in real backbones.
+GROUND_EXTRA_LINKS = 2
+# The lower and upper bounds on the number of ground (or ground and air)
+# nodes an air (or space) node is linked to at a time
+AIR_GROUND_LINKS = (1, 2)
+SPACE_VISIBLE_LINKS = (1, 3)
+# The lower and upper bounds on the number of nodes in the same tier a
+# mobile node links to when its links change (UAV-to-UAV links and
+# inter-satellite links)
+MOBILE_PEER_LINKS = (0, 2)
+
+# The lower and upper bounds on the time between link changes of air and
+# space nodes, in simulated seconds. These are compressed to the timescale of
+# an episode, which lasts seconds, so that topologies change within it.
+HANDOVER_INTERVAL_LOWER_BOUNDS = {AIR: 1.0, SPACE: 0.5}
+HANDOVER_INTERVAL_UPPER_BOUNDS = {AIR: 4.0, SPACE: 2.0}
+
+UPDATE_TIMER = PROFILER.timer("network.update_links")
+
+# The link and all-pairs matrices copied by get_state
+STATE_ARRAYS = ("link_delay", "link_seconds_per_byte", "link_cost", "delay", "seconds_per_byte", "cost",
+                "predecessor")
+
+class Sagin_Network:
+    """The tiers and links of a scenario's nodes, and the precomputed transfer
+    latency between every pair of them. Links change as the network's clock
+    is advanced with advance_to."""
+    def __init__(self, rng : np.random.Generator, node_bandwidth, routing_data_size : float, tiers=None):
+        self.rng = rng
+        # The bandwidth available to each node in Bytes Per Second
+        self.node_bandwidth = np.asarray(node_bandwidth, dtype=np.float64)
+        self.num_nodes = len(self.node_bandwidth)
+        # Paths are chosen to minimize the transfer time of this much data
+        self.routing_data_size = routing_data_size
+        if tiers is None:
+            tiers = rng.choice(len(TIER_NAMES), size=self.num_nodes, p=TIER_PROBABILITIES)
+            tiers[0] = GROUND
+        # The tier of each node
+        self.tiers = np.asarray(tiers, dtype=np.int64)
+        assert self.tiers[0] == GROUND, "Node 0 must be a ground node"
+
+        N = self.num_nodes
+        # The propagation delay, seconds per byte and routing cost of each link
+        # (infinite where nodes aren't linked), and the nodes each node is
+        # linked to
+        self.link_delay = np.full((N, N), np.inf)
+        self.link_seconds_per_byte = np.full((N, N), np.inf)
+        self.link_cost = np.full((N, N), np.inf)
+        self.neighbours = [set() for _ in range(N)]
+        # The links each mobile node drew, which it redraws when it moves
+        self.owned_links = [set() for _ in range(N)]
+
+        self._link_ground()
+        self.mobile_nodes = np.flatnonzero(self.tiers != GROUND)
+        for node in self.mobile_nodes:
+            self._link_mobile(node)
+        self._compute_all_pairs()
+
+        # Link changes of mobile nodes are scheduled on the network's own clock,
+        # with the node as the payload
+        self.ephemeris = Event_Queue()
+        for node in self.mobile_nodes:
+            self._schedule_handover(node)
+        # The number of link changes and of rows recomputed because of them
+        self.num_link_changes = 0
+        self.num_rows_recomputed = 0
+
+    def transfer_time(self, source : int, destination : int, data_size : float) -> float:
+        """Returns the time taken to transfer data_size Bytes from one node to
+        another along the precomputed path."""
+        return self.delay[source, destination] + data_size * self.seconds_per_byte[source, destination]
+
+    def get_state(self) -> dict:
+        """Returns copies of the links, all-pairs matrices and handover
+        schedule, which set_state restores. Random draws come from the
+        generator the network was given, whose state isn't included."""
+        return {
+            **{name: getattr(self, name).copy() for name in STATE_ARRAYS},
+            "neighbours": [set(links) for links in self.neighbours],
+            "owned_links": [set(links) for links in self.owned_links],
+            "ephemeris": self.ephemeris.get_state(),
+            "num_link_changes": self.num_link_changes,
+            "num_rows_recomputed": self.num_rows_recomputed
+        }
+
+    def set_state(self, state : dict):
+        """Restores the state of the same network from get_state."""
+        for name in STATE_ARRAYS:
+            np.copyto(getattr(self, name), state[name])
+        self.neighbours = [set(links) for links in state["neighbours"]]
+        self.owned_links = [set(links) for links in state["owned_links"]]
+        self.ephemeris.set_state(state["ephemeris"])
+        self.num_link_changes = state["num_link_changes"]
+        self.num_rows_recomputed = state["num_rows_recomputed"]
+
+    def advance_to(self, time : float):
+        """Applies every link change scheduled at or before the given time."""
+        if self.ephemeris.next_time() is None or self.ephemeris.next_time() > time:
+            return
+        changed = set()
+        for node in self.ephemeris.pop_until(time):
+            changed.add(node)
+            self._schedule_handover(node)
+        with UPDATE_TIMER:
+            self._update_links(sorted(changed))
+
+    #================================= Links =================================#
+    def _add_link(self, u : int, v : int):
+        delay = self.rng.uniform(LINK_DELAY_LOWER_BOUNDS[self.tiers[u], self.tiers[v]],
+                                 LINK_DELAY_UPPER_BOUNDS[self.tiers[u], self.tiers[v]])
+        seconds_per_byte = 1.0 / min(self.node_bandwidth[u], self.node_bandwidth[v])
+        self.link_delay[u, v] = self.link_delay[v, u] = delay
+        self.link_seconds_per_byte[u, v] = self.link_seconds_per_byte[v, u] = seconds_per_byte
+        self.link_cost[u, v] = self.link_cost[v, u] = delay + self.routing_data_size * seconds_per_byte
+        self.neighbours[u].add(v)
+        self.neighbours[v].add(u)
+
+    def _remove_link(self, u : int, v : int):
+        self.link_delay[u, v] = self.link_delay[v, u] = np.inf
+        self.link_seconds_per_byte[u, v] = self.link_seconds_per_byte[v, u] = np.inf
+        self.link_cost[u, v] = self.link_cost[v, u] = np.inf
+        self.neighbours[u].discard(v)
+        self.neighbours[v].discard(u)
+
+    def _link_ground(self):
+        """Links the ground nodes into a connected backbone: a random spanning
+        tree plus extra random links."""
+        ground = self.rng.permutation(np.flatnonzero(self.tiers == GROUND))
+        for i in range(1, len(ground)):
+            self._add_link(ground[i], ground[self.rng.integers(i)])
+        if len(ground) < 3:
+            return
+        # Each extra link joins two ground nodes, so this gives each node
+        # GROUND_EXTRA_LINKS extra links on average
+        for _ in range(self.rng.poisson(GROUND_EXTRA_LINKS * len(ground) / 2)):
+            u, v = self.rng.choice(ground, size=2, replace=False)
+            if v not in self.neighbours[u]:
+                self._add_link(u, v)
+
+    def _link_mobile(self, node : int):
+        """Draws the links of an air or space node for its current position.
+        Air nodes always link to a ground node, and space nodes to a ground or
+        air node, which keeps the graph connected."""
+        tier = self.tiers[node]
+        if tier == AIR:
+            anchors = np.flatnonzero(self.tiers == GROUND)
+            low, high = AIR_GROUND_LINKS
+        else:
+            anchors = np.flatnonzero(self.tiers != SPACE)
+            low, high = SPACE_VISIBLE_LINKS
+        num_links = min(int(self.rng.integers(low, high, endpoint=True)), len(anchors))
+        linked = list(self.rng.choice(anchors, size=num_links, replace=False))
+        peers = np.flatnonzero(self.tiers == tier)
+        peers = peers[peers != node]
+        num_links = min(int(self.rng.integers(*MOBILE_PEER_LINKS, endpoint=True)), len(peers))
+        linked += list(self.rng.choice(peers, size=num_links, replace=False))
+        for other in linked:
+            if other not in self.neighbours[node]:
+                self._add_link(node, other)
+                self.owned_links[node].add(other)
+
+    def _schedule_handover(self, node : int):
+        tier = self.tiers[node]
+        interval = self.rng.uniform(HANDOVER_INTERVAL_LOWER_BOUNDS[tier], HANDOVER_INTERVAL_UPPER_BOUNDS[tier])
+        self.ephemeris.schedule(self.ephemeris.now + interval, node)
+
+    #=============================== All pairs ===============================#
+    def _compute_all_pairs(self):
+        """Computes the fastest path between every pair of nodes with a
+        vectorized Floyd-Warshall, tracking the delay and seconds per byte of
+        each path alongside its cost."""
+        N = self.num_nodes
+        # The node before each node on the fastest path from each row's node
+        # (-1 for the row's own node and for nodes it can't reach)
+        self.predecessor = np.where(np.isfinite(self.link_cost), np.arange(N)[:, None], -1)
+        np.fill_diagonal(self.predecessor, -1)
+        self.delay = self.link_delay.copy()
+        self.seconds_per_byte = self.link_seconds_per_byte.copy()
+        np.fill_diagonal(self.delay, 0.0)
+        np.fill_diagonal(self.seconds_per_byte, 0.0)
+        self.cost = self.link_cost.copy()
+        np.fill_diagonal(self.cost, 0.0)
+        for k in range(N):
+            self._relax(self.cost[:, k, None], 0.0, self.cost[None, k, :],
+                        self.delay[:, k, None] + self.delay[None, k, :],
+                        self.seconds_per_byte[:, k, None] + self.seconds_per_byte[None, k, :],
+                        self.predecessor[None, k, :])
+
+    def _relax(self, cost_to, link_cost, cost_from, delay, seconds_per_byte, predecessor):
+        """Replaces every path that is slower than the given paths (built from
+        a path to a node, a link, and a path from another node)."""
+        via = cost_to + link_cost + cost_from
+        better = via < self.cost
+        if better.any():
+            np.copyto(self.cost, via, where=better)
+            np.copyto(self.delay, delay, where=better)
+            np.copyto(self.seconds_per_byte, seconds_per_byte, where=better)
+            np.copyto(self.predecessor, predecessor, where=better)
+
+    def _relax_link(self, u : int, v : int):
+        """Updates every path that gets faster by using a new link, in both
+        directions."""
+        delay = self.link_delay[u, v]
+        seconds_per_byte = self.link_seconds_per_byte[u, v]
+        link_cost = self.link_cost[u, v]
+        for a, b in ((u, v), (v, u)):
+            # Paths continue from b as they did before, except that b itself is
+            # now reached from a
+            predecessor = self.predecessor[b].copy()
+            predecessor[b] = a
+            self._relax(self.cost[:, a, None], link_cost, self.cost[None, b, :],
+                        self.delay[:, a, None] + delay + self.delay[None, b, :],
+                        self.seconds_per_byte[:, a, None] + seconds_per_byte + self.seconds_per_byte[None, b, :],
+                        predecessor[None, :])
+
+    def _broken_paths(self, removed) -> np.ndarray:
+        """Returns whether each row's fastest path to each node uses one of the
+        removed links, as the nodes below those links in each row's tree.
+        Rows whose tree doesn't use a removed link keep the same paths once
+        it is removed, even if another path through it was just as fast."""
+        broken = np.zeros((self.num_nodes, self.num_nodes), dtype=bool)
+        for u, v in removed:
+            for parent, child in ((u, v), (v, u)):
+                broken[:, child] |= self.predecessor[:, child] == parent
+        # Marks the children of marked nodes until every subtree is marked,
+        # which takes as many passes as the trees are deep
+        rows = np.flatnonzero(broken.any(axis=1))
+        predecessor = self.predecessor[rows]
+        has_parent = predecessor >= 0
+        predecessor = np.where(has_parent, predecessor, 0)
+        below = broken[rows]
+        while True:
+            extended = below | (below[np.arange(len(rows))[:, None], predecessor] & has_parent)
+            if np.array_equal(extended, below):
+                break
+            below = extended
+        broken[rows] = below
+        return broken
+
+    def _update_links(self, nodes):
+        """Redraws the links of the given mobile nodes and updates the
+        all-pairs matrices. The relinked nodes' rows are recomputed and the
+        paths of other rows that used a removed link are repaired, then the
+        new links are relaxed into every row."""
+        removed = [(u, v) for u in nodes for v in self.owned_links[u]]
+        broken = self._broken_paths(removed)
+        for u, v in removed:
+            self._remove_link(u, v)
+        for node in nodes:
+            self.owned_links[node].clear()
+            self._link_mobile(node)
+        added = [(u, v) for u in nodes for v in self.owned_links[u]]
+
+        # The relinked nodes' rows, and so their columns (links are
+        # symmetric), are recomputed first, so the paths repaired below
+        # continue from their new paths rather than their old ones
+        self._shortest_paths(np.asarray(nodes))
+        broken[:, nodes] = False
+        broken[nodes] = False
+        rows = np.flatnonzero(broken.any(axis=1))
+        if len(rows) > 0:
+            self._repair_paths(rows, broken[rows])
+        for u, v in added:
+            self._relax_link(u, v)
+        self.num_link_changes += len(nodes)
+        self.num_rows_recomputed += len(rows) + len(nodes)
+        PROFILER.count("network.rows_recomputed", len(rows) + len(nodes))
+
+    def _repair_paths(self, sources : np.ndarray, broken : np.ndarray):
+        """Recomputes the fastest paths from the given nodes to the nodes
+        marked broken in their rows, keeping their other paths. Every source
+        is repaired at once with Bellman-Ford passes over each node's links:
+        each pass gives every broken node its fastest path through a link
+        from one of its neighbours, so the number of passes is the most links
+        on any repaired path rather than the number of nodes. Paths that new
+        links make faster are left to be relaxed afterwards."""
+        N = self.num_nodes
+        # The neighbours of each node, padded with node N, which has no path
+        degree = max(len(linked) for linked in self.neighbours)
+        neighbours = np.full((N, degree), N, dtype=np.int64)
+        for node, linked in enumerate(self.neighbours):
+            neighbours[node, :len(linked)] = sorted(linked)
+        padded = neighbours == N
+        neighbours_of = np.where(padded, 0, neighbours)
+        links = np.arange(N)[:, None], neighbours_of
+
+        broken_rows, broken_nodes = np.nonzero(broken)
+        candidates = neighbours[broken_nodes]
+        edge = np.arange(len(broken_nodes))
+        link_cost = np.where(padded, np.inf, self.link_cost[links])[broken_nodes]
+        link_delay = self.link_delay[links][broken_nodes]
+        link_seconds_per_byte = self.link_seconds_per_byte[links][broken_nodes]
+        # The matrices of the sources' rows, with broken paths removed and a
+        # column for the padding node
+        cost = np.full((len(sources), N + 1), np.inf)
+        delay = np.full((len(sources), N + 1), np.inf)
+        seconds_per_byte = np.full((len(sources), N + 1), np.inf)
+        cost[:, :N] = np.where(broken, np.inf, self.cost[sources])
+        delay[:, :N] = np.where(broken, np.inf, self.delay[sources])
+        seconds_per_byte[:, :N] = np.where(broken, np.inf, self.seconds_per_byte[sources])
+        parent = np.full(len(broken_nodes), -1, dtype=np.int64)
+        while True:
+            via = cost[broken_rows[:, None], candidates] + link_cost
+            best = np.argmin(via, axis=1)
+            parent = candidates[edge, best]
+            new_cost = via[edge, best]
+            new_delay = delay[broken_rows, parent] + link_delay[edge, best]
+            new_seconds_per_byte = seconds_per_byte[broken_rows, parent] + link_seconds_per_byte[edge, best]
+            # Delays are carried along with the costs, so they settle at most
+            # one pass after them
+            if (np.array_equal(new_cost, cost[broken_rows, broken_nodes])
+                    and np.array_equal(new_delay, delay[broken_rows, broken_nodes])
+                    and np.array_equal(new_seconds_per_byte, seconds_per_byte[broken_rows, broken_nodes])):
+                break
+            cost[broken_rows, broken_nodes] = new_cost
+            delay[broken_rows, broken_nodes] = new_delay
+            seconds_per_byte[broken_rows, broken_nodes] = new_seconds_per_byte
+
+        predecessor = self.predecessor[sources]
+        predecessor[broken_rows, broken_nodes] = np.where(np.isinf(new_cost), -1, parent)
+        self.cost[sources] = cost[:, :N]
+        self.delay[sources] = delay[:, :N]
+        self.seconds_per_byte[sources] = seconds_per_byte[:, :N]
+        self.predecessor[sources] = predecessor
+
+    def _shortest_paths(self, sources : np.ndarray):
+        """Recomputes every fastest path from the given nodes and writes them
+        to their rows and columns (links are symmetric)."""
+        R = len(sources)
+        row = np.arange(R)
+        broken = np.ones((R, self.num_nodes), dtype=bool)
+        broken[row, sources] = False
+        self._repair_paths(sources, broken)
+
+        # The path from another node to a source is its path from the source
+        # reversed, on which the source is reached from the first node after
+        # it. Those are found by following predecessors, one link per pass.
+        predecessor = self.predecessor[sources]
+        reachable = predecessor >= 0
+        predecessor_of = np.where(reachable, predecessor, 0)
+        first_hop = np.where(predecessor == sources[:, None], np.arange(self.num_nodes), -1)
+        while True:
+            found = np.where((first_hop < 0) & reachable, first_hop[row[:, None], predecessor_of], first_hop)
+            if np.array_equal(found, first_hop):
+                break
+            first_hop = found
+        self.cost[:, sources] = self.cost[sources].T
+        self.delay[:, sources] = self.delay[sources].T
+        self.seconds_per_byte[:, sources] = self.seconds_per_byte[sources].T
+        self.predecessor[:, sources] = first_hop.T
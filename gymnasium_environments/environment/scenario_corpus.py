@@ -0,0 +1,97 @@
+"""A corpus of pre-generated scenarios (sets of modules and nodes) stored on
+disk. Each property is stored as its own .npy file with one row per scenario,
+padded to the largest scenario, so the files can be memory-mapped and any
+scenario loaded in O(1) without reading the rest of the corpus. (An .npz
+archive can't be memory-mapped, which is why a directory is used instead.)
+
+Usage: python -m environment.scenario_corpus <Corpus path> <# Scenarios> [Seed]"""
+
+import numpy as np
+import os
+import sys
+
+# The per-module and per-node properties of a scenario, as generated by
+# generate_scenarios in the application placement environment
+MODULE_PROPERTIES = ("module_instructions", "module_memory", "module_data_size")
+NODE_PROPERTIES = ("node_speed", "node_bandwidth", "node_memory")
+
+# These represent the lower and upper bounds on the size of activity
+# modules in # of Instructions
+MODULE_SIZE_LOWER_BOUND = 1_500_000_000
+MODULE_SIZE_UPPER_BOUND = 2_500_000_000
+
+# These represent the lower and upper bounds on the required memory
+# of acitivy modules in Bytes
+MODULE_MEMORY_REQUIRED_LOWER_BOUND = 1_000_000
+MODULE_MEMORY_REQUIRED_UPPER_BOUND = 3_000_000
+
+# These represent the lower and upper bound on the amount of data
+# required for a module to execute in Bytes
+MODULE_DATA_SIZE_LOWER_BOUND = 200_000
+MODULE_DATA_SIZE_UPPER_BOUND = 800_000
+
+def generate_modules(rng : np.random.Generator, shape) -> dict[str, np.ndarray]:
+    """Generates the properties of an array of modules of the given shape,
+    each drawn uniformly between the set bounds."""
+    return {
+        "module_instructions": rng.integers(MODULE_SIZE_LOWER_BOUND, MODULE_SIZE_UPPER_BOUND, shape, endpoint=True),
+        "module_memory": rng.integers(MODULE_MEMORY_REQUIRED_LOWER_BOUND, MODULE_MEMORY_REQUIRED_UPPER_BOUND, shape, endpoint=True),
+        "module_data_size": rng.integers(MODULE_DATA_SIZE_LOWER_BOUND, MODULE_DATA_SIZE_UPPER_BOUND, shape, endpoint=True)
+    }
+
+class Scenario_Corpus:
+    """A memory-mapped corpus of scenarios written by generate_corpus."""
+    def __init__(self, path : str):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.properties = {name: load(name) for name in MODULE_PROPERTIES + NODE_PROPERTIES}
+        # The number of modules and nodes in each scenario (the rows of the
+        # property arrays are padded past these)
+        self.num_modules = load("num_modules")
+        self.num_nodes = load("num_nodes")
+
+    def __len__(self):
+        return len(self.num_modules)
+
+    def scenario(self, scenario_id : int) -> dict:
+        """Returns the properties of a scenario as views into the corpus."""
+        num_modules = int(self.num_modules[scenario_id])
+        num_nodes = int(self.num_nodes[scenario_id])
+        scenario = {name: self.properties[name][scenario_id, :num_modules] for name in MODULE_PROPERTIES}
+        scenario.update({name: self.properties[name][scenario_id, :num_nodes] for name in NODE_PROPERTIES})
+        return scenario
+
+def generate_corpus(path : str, num_scenarios : int, num_modules : int, num_nodes : int,
+                    seed=None, chunk_size=100_000) -> Scenario_Corpus:
+    """Generates num_scenarios scenarios with the given numbers of modules and
+    nodes and writes them to a corpus. Scenarios are generated and written in
+    chunks, so corpora much larger than RAM can be created."""
+    # Imported here as the environment itself imports this module
+    from environment.envs.application_placement_env import generate_scenarios
+
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = {}
+    for name in MODULE_PROPERTIES + NODE_PROPERTIES:
+        width = num_modules if name in MODULE_PROPERTIES else num_nodes
+        files[name] = np.lib.format.open_memmap(
+            os.path.join(path, f"{name}.npy"), mode="w+", dtype=np.int64, shape=(num_scenarios, width)
+        )
+    for start in range(0, num_scenarios, chunk_size):
+        end = min(start + chunk_size, num_scenarios)
+        for name, values in generate_scenarios(rng, end - start, num_modules, num_nodes).items():
+            files[name][start:end] = values
+    for array in files.values():
+        array.flush()
+    np.save(os.path.join(path, "num_modules.npy"), np.full(num_scenarios, num_modules, dtype=np.int64))
+    np.save(os.path.join(path, "num_nodes.npy"), np.full(num_scenarios, num_nodes, dtype=np.int64))
+    return Scenario_Corpus(path)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 or len(sys.argv) == 4:
+        from environment.envs.application_placement_env import NUM_MODULES_UPPER_BOUND, NUM_NODES_UPPER_BOUND
+        seed = int(sys.argv[3]) if len(sys.argv) == 4 else None
+        corpus = generate_corpus(sys.argv[1], int(sys.argv[2]), NUM_MODULES_UPPER_BOUND, NUM_NODES_UPPER_BOUND, seed)
+        print(f"Generated {len(corpus)} scenarios in {sys.argv[1]}")
+    else:
+        print("Please provide arguments: <Corpus path> <# Scenarios> [Seed]")
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from environment.application_dag import Application_Dag, generate_dag
+from environment.envs.application_placement_env import ApplicationPlacementEnv
+
+def make_dag() -> Application_Dag:
+    # 0 -> 2 -> 3, 1 -> 2 and 0 -> 4, with 0 -> 2 given twice
+    return Application_Dag(5, [0, 1, 2, 0, 0], [2, 2, 3, 4, 2], [1, 2, 3, 4, 5])
+
+def test_csr_layout_and_levels():
+    dag = make_dag()
+    assert dag.num_edges == 4
+    np.testing.assert_array_equal(dag.successor_offsets, [0, 2, 3, 4, 4, 4])
+    np.testing.assert_array_equal(dag.successors, [2, 4, 2, 3])
+    np.testing.assert_array_equal(dag.parents_of(2), [0, 1])
+    np.testing.assert_array_equal(dag.in_degree, [0, 0, 2, 1, 1])
+    assert [level.tolist() for level in dag.levels] == [[0, 1], [2, 4], [3]]
+
+def test_critical_paths():
+    dag = make_dag()
+    np.testing.assert_array_equal(dag.critical_path, [8, 9, 7, 4, 5])
+    assert dag.critical_path_length == 9
+    np.testing.assert_allclose(dag.criticality, np.array([8, 9, 7, 4, 5]) / 9)
+
+def test_ready_order():
+    dag = make_dag()
+    placed = []
+    # Modules finish as soon as they are placed
+    while dag.next_ready() is not None:
+        module = dag.pop_ready(node=0)
+        placed.append(module)
+        dag.finish(module)
+    assert placed == [0, 1, 4, 2, 3]
+    assert dag.all_done()
+
+def test_ready_order_waits_for_every_parent():
+    dag = make_dag()
+    assert dag.pop_ready(node=0) == 0
+    assert dag.pop_ready(node=1) == 1
+    assert dag.next_ready() is None
+    dag.finish(1)
+    # Module 2 still waits for module 0
+    assert dag.next_ready() is None
+    dag.finish(0)
+    assert dag.next_ready() == 2
+    np.testing.assert_array_equal(dag.module_node[:2], [0, 1])
+
+def test_cycles_are_rejected():
+    with pytest.raises(AssertionError):
+        Application_Dag(2, [0, 1], [1, 0], [1, 1])
+
+def test_generated_dependencies_point_forwards():
+    parents, children = generate_dag(np.random.default_rng(0), 200, max_parents=3)
+    assert (parents < children).all()
+    assert np.bincount(children, minlength=200).max() <= 3
+
+@pytest.mark.parametrize("network_model", [False, True])
+def test_backends_match_with_dependencies(network_model):
+    trajectories = []
+    for backend in ("objects", "arrays"):
+        env = ApplicationPlacementEnv(backend=backend, num_modules=40, num_nodes=6, dag_max_parents=2,
+                                      critical_path_weight=0.5, network_model=network_model)
+        observation, info = env.reset(seed=3)
+        rng = np.random.default_rng(0)
+        trajectory = [observation]
+        terminated = False
+        while not terminated:
+            action = int(rng.choice(np.flatnonzero(info["action_mask"])))
+            observation, reward, terminated, _, info = env.step(action)
+            trajectory += [observation, reward]
+        trajectories.append(trajectory)
+    assert len(trajectories[0]) == len(trajectories[1])
+    for objects_value, arrays_value in zip(*trajectories):
+        np.testing.assert_array_equal(objects_value, arrays_value)
@@ -0,0 +1,37 @@
+import copy
+import numpy as np
+import pytest
+from environment.sagin_network import Sagin_Network
+
+def make_network(seed : int, num_nodes : int) -> Sagin_Network:
+    rng = np.random.default_rng(seed)
+    return Sagin_Network(rng, rng.integers(2_000_000, 8_000_000, num_nodes, endpoint=True), 500_000)
+
+def assert_matches_full_recompute(network : Sagin_Network):
+    expected = copy.deepcopy(network)
+    expected._compute_all_pairs()
+    for name in ("cost", "delay", "seconds_per_byte"):
+        np.testing.assert_allclose(getattr(network, name), getattr(expected, name), rtol=1e-9, err_msg=name)
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("interval", [None, 1.0])
+def test_link_changes_match_full_recompute(seed, interval):
+    # With an interval, several mobile nodes usually change links at once
+    network = make_network(seed, 50)
+    for _ in range(20):
+        if interval is None:
+            network.advance_to(network.ephemeris.next_time())
+        else:
+            network.advance_to(network.ephemeris.now + interval)
+        assert_matches_full_recompute(network)
+
+def test_predecessors_follow_fastest_paths():
+    network = make_network(0, 80)
+    for _ in range(20):
+        network.advance_to(network.ephemeris.now + 1.0)
+    rows, nodes = np.nonzero(network.predecessor >= 0)
+    predecessors = network.predecessor[rows, nodes]
+    np.testing.assert_allclose(network.cost[rows, predecessors] + network.link_cost[predecessors, nodes],
+                               network.cost[rows, nodes], rtol=1e-9)
+    # Only a row's own node has no predecessor, as the network is connected
+    assert len(rows) == network.num_nodes * (network.num_nodes - 1)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from environment.envs.application_placement_env import ApplicationPlacementEnv
+
+def play(env, info, actions):
+    """Takes each action (an index into the allowed nodes) and returns the
+    observation, reward and termination of every step, and the last info."""
+    steps = []
+    for action in actions:
+        allowed = np.flatnonzero(info["action_mask"])
+        observation, reward, terminated, _, info = env.step(int(allowed[action % len(allowed)]))
+        steps.append((observation, reward, terminated))
+        if terminated:
+            break
+    return steps, info
+
+@pytest.mark.parametrize("backend", ["objects", "arrays"])
+@pytest.mark.parametrize("network_model", [False, True])
+@pytest.mark.parametrize("dag_max_parents", [None, 2])
+def test_restored_snapshot_replays_identically(backend, network_model, dag_max_parents):
+    env = ApplicationPlacementEnv(backend=backend, num_modules=60, num_nodes=8, network_model=network_model,
+                                  dag_max_parents=dag_max_parents)
+    _, info = env.reset(seed=11)
+    rng = np.random.default_rng(0)
+    steps, info = play(env, info, rng.integers(1_000, size=20))
+    observation = steps[-1][0]
+    state = env.get_state()
+    actions = rng.integers(1_000, size=40)
+    first, _ = play(env, info, actions)
+
+    restored_observation, restored_info = env.set_state(state)
+    np.testing.assert_array_equal(restored_observation, observation)
+    np.testing.assert_array_equal(restored_info["action_mask"], info["action_mask"])
+    second, _ = play(env, restored_info, actions)
+    assert len(first) == len(second)
+    for (observation, reward, terminated), (replayed_observation, replayed_reward, replayed_terminated) in zip(first, second):
+        np.testing.assert_array_equal(observation, replayed_observation)
+        assert reward == replayed_reward
+        assert terminated == replayed_terminated